@@ -0,0 +1,156 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .config import (
+    EVENT_AGGREGATION,
+    EVENT_AGGREGATION_WINDOW,
+    EVENT_AGGREGATION_MAX_DELAY,
+    EVENT_AGGREGATION_SAMPLE_SIZE,
+)
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+class _Bucket:
+    """同一鍵在目前視窗內累積的事件"""
+    __slots__ = ("kind", "frame", "summary", "count", "users", "first_at", "last_at", "started", "seq")
+    
+    def __init__(self, kind: str, frame: dict, summary: dict, now: float):
+        self.kind = kind
+        self.frame = frame
+        self.summary = summary
+        self.count = 0
+        self.users: List[str] = []
+        self.first_at = now
+        self.last_at = now
+        self.started = datetime.now().isoformat()
+        # 此鍵在到期堆積中有效項目的序號，其他項目已過時
+        self.seq = 0
+    
+    def deadline(self, window: float, max_delay: float) -> float:
+        return min(self.last_at + window, self.first_at + max_delay)
+
+class EventAggregator:
+    """將短時間內大量的同類事件合併為一個摘要訊框再廣播
+    
+    每個鍵（例如 (訊息 ID, 表情)）的事件累積到 window 秒內沒有新事件，
+    或距第一個事件已滿 max_delay 秒時送出：只有一個事件時送出原本的訊框，
+    多個事件時送出 summary 加上 count、users（最多 sample_size 個使用者）與 first_at。
+    只處理 kinds 中的事件類型，其餘由呼叫端照常逐一廣播。
+    到期時間保存在最小堆積中，新事件只延後鍵的期限而不更新堆積：項目到期時才檢查實際期限，
+    尚未到期則以新期限重新放入，大量不同鍵同時出現時每個事件只需 O(log n)。
+    """
+    def __init__(
+        self,
+        emit: Callable[[dict], Awaitable[None]],
+        kinds=EVENT_AGGREGATION,
+        window: float = EVENT_AGGREGATION_WINDOW,
+        max_delay: float = EVENT_AGGREGATION_MAX_DELAY,
+        sample_size: int = EVENT_AGGREGATION_SAMPLE_SIZE,
+    ):
+        self.emit = emit
+        self.kinds = frozenset(kinds)
+        self.window = window
+        self.max_delay = max_delay
+        self.sample_size = sample_size
+        
+        self._buckets: Dict[Hashable, _Bucket] = {}
+        # (期限, 序號, 鍵)
+        self._deadlines: List[Tuple[float, int, Hashable]] = []
+        self._seq = itertools.count(1)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+    
+    def enabled(self, kind: str) -> bool:
+        return kind in self.kinds
+    
+    def add(self, kind: str, key: Hashable, frame: dict, summary: dict, user: Optional[str] = None):
+        """加入一個事件；frame 為單獨廣播時的訊框，summary 為合併後摘要的基本欄位"""
+        now = time.monotonic()
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            bucket = self._buckets[(kind, key)] = _Bucket(kind, frame, summary, now)
+            deadline = bucket.deadline(self.window, self.max_delay)
+            if not self._deadlines or deadline < self._deadlines[0][0]:
+                # 比目前等待的期限更早才喚醒背景任務
+                self._wakeup.set()
+            self._schedule((kind, key), bucket, deadline)
+            if self._task is None:
+                self._closing = False
+                self._task = asyncio.create_task(self._run())
+        bucket.count += 1
+        bucket.last_at = now
+        if user is not None and len(bucket.users) < self.sample_size and user not in bucket.users:
+            bucket.users.append(user)
+    
+    def pending_count(self) -> int:
+        """尚未送出的事件數"""
+        return sum(bucket.count for bucket in self._buckets.values())
+    
+    async def close(self):
+        """停止背景任務並送出所有累積中的事件"""
+        if self._task:
+            # 不直接取消，避免廣播到一半的摘要被中斷
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        buckets, self._buckets = self._buckets, {}
+        self._deadlines = []
+        for bucket in buckets.values():
+            await self._flush(bucket)
+    
+    def _schedule(self, key: Hashable, bucket: _Bucket, deadline: float):
+        bucket.seq = next(self._seq)
+        heapq.heappush(self._deadlines, (deadline, bucket.seq, key))
+    
+    async def _run(self):
+        while not self._closing:
+            self._wakeup.clear()
+            if not self._deadlines:
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            deadline, seq, key = self._deadlines[0]
+            if deadline > now:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=deadline - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            heapq.heappop(self._deadlines)
+            bucket = self._buckets.get(key)
+            if bucket is None or bucket.seq != seq:
+                # 已送出的鍵，或已重新排程的過時項目
+                continue
+            deadline = bucket.deadline(self.window, self.max_delay)
+            if deadline > now:
+                # 期間有新事件，延後到新的期限
+                self._schedule(key, bucket, deadline)
+                continue
+            del self._buckets[key]
+            await self._flush(bucket)
+    
+    async def _flush(self, bucket: _Bucket):
+        if bucket.count == 1:
+            data = bucket.frame
+        else:
+            data = {
+                **bucket.summary,
+                "count": bucket.count,
+                "users": bucket.users,
+                "first_at": bucket.started,
+                "timestamp": datetime.now().isoformat(),
+            }
+            metrics.EVENTS_AGGREGATED.inc(bucket.count - 1, kind=bucket.kind)
+        try:
+            await self.emit(data)
+        except Exception as e:
+            logger.error(f"廣播合併事件失敗: {e}")
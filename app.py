@@ -5,51 +5,138 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from .config import validate_config, HOST, PORT, DISCORD_TOKEN
+from .config import validate_config, HOST, PORT, DISCORD_TOKEN, OUTBOUND_QUEUE_BACKEND, BROKER_MODE, METRICS_CACHE_COUNT_TTL
 from .websocket_manager import WebSocketManager
 from .bot import DiscordBot
 from .tasks import DiscordSenderTask
+from .outbound import OutboundQueue
+from .queue_store import SQLiteQueueStore
+from .idempotency import IdempotencyCache
+from .tickets import DeliveryTickets
+from .scheduler import MessageScheduler
 from .routes import router, set_globals
+from .broker import BrokerServer, BrokerClient, BrokerForwardMiddleware, acquire_owner_lock
+from .logs import setup_logging
+from . import metrics
 
-# 配置日誌
-logging.basicConfig(level=logging.INFO)
+# 配置日誌（背景執行緒寫出，事件迴圈只負責放入佇列）
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # 全域變數
 discord_bot: DiscordBot = None
-message_queue: asyncio.Queue = None
+message_queue: OutboundQueue = None
 websocket_manager: WebSocketManager = None
 sender_task: DiscordSenderTask = None
+message_scheduler: MessageScheduler = None
 bot_task: asyncio.Task = None
+loop_lag_monitor: metrics.LoopLagMonitor = None
+broker_server: BrokerServer = None
+broker_client: BrokerClient = None
+
+def register_metrics():
+    """設定於輸出時才讀取的即時指標"""
+    metrics.QUEUE_DEPTH.set_function(lambda: message_queue.qsize() if message_queue else 0)
+    metrics.QUEUE_PENDING.set_function(lambda: message_queue.pending_count() if message_queue else 0)
+    metrics.QUEUE_PRIORITY_PENDING.set_function(lambda: {
+        (priority,): count
+        for priority, count in (message_queue.pending_by_priority().items() if message_queue else [])
+    })
+    metrics.SCHEDULED_PENDING.set_function(lambda: message_scheduler.pending_count() if message_scheduler else 0)
+    metrics.QUEUE_CAPACITY.set_function(lambda: message_queue.maxsize if message_queue else 0)
+    metrics.WS_CONNECTIONS.set_function(lambda: websocket_manager.get_connection_count() if websocket_manager else 0)
+    metrics.GATEWAY_LATENCY.set_function(lambda: {
+        (str(shard["shard_id"]),): shard["latency"] if shard["ready"] and shard["latency"] is not None else float("nan")
+        for shard in (discord_bot.shard_status() if discord_bot else [])
+    })
+    metrics.SHARD_READY.set_function(lambda: {
+        (str(shard_id),): 1 if ready else 0
+        for shard_id, ready in (discord_bot.shard_ready.items() if discord_bot else [])
+    })
+    metrics.RATELIMIT_UTILIZATION.set_function(lambda: {
+        (bucket["bucket"], str(bucket["major_id"])): bucket["utilization"]
+        for bucket in (discord_bot.rate_limits.snapshot()["buckets"] if discord_bot else [])
+    })
+    metrics.RESIDENT_MEMORY.set_function(metrics.rss_bytes)
+    metrics.CACHE_OBJECTS.set_function(lambda: {
+        (cache,): count
+        for cache, count in (discord_bot.cache_counts(METRICS_CACHE_COUNT_TTL).items() if discord_bot else [])
+    })
+    metrics.TIME_TO_READY.set_function(lambda: discord_bot.time_to_ready if discord_bot else None)
+    metrics.SEND_OUTAGE_BACKLOG.set_function(lambda: sender_task.get_outage_backlog() if sender_task else 0)
+    metrics.SEND_PARKED.set_function(lambda: {
+        (str(shard_id) if shard_id is not None else "unknown",): count
+        for shard_id, count in (sender_task.get_parked_counts().items() if sender_task else [])
+    })
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """應用程式生命週期管理"""
-    global discord_bot, message_queue, websocket_manager, sender_task, bot_task
-    
-    # 啟動事件
-    logger.info("正在啟動 Discord Bot...")
+    global discord_bot, message_queue, websocket_manager, sender_task, message_scheduler, bot_task, loop_lag_monitor
+    global broker_server, broker_client
     
     # 驗證配置
     validate_config()
     
+    # 多工作程序模式：只有取得檔案鎖的程序連線 Discord，其餘程序轉送請求給它
+    owner_lock = acquire_owner_lock() if BROKER_MODE == "auto" else None
+    if BROKER_MODE == "auto" and owner_lock is None:
+        logger.info("以工作程序模式啟動，HTTP 請求將轉送給 Gateway 擁有者程序")
+        websocket_manager = WebSocketManager()
+        set_globals(None, None, websocket_manager)
+        broker_client = BrokerClient(websocket_manager)
+        await broker_client.start()
+        websocket_manager.set_send_handler(broker_client.forward_message)
+        app.state.broker_client = broker_client
+        register_metrics()
+        loop_lag_monitor = metrics.LoopLagMonitor()
+        loop_lag_monitor.start()
+        
+        yield
+        
+        await loop_lag_monitor.stop()
+        await broker_client.close()
+        return
+    
+    # 啟動事件
+    logger.info("正在啟動 Discord Bot...")
+    
     # 初始化組件
-    message_queue = asyncio.Queue()
+    store = SQLiteQueueStore() if OUTBOUND_QUEUE_BACKEND == "sqlite" else None
+    delivery_tickets = DeliveryTickets()
+    message_queue = OutboundQueue(store=store, tickets=delivery_tickets)
+    await message_queue.open()
+    idempotency_cache = IdempotencyCache(store=store)
+    await idempotency_cache.open()
+    message_scheduler = MessageScheduler(message_queue, delivery_tickets)
     websocket_manager = WebSocketManager()
     
     # 創建 Discord Bot 實例
     discord_bot = DiscordBot(websocket_manager)
     
     # 設定路由的全域變數
-    set_globals(message_queue, discord_bot, websocket_manager)
+    set_globals(message_queue, discord_bot, websocket_manager, idempotency_cache, delivery_tickets, message_scheduler)
     
     # 啟動 Bot 連線（背景執行）
     bot_task = asyncio.create_task(discord_bot.start(DISCORD_TOKEN))
     
     # 創建並啟動訊息發送任務
-    sender_task = DiscordSenderTask(message_queue, discord_bot)
+    sender_task = DiscordSenderTask(message_queue, discord_bot, tickets=delivery_tickets)
     asyncio.create_task(sender_task.start())
     
+    # 啟動排程器（到期的訊息放入發送佇列）
+    message_scheduler.start(message_queue.take_deferred())
+    
+    # 提供給其他工作程序的 broker
+    if owner_lock is not None:
+        broker_server = BrokerServer(app, websocket_manager)
+        await broker_server.start()
+    
+    # 監控指標
+    register_metrics()
+    loop_lag_monitor = metrics.LoopLagMonitor()
+    loop_lag_monitor.start()
+    
     logger.info("Discord Bot 啟動任務已建立")
     
     yield  # 應用程式運行期間
@@ -57,10 +144,24 @@ async def lifespan(app: FastAPI):
     # 關閉事件
     logger.info("正在關閉 Discord Bot...")
     
+    if loop_lag_monitor:
+        await loop_lag_monitor.stop()
+    
+    if broker_server:
+        await broker_server.close()
+    
+    # 停止排程器（未到期的訊息已寫入持久化佇列）
+    if message_scheduler:
+        await message_scheduler.stop()
+    
     # 停止訊息發送任務
     if sender_task:
         await sender_task.stop()
     
+    # 寫入持久化佇列剩餘的變更
+    if message_queue:
+        await message_queue.close()
+    
     # 取消 Bot 任務
     if bot_task:
         bot_task.cancel()
@@ -74,6 +175,9 @@ async def lifespan(app: FastAPI):
         await discord_bot.close()
     
     logger.info("Discord Bot 已關閉")
+    
+    if owner_lock is not None:
+        owner_lock.close()
 
 # 創建 FastAPI 應用
 app = FastAPI(
@@ -92,6 +196,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 工作程序模式下將 HTTP 請求轉送給 Gateway 擁有者（最外層，轉送前不經其他中間件）
+app.add_middleware(BrokerForwardMiddleware)
+
 # 包含路由
 app.include_router(router, prefix="/api/v1")
 
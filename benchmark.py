@@ -0,0 +1,423 @@
+"""離線效能測試：以本機模擬的 Discord REST API 執行發送與 WebSocket 廣播流程
+
+使用方式（在專案上層目錄執行）：
+    python -m project.benchmark --messages 5000 --channels 20 --ws-clients 2000 --latency 30 --rate-limit 0.01
+
+不連線 Discord：REST 請求導向本機的模擬伺服器（可設定延遲與 429 比例），
+Gateway 以直接填入伺服器 / 頻道快取並觸發 on_ready 取代。
+WebSocket 客戶端在獨立子程序中執行，伺服器程序的記憶體量測不包含客戶端。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import discord
+import uvicorn
+from aiohttp import web
+from fastapi import FastAPI
+
+from .config import API_AUTH_TOKEN
+from .bot import DiscordBot
+from .outbound import OutboundQueue
+from .routes import router, set_globals
+from .tasks import DiscordSenderTask
+from .websocket_manager import WebSocketManager
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+BENCH_GUILD_ID = 100000000000000000
+BENCH_CHANNEL_BASE = 200000000000000000
+BENCH_USER = {"id": "300000000000000000", "username": "benchmark-bot", "discriminator": "0000", "avatar": None, "bot": True}
+
+def _percentile(samples: List[float], percent: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(int(len(ordered) * percent / 100), len(ordered) - 1)
+    return ordered[index]
+
+def _latency_summary(samples: List[float]) -> dict:
+    """延遲統計（毫秒）"""
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+    return {
+        "count": len(samples),
+        "p50_ms": ms(_percentile(samples, 50)),
+        "p99_ms": ms(_percentile(samples, 99)),
+        "max_ms": ms(max(samples) if samples else None),
+        "mean_ms": ms(statistics.fmean(samples) if samples else None),
+    }
+
+def _json_response(data: dict, status: int = 200, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    # discord.py 只在 Content-Type 恰為 application/json（不含 charset）時解析 JSON
+    return web.Response(body=json.dumps(data).encode(), status=status, headers={"Content-Type": "application/json", **(headers or {})})
+
+class FakeDiscordAPI:
+    """模擬 Discord REST API 中 Bot 登入與頻道發送會用到的端點"""
+    def __init__(
+        self,
+        latency: float = 0.0,
+        rate_limit: float = 0.0,
+        retry_after: float = 0.1,
+        bucket_limit: int = 0,
+        bucket_window: float = 5.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        # 每個頻道每 bucket_window 秒最多 bucket_limit 次發送（與 Discord 相同以頻道為 major parameter），0 表示不限制
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        # 頻道 -> [視窗重置時間, 剩餘次數]
+        self._windows: Dict[str, list] = {}
+        self._random = random.Random(seed)
+        self._message_ids = iter(range(400000000000000000, 10 ** 19))
+        self.requests = 0
+        self.rate_limited = 0
+        # 每則 bench 訊息從加入 API 到送達模擬 Discord 的延遲
+        self.delivery_latencies: List[float] = []
+        self.delivered_at: List[float] = []
+        self._runner: Optional[web.AppRunner] = None
+    
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/api/v10/users/@me", self._get_me)
+        app.router.add_get("/api/v10/oauth2/applications/@me", self._get_application)
+        app.router.add_get("/api/v10/channels/{channel_id}", self._get_channel)
+        app.router.add_post("/api/v10/channels/{channel_id}/messages", self._send_message)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/api/v10"
+    
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+    
+    async def _get_me(self, request: web.Request) -> web.Response:
+        return _json_response(BENCH_USER)
+    
+    async def _get_application(self, request: web.Request) -> web.Response:
+        return _json_response({
+            "id": BENCH_USER["id"],
+            "name": BENCH_USER["username"],
+            "icon": None,
+            "description": "",
+            "bot_public": True,
+            "bot_require_code_grant": False,
+            "owner": BENCH_USER,
+            "verify_key": "",
+            "flags": 0,
+        })
+    
+    async def _get_channel(self, request: web.Request) -> web.Response:
+        return _json_response(channel_payload(int(request.match_info["channel_id"])))
+    
+    async def _send_message(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        channel_id = request.match_info["channel_id"]
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        now = time.monotonic()
+        limit = self.bucket_limit or 5
+        window = self._windows.get(channel_id)
+        if window is None or now >= window[0]:
+            window = self._windows[channel_id] = [now + self.bucket_window, limit]
+        exhausted = self.bucket_limit and window[1] <= 0
+        
+        if exhausted or (self.rate_limit and self._random.random() < self.rate_limit):
+            self.rate_limited += 1
+            retry_after = round(window[0] - now, 3) if exhausted else self.retry_after
+            return _json_response(
+                {"message": "You are being rate limited.", "retry_after": retry_after, "global": False},
+                status=429,
+                headers={
+                    "Retry-After": str(retry_after),
+                    "X-RateLimit-Limit": str(limit),
+                    "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset-After": str(retry_after),
+                    "X-RateLimit-Bucket": "bench-messages",
+                    "X-RateLimit-Scope": "user",
+                    # 沒有 Via 標頭的 429 會被 discord.py 視為 Cloudflare 封鎖而直接拋出
+                    "Via": "1.1 google",
+                },
+            )
+        if self.bucket_limit:
+            window[1] -= 1
+        
+        data = await request.json()
+        now = time.perf_counter()
+        for line in (data.get("content") or "").splitlines():
+            # bench:<序號>:<送出 API 的 perf_counter>
+            if line.startswith("bench:"):
+                self.delivery_latencies.append(now - float(line.split(":")[2]))
+                self.delivered_at.append(now)
+        
+        return _json_response(
+            {
+                "id": str(next(self._message_ids)),
+                "channel_id": channel_id,
+                "guild_id": str(BENCH_GUILD_ID),
+                "type": 0,
+                "content": data.get("content") or "",
+                "author": BENCH_USER,
+                "attachments": [],
+                "embeds": data.get("embeds") or [],
+                "mentions": [],
+                "mention_roles": [],
+                "mention_everyone": False,
+                "pinned": False,
+                "tts": False,
+                "flags": 0,
+                "components": [],
+                "timestamp": discord.utils.utcnow().isoformat(),
+                "edited_timestamp": None,
+            },
+            headers={
+                "X-RateLimit-Limit": str(limit),
+                "X-RateLimit-Remaining": str(window[1]),
+                "X-RateLimit-Reset-After": str(round(window[0] - now, 3)),
+                "X-RateLimit-Bucket": "bench-messages",
+            },
+        )
+
+def channel_payload(channel_id: int) -> dict:
+    return {
+        "id": str(channel_id),
+        "guild_id": str(BENCH_GUILD_ID),
+        "type": 0,
+        "name": f"bench-{channel_id - BENCH_CHANNEL_BASE}",
+        "position": channel_id - BENCH_CHANNEL_BASE,
+        "permission_overwrites": [],
+        "nsfw": False,
+        "parent_id": None,
+    }
+
+def seed_gateway_state(bot: DiscordBot, channel_ids: List[int]):
+    """以模擬資料填入 Bot 的伺服器 / 頻道快取，取代 Gateway 的 GUILD_CREATE"""
+    guild = discord.Guild(
+        data={
+            "id": str(BENCH_GUILD_ID),
+            "name": "benchmark",
+            "owner_id": BENCH_USER["id"],
+            "member_count": 1,
+            "roles": [],
+            "emojis": [],
+            "stickers": [],
+            "features": [],
+            "channels": [channel_payload(channel_id) for channel_id in channel_ids],
+        },
+        state=bot._connection,
+    )
+    bot._connection._add_guild(guild)
+
+def build_app(bot: DiscordBot, message_queue: OutboundQueue, websocket_manager: WebSocketManager, sender: DiscordSenderTask) -> FastAPI:
+    """與 app.py 相同的路由，但不啟動 Gateway 連線"""
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        set_globals(message_queue, bot, websocket_manager)
+        sender_task = asyncio.create_task(sender.start())
+        yield
+        await sender.stop()
+        sender_task.cancel()
+    
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router, prefix="/api/v1")
+    return app
+
+async def _start_server(app: FastAPI) -> Tuple[uvicorn.Server, asyncio.Task, int]:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="on"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, server_task, port
+
+async def _post_messages(base_url: str, args, channel_ids: List[int]) -> dict:
+    """以 args.http_concurrency 個並行連線送出 args.messages 則訊息"""
+    headers = {"Authorization": f"Bearer {API_AUTH_TOKEN}"} if API_AUTH_TOKEN else {}
+    counter = iter(range(args.messages))
+    statuses: Dict[int, int] = {}
+    
+    async def client(session: aiohttp.ClientSession):
+        for seq in counter:
+            payload = {
+                "content": f"bench:{seq}:{time.perf_counter()}",
+                "channel_id": channel_ids[seq % len(channel_ids)],
+            }
+            async with session.post(f"{base_url}/api/v1/send-message", json=payload, headers=headers) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+    
+    connector = aiohttp.TCPConnector(limit=args.http_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(client(session) for _ in range(args.http_concurrency)))
+    return statuses
+
+async def run_benchmark(args) -> dict:
+    fake = FakeDiscordAPI(
+        latency=args.latency / 1000, rate_limit=args.rate_limit, retry_after=args.retry_after,
+        bucket_limit=args.bucket_limit, bucket_window=args.bucket_window, seed=args.seed,
+    )
+    discord.http.Route.BASE = await fake.start()
+    
+    websocket_manager = WebSocketManager()
+    bot = DiscordBot(websocket_manager)
+    await bot.login("benchmark-token")
+    channel_ids = [BENCH_CHANNEL_BASE + index for index in range(args.channels)]
+    seed_gateway_state(bot, channel_ids)
+    await bot.on_ready()
+    
+    message_queue = OutboundQueue(maxsize=0)
+    await message_queue.open()
+    sender = DiscordSenderTask(message_queue, bot, concurrency=args.sender_concurrency, coalesce=args.coalesce)
+    server, server_task, port = await _start_server(build_app(bot, message_queue, websocket_manager, sender))
+    base_url = f"http://127.0.0.1:{port}"
+    result: dict = {"config": vars(args)}
+    
+    try:
+        # 連線 WebSocket 客戶端（子程序），量測每條連線的伺服器端記憶體
+        ws_process = None
+        if args.ws_clients:
+            rss_before = metrics.rss_bytes()
+            ws_process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", __spec__.name, "--ws-worker", f"ws://127.0.0.1:{port}/api/v1/ws",
+                "--ws-clients", str(args.ws_clients),
+                stdout=asyncio.subprocess.PIPE,
+            )
+            await ws_process.stdout.readline()
+            while websocket_manager.get_connection_count() < args.ws_clients:
+                await asyncio.sleep(0.05)
+            rss_after = metrics.rss_bytes()
+            result["websocket"] = {
+                "connections": websocket_manager.get_connection_count(),
+                "memory_per_connection_bytes": (rss_after - rss_before) // args.ws_clients,
+            }
+        
+        # 發送：HTTP API -> 佇列 -> 發送任務 -> 模擬 Discord
+        started = time.perf_counter()
+        statuses = await _post_messages(base_url, args, channel_ids)
+        accepted_at = time.perf_counter()
+        while message_queue.pending_count() and time.perf_counter() - accepted_at < args.drain_timeout:
+            await asyncio.sleep(0.05)
+        finished = fake.delivered_at[-1] if fake.delivered_at else time.perf_counter()
+        result["send"] = {
+            "http_statuses": statuses,
+            "accept_rate_per_sec": round(args.messages / (accepted_at - started), 1),
+            "delivered": len(fake.delivery_latencies),
+            "messages_per_sec": round(len(fake.delivery_latencies) / (finished - started), 1),
+            "discord_requests": fake.requests,
+            "rate_limited_responses": fake.rate_limited,
+            "deferred_sends": metrics.SEND_DEFERRED.get(),
+            "enqueue_to_delivery": _latency_summary(fake.delivery_latencies),
+        }
+        
+        # 廣播：直接呼叫 WebSocketManager.broadcast，由客戶端量測送達延遲
+        if ws_process:
+            broadcast_started = time.perf_counter()
+            for index in range(args.broadcasts):
+                await websocket_manager.broadcast({"type": "bench", "n": index, "sent_at": time.time()})
+                if index % 100 == 99:
+                    await asyncio.sleep(0)
+            fan_out_seconds = time.perf_counter() - broadcast_started
+            await websocket_manager.broadcast({"type": "bench_end"})
+            output, _ = await asyncio.wait_for(ws_process.communicate(), timeout=args.drain_timeout)
+            client_report = json.loads(output.decode().strip().splitlines()[-1])
+            result["broadcast"] = {
+                "events": args.broadcasts,
+                "fan_out_seconds": round(fan_out_seconds, 4),
+                "fan_out_frames_per_sec": round(args.broadcasts * args.ws_clients / fan_out_seconds, 1) if fan_out_seconds else None,
+                **client_report,
+            }
+    finally:
+        server.should_exit = True
+        await server_task
+        await message_queue.close()
+        await bot.close()
+        await fake.close()
+    return result
+
+async def run_ws_worker(url: str, clients: int):
+    """子程序：建立多條 WebSocket 連線並統計 bench 事件的送達延遲，結果以 JSON 輸出到 stdout"""
+    latencies: List[float] = []
+    received = 0
+    finished = asyncio.Event()
+    done_count = 0
+    
+    async def consume(ws: aiohttp.ClientWebSocketResponse):
+        nonlocal received, done_count
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                break
+            event = json.loads(message.data)
+            if event.get("type") == "bench":
+                received += 1
+                latencies.append(time.time() - event["sent_at"])
+            elif event.get("type") == "bench_end":
+                break
+        done_count += 1
+        if done_count == clients:
+            finished.set()
+    
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        sockets = []
+        for _ in range(clients):
+            ws = await session.ws_connect(url, max_msg_size=0)
+            # 只訂閱廣播測試的事件，避免發送階段的 success 事件影響延遲量測
+            await ws.send_json({"action": "subscribe", "types": ["bench", "bench_end"]})
+            sockets.append(ws)
+        print(json.dumps({"connected": len(sockets)}), flush=True)
+        tasks = [asyncio.create_task(consume(ws)) for ws in sockets]
+        await finished.wait()
+        for ws in sockets:
+            await ws.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    print(json.dumps({"frames_received": received, "delivery": _latency_summary(latencies)}), flush=True)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Discord Bot API 離線效能測試")
+    parser.add_argument("--messages", type=int, default=2000, help="透過 /send-message 送出的訊息數")
+    parser.add_argument("--channels", type=int, default=10, help="模擬的頻道數，訊息平均分配到各頻道")
+    parser.add_argument("--http-concurrency", type=int, default=50, help="並行的 HTTP 客戶端數")
+    parser.add_argument("--sender-concurrency", type=int, default=8, help="發送任務的並行頻道數")
+    parser.add_argument("--coalesce", action="store_true", help="啟用同頻道訊息合併")
+    parser.add_argument("--latency", type=float, default=20.0, help="模擬 Discord API 的回應延遲（毫秒）")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="回應 429 的機率（0–1）")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="429 回應的 retry_after 秒數")
+    parser.add_argument("--bucket-limit", type=int, default=0, help="每個頻道每個視窗最多發送次數，0 表示不限制")
+    parser.add_argument("--bucket-window", type=float, default=5.0, help="頻道限流視窗秒數")
+    parser.add_argument("--ws-clients", type=int, default=1000, help="WebSocket 訂閱者數")
+    parser.add_argument("--broadcasts", type=int, default=200, help="廣播測試的事件數")
+    parser.add_argument("--drain-timeout", type=float, default=120.0, help="等待佇列清空與客戶端收完的最長秒數")
+    parser.add_argument("--seed", type=int, default=0, help="429 注入的亂數種子")
+    parser.add_argument("--ws-worker", metavar="URL", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    if args.ws_worker:
+        asyncio.run(run_ws_worker(args.ws_worker, args.ws_clients))
+        return
+    result = asyncio.run(run_benchmark(args))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
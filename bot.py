@@ -1,27 +1,93 @@
 import logging
 import discord
 from discord.ext import commands
+import math
+import time
+from collections import Counter
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Dict, List, Optional
+from .config import (
+    DISCORD_SHARDING,
+    DISCORD_SHARD_COUNT,
+    DISCORD_SHARD_IDS,
+    DISCORD_CACHE_POLICY,
+    DISCORD_INTENTS,
+    DISCORD_MEMBER_CACHE,
+    DISCORD_CHUNK_GUILDS,
+    DISCORD_MAX_MESSAGES,
+    SENDER_MAX_RATELIMIT_WAIT,
+)
+from .ratelimit import RateLimitTracker
 from .websocket_manager import WebSocketManager
+from .snapshot import GuildSnapshot
+from .channels import ChannelResolver
+from .aggregation import EventAggregator
 from .commands_impl import ping_command, status_command, servers_command, channels_command
 
 logger = logging.getLogger(__name__)
 
-class DiscordBot(commands.Bot):
+# 啟用分片時以 AutoShardedBot 為基底，每個分片各自維持一條 Gateway 連線
+_BotBase = commands.AutoShardedBot if DISCORD_SHARDING == "auto" else commands.Bot
+
+def _build_intents(names) -> discord.Intents:
+    """由旗標名稱建立 Intents；default 表示 discord.py 的預設（非特權）組合"""
+    intents = discord.Intents.none()
+    for name in names:
+        if name == "default":
+            intents.value |= discord.Intents.default().value
+        elif name in discord.Intents.VALID_FLAGS:
+            setattr(intents, name, True)
+        else:
+            raise ValueError(f"未知的 Discord intent: {name}")
+    return intents
+
+def _build_member_cache_flags(policy: str, intents: discord.Intents) -> discord.MemberCacheFlags:
+    if policy == "all":
+        return discord.MemberCacheFlags.from_intents(intents)
+    flags = discord.MemberCacheFlags.none()
+    flags.joined = policy == "joined"
+    return flags
+
+class DiscordBot(_BotBase):
     def __init__(self, websocket_manager: WebSocketManager):
-        # Discord Bot 設定
-        intents = discord.Intents.default()
-        intents.message_content = True
-        intents.guilds = True
-        intents.guild_messages = True
-        intents.guild_reactions = True
-        intents.members = True
+        # Discord Bot 設定：intents 與成員 / 訊息快取依 DISCORD_CACHE_POLICY 決定
+        intents = _build_intents(DISCORD_INTENTS)
+        
+        options = {}
+        if DISCORD_SHARDING == "auto":
+            options = {"shard_count": DISCORD_SHARD_COUNT or None, "shard_ids": DISCORD_SHARD_IDS}
+        
+        # 追蹤 REST 回應的限流標頭，供發送任務避開已知會被限流的頻道
+        rate_limits = RateLimitTracker()
         
-        super().__init__(command_prefix="!", intents=intents)
-        self.is_ready_flag = False
+        super().__init__(
+            command_prefix="!",
+            intents=intents,
+            member_cache_flags=_build_member_cache_flags(DISCORD_MEMBER_CACHE, intents),
+            chunk_guilds_at_startup=DISCORD_CHUNK_GUILDS,
+            max_messages=DISCORD_MAX_MESSAGES or None,
+            http_trace=rate_limits.trace_config(),
+            max_ratelimit_timeout=SENDER_MAX_RATELIMIT_WAIT,
+            **options
+        )
+        self.rate_limits = rate_limits
+        self.sharded = DISCORD_SHARDING == "auto"
+        # 各分片是否已連線就緒；未分片時只有分片 0
+        self.shard_ready: Dict[int, bool] = {}
+        self._shard_listeners: List[Callable[[int, bool], None]] = []
         self.websocket_manager = websocket_manager
-
+        self.snapshot = GuildSnapshot()
+        # 發送時解析頻道：Gateway 快取沒有時改以 API 取得
+        self.channels = ChannelResolver(self)
+        # 大量反應 / 成員加入離開時合併為摘要訊框（EVENT_AGGREGATION）
+        self.events = EventAggregator(self.broadcast_websocket)
+        # 從建立到第一次 on_ready 的秒數（含成員 chunk）
+        self.time_to_ready: Optional[float] = None
+        self._created_at = time.monotonic()
+        # 上次計算的快取物件數與計算時間（/metrics 每次抓取不重新走訪所有伺服器）
+        self._cache_counts: Optional[Dict[str, int]] = None
+        self._cache_counts_at = 0.0
+    
     async def setup_hook(self):
         # 手動把命令註冊進來
         self.add_command(ping_command)
@@ -30,41 +96,189 @@ class DiscordBot(commands.Bot):
         self.add_command(channels_command)
         logger.info("Discord Bot 設定完成，已註冊命令：ping / status / servers / channels")
     
+    @property
+    def is_ready_flag(self) -> bool:
+        """至少一個分片已就緒"""
+        return any(self.shard_ready.values())
+    
+    @property
+    def all_shards_ready(self) -> bool:
+        """本程序負責的分片全部就緒"""
+        if not self.sharded:
+            return self.shard_ready.get(0, False)
+        expected = self.shard_ids or range(self.shard_count or 0)
+        return self.is_ready_flag and all(self.shard_ready.get(shard_id, False) for shard_id in expected)
+    
+    def is_shard_ready(self, shard_id: Optional[int]) -> bool:
+        """shard_id 為 None（無法判斷所屬分片）時需所有分片就緒，頻道快取才完整"""
+        if shard_id is None:
+            return self.all_shards_ready
+        return self.shard_ready.get(shard_id, False)
+    
+    def shard_for_channel(self, channel_id: int) -> Optional[int]:
+        """取得頻道所屬伺服器的分片；頻道不在快取或為私訊時回傳 None"""
+        guild = getattr(self.get_channel(channel_id), "guild", None)
+        return guild.shard_id if guild else None
+    
+    def add_shard_listener(self, listener: Callable[[int, bool], None]):
+        """註冊分片就緒狀態變更的 callback(shard_id, ready)"""
+        self._shard_listeners.append(listener)
+    
+    def shard_status(self) -> List[dict]:
+        """各分片的就緒狀態、Gateway 延遲與伺服器數"""
+        latencies = dict(self.latencies) if self.sharded else {0: self.latency}
+        guild_counts = Counter(guild.shard_id for guild in self.guilds)
+        return [
+            {
+                "shard_id": shard_id,
+                "ready": self.shard_ready.get(shard_id, False),
+                "latency": latencies[shard_id] if math.isfinite(latencies.get(shard_id, math.nan)) else None,
+                "guild_count": guild_counts.get(shard_id, 0),
+            }
+            for shard_id in sorted(set(self.shard_ready) | set(latencies) | set(getattr(self, "shard_ids", None) or ()))
+        ]
+    
+    def memory_report(self) -> dict:
+        """目前的快取策略與 discord.py 各快取的物件數"""
+        return {
+            "policy": {
+                "preset": DISCORD_CACHE_POLICY,
+                "intents": sorted(name for name, enabled in self.intents if enabled),
+                "member_cache": DISCORD_MEMBER_CACHE,
+                "chunk_guilds_at_startup": DISCORD_CHUNK_GUILDS,
+                "max_messages": DISCORD_MAX_MESSAGES,
+            },
+            "time_to_ready": self.time_to_ready,
+            "caches": self.cache_counts(),
+        }
+    
+    def cache_counts(self, max_age: float = 0) -> Dict[str, int]:
+        """discord.py 各快取的物件數；距上次計算未超過 max_age 秒時沿用上次的結果"""
+        now = time.monotonic()
+        if self._cache_counts is None or now - self._cache_counts_at >= max_age:
+            self._cache_counts = self._count_caches()
+            self._cache_counts_at = now
+        return self._cache_counts
+    
+    def _count_caches(self) -> Dict[str, int]:
+        guilds = self.guilds
+        return {
+            "guilds": len(guilds),
+            "channels": sum(len(guild.channels) for guild in guilds),
+            "threads": sum(len(guild.threads) for guild in guilds),
+            "roles": sum(len(guild.roles) for guild in guilds),
+            "members": sum(len(guild.members) for guild in guilds),
+            "users": len(self.users),
+            "emojis": len(self.emojis),
+            "stickers": len(self.stickers),
+            "messages": len(self.cached_messages),
+            "private_channels": len(self.private_channels),
+            "voice_states": sum(
+                len(channel.voice_states)
+                for guild in guilds
+                for channel in guild.channels
+                if isinstance(channel, (discord.VoiceChannel, discord.StageChannel))
+            ),
+        }
+    
+    def _set_shard_ready(self, shard_id: int, ready: bool):
+        if self.shard_ready.get(shard_id) == ready:
+            return
+        self.shard_ready[shard_id] = ready
+        for listener in self._shard_listeners:
+            listener(shard_id, ready)
+    
+    async def close(self):
+        # 送出合併中的事件後再斷線
+        await self.events.close()
+        await super().close()
+    
     async def on_ready(self):
-        self.is_ready_flag = True
+        if self.time_to_ready is None:
+            self.time_to_ready = time.monotonic() - self._created_at
+        if not self.sharded:
+            self._set_shard_ready(0, True)
+        self.snapshot.rebuild(self.guilds)
         logger.info(f"Discord Bot 已登入: {self.user}")
         await self.broadcast_status("Bot 已準備就緒")
     
+    async def on_resumed(self):
+        if not self.sharded:
+            self._set_shard_ready(0, True)
+    
     async def on_disconnect(self):
-        self.is_ready_flag = False
+        # 分片模式下由 on_shard_disconnect 處理
+        if self.sharded:
+            return
+        self._set_shard_ready(0, False)
         logger.warning("Discord Bot 已斷線")
         await self.broadcast_status("Bot 已斷線")
     
+    async def on_shard_ready(self, shard_id: int):
+        self._set_shard_ready(shard_id, True)
+        logger.info(f"分片 {shard_id} 已準備就緒")
+        await self.broadcast_status(f"分片 {shard_id} 已準備就緒")
+    
+    async def on_shard_resumed(self, shard_id: int):
+        self._set_shard_ready(shard_id, True)
+        logger.info(f"分片 {shard_id} 已恢復連線")
+    
+    async def on_shard_disconnect(self, shard_id: int):
+        self._set_shard_ready(shard_id, False)
+        logger.warning(f"分片 {shard_id} 已斷線")
+        await self.broadcast_status(f"分片 {shard_id} 已斷線")
+    
     async def on_guild_join(self, guild):
         """Bot 加入新伺服器時"""
+        self.snapshot.upsert_guild(guild)
         logger.info(f"Bot 已加入新伺服器: {guild.name} (ID: {guild.id})")
-        await self.broadcast_status(f"Bot 已加入伺服器: {guild.name}")
+        await self.broadcast_status(f"Bot 已加入伺服器: {guild.name}", guild_id=guild.id)
     
     async def on_guild_remove(self, guild):
         """Bot 離開伺服器時"""
+        self.snapshot.remove_guild(guild.id)
         logger.info(f"Bot 已離開伺服器: {guild.name} (ID: {guild.id})")
-        await self.broadcast_status(f"Bot 已離開伺服器: {guild.name}")
+        await self.broadcast_status(f"Bot 已離開伺服器: {guild.name}", guild_id=guild.id)
     
     async def on_guild_update(self, before, after):
         """伺服器資訊更新時"""
+        self.snapshot.update_guild_info(after)
         if before.name != after.name:
             logger.info(f"伺服器名稱已更新: {before.name} -> {after.name}")
-            await self.broadcast_status(f"伺服器名稱已更新: {before.name} -> {after.name}")
+            await self.broadcast_status(f"伺服器名稱已更新: {before.name} -> {after.name}", guild_id=after.id)
+    
+    async def on_guild_available(self, guild):
+        """伺服器在 on_ready 之後才變為可用時（大型 Bot 的延遲載入）"""
+        if self.is_ready_flag:
+            self.snapshot.upsert_guild(guild)
     
     async def on_member_join(self, member):
         """新成員加入伺服器時"""
+        self.snapshot.update_guild_info(member.guild)
         logger.info(f"新成員加入: {member.name} 在伺服器 {member.guild.name}")
-        await self.broadcast_status(f"新成員 {member.name} 已加入伺服器 {member.guild.name}")
+        await self._broadcast_member(member.guild, member.name, "join", f"新成員 {member.name} 已加入伺服器 {member.guild.name}")
     
-    async def on_member_remove(self, member):
-        """成員離開伺服器時"""
-        logger.info(f"成員離開: {member.name} 從伺服器 {member.guild.name}")
-        await self.broadcast_status(f"成員 {member.name} 已離開伺服器 {member.guild.name}")
+    async def on_raw_member_remove(self, payload):
+        """成員離開伺服器時（raw 事件不需要成員快取）"""
+        guild = self.get_guild(payload.guild_id)
+        if guild is None:
+            return
+        self.snapshot.update_guild_info(guild)
+        logger.info(f"成員離開: {payload.user.name} 從伺服器 {guild.name}")
+        await self._broadcast_member(guild, payload.user.name, "leave", f"成員 {payload.user.name} 已離開伺服器 {guild.name}")
+    
+    async def _broadcast_member(self, guild, name: str, action: str, message: str):
+        """廣播成員加入 / 離開；啟用合併時同一伺服器的連續事件合併為 member_summary"""
+        data = self._status_frame(message, guild_id=guild.id)
+        if not self.events.enabled("member"):
+            await self.websocket_manager.broadcast(data)
+            return
+        self.events.add("member", (guild.id, action), data, {
+            "type": "member_summary",
+            "action": action,
+            "guild": guild.name,
+            "guild_id": guild.id,
+        }, user=name)
     
     async def on_message(self, message):
         """收到訊息時"""
@@ -72,13 +286,18 @@ class DiscordBot(commands.Bot):
         if message.author == self.user:
             return
         
-        logger.info(f"收到訊息: {message.author.name}: {message.content} (在頻道 {message.channel.name})")
+        logger.info(
+            "收到訊息: %s (在頻道 %s，%d 字)", message.author.name, message.channel.name, len(message.content),
+            extra={"event": "message", "guild_id": message.guild.id if message.guild else None, "channel_id": message.channel.id},
+        )
         
         # 廣播訊息到 WebSocket
         await self.broadcast_websocket({
             "type": "message",
             "guild": message.guild.name if message.guild else "DM",
+            "guild_id": message.guild.id if message.guild else None,
             "channel": message.channel.name,
+            "channel_id": message.channel.id,
             "author": message.author.name,
             "content": message.content,
             "timestamp": datetime.now().isoformat()
@@ -87,51 +306,78 @@ class DiscordBot(commands.Bot):
         # 處理命令
         await self.process_commands(message)
     
-    async def on_reaction_add(self, reaction, user):
-        """收到反應時"""
-        if user == self.user:
+    async def on_raw_reaction_add(self, payload):
+        """收到反應時（raw 事件不需要訊息快取，較舊的訊息也會收到）"""
+        if payload.user_id == self.user.id:
             return
         
-        logger.info(f"收到反應: {user.name} 對訊息 {reaction.message.id} 添加了 {reaction.emoji}")
-        await self.broadcast_websocket({
+        guild = self.get_guild(payload.guild_id) if payload.guild_id else None
+        channel = self.get_channel(payload.channel_id)
+        user = payload.member or self.get_user(payload.user_id)
+        author = user.name if user else str(payload.user_id)
+        logger.info(
+            "收到反應: %s 對訊息 %s 添加了 %s", author, payload.message_id, payload.emoji,
+            extra={"event": "reaction", "guild_id": payload.guild_id, "channel_id": payload.channel_id},
+        )
+        data = {
             "type": "reaction",
-            "guild": reaction.message.guild.name if reaction.message.guild else "DM",
-            "channel": reaction.message.channel.name,
-            "author": user.name,
-            "emoji": str(reaction.emoji),
-            "message_id": reaction.message.id,
+            "guild": guild.name if guild else "DM",
+            "guild_id": payload.guild_id,
+            "channel": getattr(channel, "name", None),
+            "channel_id": payload.channel_id,
+            "author": author,
+            "emoji": str(payload.emoji),
+            "message_id": payload.message_id,
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        if not self.events.enabled("reaction"):
+            await self.broadcast_websocket(data)
+            return
+        # 同一訊息的同一表情在短時間內的反應合併為 reaction_summary
+        summary = {key: data[key] for key in ("guild", "guild_id", "channel", "channel_id", "emoji", "message_id")}
+        self.events.add("reaction", (payload.message_id, data["emoji"]), data, {"type": "reaction_summary", **summary}, user=author)
     
     async def on_guild_channel_create(self, channel):
         """新頻道創建時"""
+        self.snapshot.upsert_channel(channel)
         logger.info(f"新頻道已創建: {channel.name} 在伺服器 {channel.guild.name}")
-        await self.broadcast_status(f"新頻道 {channel.name} 已在伺服器 {channel.guild.name} 創建")
+        await self.broadcast_status(f"新頻道 {channel.name} 已在伺服器 {channel.guild.name} 創建", guild_id=channel.guild.id, channel_id=channel.id)
     
     async def on_guild_channel_delete(self, channel):
         """頻道刪除時"""
+        self.snapshot.remove_channel(channel)
+        self.channels.invalidate(channel.id)
         logger.info(f"頻道已刪除: {channel.name} 從伺服器 {channel.guild.name}")
-        await self.broadcast_status(f"頻道 {channel.name} 已從伺服器 {channel.guild.name} 刪除")
+        await self.broadcast_status(f"頻道 {channel.name} 已從伺服器 {channel.guild.name} 刪除", guild_id=channel.guild.id, channel_id=channel.id)
     
     async def on_guild_channel_update(self, before, after):
         """頻道更新時"""
+        self.snapshot.upsert_channel(after)
         if before.name != after.name:
             logger.info(f"頻道名稱已更新: {before.name} -> {after.name}")
-            await self.broadcast_status(f"頻道名稱已更新: {before.name} -> {after.name}")
+            await self.broadcast_status(f"頻道名稱已更新: {before.name} -> {after.name}", guild_id=after.guild.id, channel_id=after.id)
     
     async def on_member_update(self, before, after):
-        """成員資訊更新時"""
+        """成員資訊更新時（需要成員快取，DISCORD_MEMBER_CACHE=none 時不會觸發）"""
         if before.nick != after.nick:
             logger.info(f"成員暱稱已更新: {before.nick or before.name} -> {after.nick or after.name}")
-            await self.broadcast_status(f"成員暱稱已更新: {before.nick or before.name} -> {after.nick or after.name}")
+            await self.broadcast_status(f"成員暱稱已更新: {before.nick or before.name} -> {after.nick or after.name}", guild_id=after.guild.id)
     
-    async def broadcast_status(self, message: str):
-        """廣播狀態訊息到所有 WebSocket 連線"""
-        await self.websocket_manager.broadcast({
+    async def broadcast_status(self, message: str, guild_id: Optional[int] = None, channel_id: Optional[int] = None):
+        """廣播狀態訊息到所有 WebSocket 連線（附上 guild_id / channel_id 供訂閱過濾）"""
+        await self.websocket_manager.broadcast(self._status_frame(message, guild_id, channel_id))
+    
+    def _status_frame(self, message: str, guild_id: Optional[int] = None, channel_id: Optional[int] = None) -> dict:
+        data = {
             "type": "status",
             "message": message,
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        if guild_id is not None:
+            data["guild_id"] = guild_id
+        if channel_id is not None:
+            data["channel_id"] = channel_id
+        return data
     
     async def broadcast_websocket(self, data: dict):
         """廣播資料到所有 WebSocket 連線"""
@@ -0,0 +1,388 @@
+import asyncio
+import base64
+import fcntl
+import itertools
+import json
+import logging
+import os
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from .config import (
+    API_AUTH_TOKEN,
+    BROKER_SOCKET,
+    BROKER_LOCK_PATH,
+    BROKER_REQUEST_TIMEOUT,
+    BROKER_MAX_FRAME,
+    BROKER_WORKER_QUEUE_SIZE,
+)
+from .encoding import encode_json
+from .websocket_manager import WebSocketManager
+
+logger = logging.getLogger(__name__)
+
+# 多工作程序模式（uvicorn --workers N）：
+# - 取得檔案鎖的程序為 Gateway 擁有者，負責 Discord Bot、訊息佇列與發送任務，並在 Unix socket 上提供 broker
+# - 其他工作程序把 HTTP 請求轉送給擁有者處理，並從 broker 接收廣播事件推送給自己的 WebSocket 連線
+# 通訊協定為每行一個 JSON 訊框：
+#   工作程序 -> 擁有者  {"id": n, "op": "http", "method", "path", "query_string", "headers", "client", "body"}
+#   擁有者 -> 工作程序  {"id": n, "status", "headers", "body"} 或 {"op":"event","data":{...}}
+
+# 事件訊框的固定前綴；工作程序直接切出 data 部分轉送給 WebSocket 連線，不需重新序列化
+EVENT_PREFIX = b'{"op":"event","data":'
+
+# WebSocket send 訊框在擁有者程序中對應的 HTTP 路由
+SEND_MESSAGE_PATH = "/api/v1/send-message"
+
+# 工作程序自行處理、不轉送的 HTTP 路由（回報本程序的 WebSocket 連線狀態）
+HEALTH_PATH = "/api/v1/health"
+LOCAL_PATHS = frozenset({HEALTH_PATH, "/api/v1/websocket/connections"})
+
+class BrokerUnavailableError(Exception):
+    """無法連線到 Gateway 擁有者程序"""
+
+def acquire_owner_lock(path: str = BROKER_LOCK_PATH):
+    """嘗試成為 Gateway 擁有者；成功時回傳需保持開啟的鎖檔，否則回傳 None"""
+    handle = open(path, "a+")
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        handle.close()
+        return None
+    return handle
+
+def _frame(data: dict) -> bytes:
+    return (encode_json(data) + "\n").encode("utf-8")
+
+def _encode_headers(headers) -> list:
+    return [[key.decode("latin-1"), value.decode("latin-1")] for key, value in headers]
+
+def _decode_headers(headers) -> list:
+    return [(key.encode("latin-1"), value.encode("latin-1")) for key, value in headers]
+
+class WorkerConnection:
+    """擁有者端的單一工作程序連線，擁有自己的待送出佇列與寫入任務（每次寫入後等待 drain）"""
+    def __init__(self, writer: asyncio.StreamWriter, max_queue: int = BROKER_WORKER_QUEUE_SIZE):
+        self.writer = writer
+        self.max_queue = max_queue
+        self.closing = False
+        
+        self._queue: Deque[bytes] = deque()
+        self._has_data = asyncio.Event()
+        self.writer_task: Optional[asyncio.Task] = None
+    
+    def enqueue(self, line: bytes, force: bool = False) -> bool:
+        """加入待送出的訊框（不等待）；回傳 False 表示佇列已滿，此連線應被斷開
+        
+        force 用於轉送請求的回覆，數量受工作程序送出的請求數限制，不套用上限。
+        """
+        if self.closing:
+            return True
+        if not force and len(self._queue) >= self.max_queue:
+            return False
+        self._queue.append(line)
+        self._has_data.set()
+        return True
+    
+    def kick(self):
+        """中斷連線；停滯的 socket 不等待緩衝區送完，寫入任務中的 drain 隨即結束"""
+        self.closing = True
+        self._queue.clear()
+        self._has_data.set()
+        self.writer.transport.abort()
+    
+    async def run_writer(self):
+        """一次寫出目前累積的訊框並等待 drain，工作程序停滯時訊框留在有上限的佇列中"""
+        try:
+            while True:
+                while not self._queue and not self.closing:
+                    self._has_data.clear()
+                    await self._has_data.wait()
+                if self.closing:
+                    return
+                data = b"".join(self._queue)
+                self._queue.clear()
+                self.writer.write(data)
+                await self.writer.drain()
+        except ConnectionError as e:
+            if not self.closing:
+                logger.warning(f"寫入工作程序失敗: {e}")
+        finally:
+            # 關閉 socket 讓讀取迴圈結束並移除連線
+            self.writer.close()
+
+class BrokerServer:
+    """Gateway 擁有者端：執行工作程序轉送的 HTTP 請求，並把廣播事件推送給所有工作程序"""
+    def __init__(self, app, websocket_manager: WebSocketManager, path: str = BROKER_SOCKET, max_queue: int = BROKER_WORKER_QUEUE_SIZE):
+        self.app = app
+        self.websocket_manager = websocket_manager
+        self.path = path
+        self.max_queue = max_queue
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._workers: Set[WorkerConnection] = set()
+    
+    async def start(self):
+        # 已持有擁有者鎖，殘留的 socket 檔必定來自先前的程序
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, path=self.path, limit=BROKER_MAX_FRAME)
+        self.websocket_manager.add_listener(self.publish)
+        logger.info(f"Broker 已啟動: {self.path}")
+    
+    async def close(self):
+        if self._server:
+            self._server.close()
+            for worker in list(self._workers):
+                worker.kick()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+    
+    def publish(self, message: dict, json_frame: str):
+        """把已編碼的廣播事件轉送給所有工作程序"""
+        if not self._workers:
+            return
+        line = EVENT_PREFIX + json_frame.encode("utf-8") + b"}\n"
+        for worker in self._workers:
+            if not worker.enqueue(line):
+                # 不再累積給停滯的工作程序；工作程序重連後從最新事件繼續，客戶端可依 seq 缺口以 resume 補送
+                logger.warning(f"工作程序待送出事件超過 {self.max_queue} 則，已斷開")
+                worker.kick()
+    
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker = WorkerConnection(writer, self.max_queue)
+        worker.writer_task = asyncio.create_task(worker.run_writer())
+        self._workers.add(worker)
+        logger.info(f"工作程序已連線，目前 {len(self._workers)} 個")
+        tasks: Set[asyncio.Task] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                if frame.get("op") == "http":
+                    task = asyncio.create_task(self._handle_http(frame, worker))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.warning(f"工作程序連線中斷: {e}")
+        finally:
+            self._workers.discard(worker)
+            for task in tasks:
+                task.cancel()
+            worker.kick()
+            logger.info(f"工作程序已斷線，目前 {len(self._workers)} 個")
+    
+    async def _handle_http(self, frame: dict, worker: WorkerConnection):
+        status_code, headers, body = await self._call_app(frame)
+        worker.enqueue(_frame({
+            "id": frame["id"],
+            "status": status_code,
+            "headers": _encode_headers(headers),
+            "body": base64.b64encode(body).decode("ascii"),
+        }), force=True)
+    
+    async def _call_app(self, frame: dict) -> Tuple[int, list, bytes]:
+        """在本程序內以 ASGI 呼叫應用程式處理轉送的請求"""
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": frame["method"],
+            "scheme": "http",
+            "path": frame["path"],
+            "raw_path": frame["path"].encode("utf-8"),
+            "query_string": frame["query_string"].encode("latin-1"),
+            "root_path": "",
+            "headers": _decode_headers(frame["headers"]),
+            "client": tuple(frame["client"]) if frame.get("client") else None,
+            "server": None,
+        }
+        request_body = base64.b64decode(frame["body"])
+        response_done = asyncio.Event()
+        request_sent = False
+        response = {"status": 500, "headers": [], "body": []}
+        
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": request_body, "more_body": False}
+            await response_done.wait()
+            return {"type": "http.disconnect"}
+        
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+                if not message.get("more_body"):
+                    response_done.set()
+        
+        try:
+            await self.app(scope, receive, send)
+        except Exception as e:
+            logger.error(f"處理轉送請求失敗: {e}")
+        finally:
+            response_done.set()
+        return response["status"], response["headers"], b"".join(response["body"])
+
+class BrokerClient:
+    """工作程序端：轉送 HTTP 請求給 Gateway 擁有者，並接收廣播事件"""
+    def __init__(self, websocket_manager: WebSocketManager, path: str = BROKER_SOCKET, timeout: float = BROKER_REQUEST_TIMEOUT):
+        self.websocket_manager = websocket_manager
+        self.path = path
+        self.timeout = timeout
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+    
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def request(self, frame: dict) -> dict:
+        """送出請求並等待擁有者回覆"""
+        if not self._writer:
+            raise BrokerUnavailableError("尚未連線到 Gateway 擁有者程序")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(_frame({**frame, "id": request_id}))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+    
+    async def forward_message(self, message: dict, idempotency_key: Optional[str] = None) -> Tuple[int, dict]:
+        """將本程序 WebSocket 連線的 send 訊框以 /send-message 請求轉送給擁有者（連線已在本程序認證）"""
+        headers = [(b"content-type", b"application/json")]
+        if API_AUTH_TOKEN:
+            headers.append((b"authorization", f"Bearer {API_AUTH_TOKEN}".encode("latin-1")))
+        if idempotency_key:
+            headers.append((b"idempotency-key", idempotency_key.encode("latin-1")))
+        try:
+            reply = await self._request_local("POST", SEND_MESSAGE_PATH, headers, encode_json(message).encode("utf-8"))
+        except (BrokerUnavailableError, asyncio.TimeoutError) as e:
+            return 503, {"detail": f"Gateway 擁有者程序無回應: {e}"}
+        
+        body = json.loads(base64.b64decode(reply["body"]) or b"{}")
+        reply_headers = {key.lower(): value for key, value in reply["headers"]}
+        if "retry-after" in reply_headers:
+            body["retry_after"] = int(reply_headers["retry-after"])
+        if reply["status"] < 300:
+            body["replayed"] = reply_headers.get("idempotent-replayed") == "true"
+        return reply["status"], body
+    
+    async def get_json(self, path: str) -> dict:
+        """以 GET 向擁有者取得 JSON 回應（不需認證的路由）"""
+        reply = await self._request_local("GET", path, [], b"")
+        return json.loads(base64.b64decode(reply["body"]) or b"{}")
+    
+    async def _request_local(self, method: str, path: str, headers: list, body: bytes) -> dict:
+        return await self.request({
+            "op": "http",
+            "method": method,
+            "path": path,
+            "query_string": "",
+            "headers": _encode_headers(headers),
+            "client": None,
+            "body": base64.b64encode(body).decode("ascii"),
+        })
+    
+    async def _run(self):
+        """維持與擁有者的連線，斷線後自動重連"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=BROKER_MAX_FRAME)
+            except (FileNotFoundError, ConnectionError):
+                await asyncio.sleep(1)
+                continue
+            
+            self._writer = writer
+            logger.info(f"已連線到 Gateway 擁有者程序: {self.path}")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self._dispatch(line)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                logger.warning(f"與 Gateway 擁有者程序的連線中斷: {e}")
+            finally:
+                self._writer = None
+                writer.close()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(BrokerUnavailableError("與 Gateway 擁有者程序的連線中斷"))
+            await asyncio.sleep(1)
+    
+    def _dispatch(self, line: bytes):
+        if line.startswith(EVENT_PREFIX):
+            json_frame = line[len(EVENT_PREFIX):].rstrip()[:-1].decode("utf-8")
+            self.websocket_manager.publish(json.loads(json_frame), json_frame)
+            return
+        frame = json.loads(line)
+        future = self._pending.get(frame.get("id"))
+        if future and not future.done():
+            future.set_result(frame)
+
+class BrokerForwardMiddleware:
+    """工作程序模式下把 HTTP 請求轉送給 Gateway 擁有者處理；WebSocket 連線與 LOCAL_PATHS 仍由本程序處理"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        client: Optional[BrokerClient] = None
+        if scope["type"] == "http" and scope["path"] not in LOCAL_PATHS:
+            client = getattr(scope["app"].state, "broker_client", None)
+        if client is None:
+            await self.app(scope, receive, send)
+            return
+        
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        
+        try:
+            reply = await client.request({
+                "op": "http",
+                "method": scope["method"],
+                "path": scope["path"],
+                "query_string": scope.get("query_string", b"").decode("latin-1"),
+                "headers": _encode_headers(scope["headers"]),
+                "client": list(scope["client"]) if scope.get("client") else None,
+                "body": base64.b64encode(body).decode("ascii"),
+            })
+            status_code = reply["status"]
+            headers = _decode_headers(reply["headers"])
+            response_body = base64.b64decode(reply["body"])
+        except (BrokerUnavailableError, asyncio.TimeoutError) as e:
+            status_code = 503 if isinstance(e, BrokerUnavailableError) else 504
+            response_body = encode_json({"detail": f"Gateway 擁有者程序無回應: {e}"}).encode("utf-8")
+            headers = [(b"content-type", b"application/json"), (b"content-length", str(len(response_body)).encode())]
+        
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": response_body})
@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterator, Optional, Tuple
+
+_MISSING = object()
+
+class TTLCache:
+    """有容量上限的 LRU 快取，每個項目在到期時間（time.time()）後失效
+    
+    超過 maxsize 時淘汰最久未使用的項目；過期項目在讀取時移除。
+    到期時間使用牆上時間，因此可以連同到期時間一起持久化後重新載入。
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING, count=False) is not _MISSING
+    
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._data.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return entry[1]
+            del self._data[key]
+        if count:
+            self.misses += 1
+        return default
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, expires_at: Optional[float] = None) -> float:
+        """加入或更新項目，回傳到期時間"""
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        return expires_at
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else default
+    
+    def clear(self):
+        self._data.clear()
+    
+    def items(self) -> Iterator[Tuple[Hashable, Any, float]]:
+        """未過期的 (key, value, 到期時間)"""
+        now = time.time()
+        for key, (expires_at, value) in list(self._data.items()):
+            if expires_at > now:
+                yield key, value, expires_at
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,102 @@
+import asyncio
+from typing import Dict, Optional
+
+import discord
+
+from .config import CHANNEL_CACHE_SIZE, CHANNEL_CACHE_TTL, CHANNEL_NEGATIVE_TTL, CHANNEL_FORBIDDEN_TTL
+from .cache import TTLCache
+from . import metrics
+
+class ChannelResolver:
+    """頻道 ID -> 可發送的頻道物件
+    
+    依序查詢 Gateway 快取、以 API 取得過的頻道（LRU + TTL）與不存在的頻道 ID（TTL），
+    都沒有時才呼叫 fetch_channel；同一個頻道同時有多個查詢時共用同一次 API 呼叫。
+    API 回應 404 的頻道在 negative_ttl 秒內直接判定不存在，403（Bot 看不到的頻道）在 forbidden_ttl 秒內判定無法發送，
+    錯誤的頻道 ID 被大量送入時不會每則訊息各呼叫一次 API。
+    """
+    def __init__(
+        self,
+        bot: discord.Client,
+        maxsize: int = CHANNEL_CACHE_SIZE,
+        ttl: float = CHANNEL_CACHE_TTL,
+        negative_ttl: float = CHANNEL_NEGATIVE_TTL,
+        forbidden_ttl: float = CHANNEL_FORBIDDEN_TTL,
+    ):
+        self.bot = bot
+        self._fetched = TTLCache(maxsize, ttl)
+        self._missing = TTLCache(maxsize, negative_ttl)
+        self.forbidden_ttl = forbidden_ttl
+        self._inflight: Dict[int, asyncio.Task] = {}
+        # 各來源的解析次數：gateway / cache / coalesced / fetch 為找到，negative / not_found / forbidden 為不存在或無權限
+        self.counts: Dict[str, int] = dict.fromkeys(("gateway", "cache", "coalesced", "fetch", "negative", "not_found", "forbidden"), 0)
+    
+    async def resolve(self, channel_id: int) -> Optional[discord.abc.Messageable]:
+        """取得頻道，不存在或無權限存取時回傳 None（其他 API 錯誤照常拋出）"""
+        channel = self.bot.get_channel(channel_id)
+        if channel is not None:
+            self._count("gateway")
+            return channel
+        
+        channel = self._fetched.get(channel_id, count=False)
+        if channel is not None:
+            self._count("cache")
+            return channel
+        if self._missing.get(channel_id, count=False) is not None:
+            self._count("negative")
+            return None
+        
+        task = self._inflight.get(channel_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(channel_id))
+            self._inflight[channel_id] = task
+            task.add_done_callback(lambda done: self._fetch_done(channel_id, done))
+        else:
+            self._count("coalesced")
+        # 個別呼叫端被取消時不取消共用的 API 呼叫
+        return await asyncio.shield(task)
+    
+    def invalidate(self, channel_id: int):
+        """頻道已刪除或發送時回應 Unknown Channel：移除快取並記錄為不存在"""
+        self._fetched.pop(channel_id)
+        self._missing.set(channel_id, True)
+    
+    def stats(self) -> dict:
+        lookups = sum(self.counts.values())
+        # 不需要呼叫 API 的比例（fetch / not_found / forbidden 為實際的 API 呼叫）
+        hits = lookups - self.counts["fetch"] - self.counts["not_found"] - self.counts["forbidden"]
+        return {
+            "lookups": lookups,
+            "hit_rate": round(hits / lookups, 4) if lookups else None,
+            "sources": dict(self.counts),
+            "fetched": len(self._fetched),
+            "missing": len(self._missing),
+            "inflight": len(self._inflight),
+        }
+    
+    async def _fetch(self, channel_id: int) -> Optional[discord.abc.Messageable]:
+        try:
+            channel = await self.bot.fetch_channel(channel_id)
+        except discord.NotFound:
+            self._missing.set(channel_id, True)
+            self._count("not_found")
+            return None
+        except discord.Forbidden:
+            # 權限可能之後才被授予，保留時間較短
+            self._missing.set(channel_id, True, ttl=self.forbidden_ttl)
+            self._count("forbidden")
+            return None
+        self._fetched.set(channel_id, channel)
+        self._count("fetch")
+        return channel
+    
+    def _count(self, source: str):
+        self.counts[source] += 1
+        metrics.CHANNEL_RESOLVE_TOTAL.inc(source=source)
+    
+    def _fetch_done(self, channel_id: int, task: asyncio.Task):
+        if self._inflight.get(channel_id) is task:
+            del self._inflight[channel_id]
+        # 所有呼叫端都已取消時避免「exception was never retrieved」
+        if not task.cancelled():
+            task.exception()
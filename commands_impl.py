@@ -40,10 +40,15 @@ async def channels_command(ctx: commands.Context):
         await ctx.send("此命令只能在伺服器中使用")
         return
     embed = discord.Embed(title=f"📺 {ctx.guild.name} 的頻道", color=0x0099ff)
-    text_channels = [ch for ch in ctx.guild.channels if isinstance(ch, discord.TextChannel)]
-    voice_channels = [ch for ch in ctx.guild.channels if isinstance(ch, discord.VoiceChannel)]
-    embed.add_field(name="文字頻道", value="\n".join([f"#{ch.name}" for ch in text_channels[:10]]) or "（無）", inline=True)
-    embed.add_field(name="語音頻道", value="\n".join([f"🔊 {ch.name}" for ch in voice_channels[:10]]) or "（無）", inline=True)
+    # 使用 Bot 維護的頻道快照，不必每次走訪所有頻道
+    groups = ctx.bot.snapshot.get_channel_groups(ctx.guild.id)
+    if groups is None:
+        ctx.bot.snapshot.upsert_guild(ctx.guild)
+        groups = ctx.bot.snapshot.get_channel_groups(ctx.guild.id)
+    text_channels = groups["text"]
+    voice_channels = groups["voice"]
+    embed.add_field(name="文字頻道", value="\n".join([f"#{name}" for name in text_channels[:10]]) or "（無）", inline=True)
+    embed.add_field(name="語音頻道", value="\n".join([f"🔊 {name}" for name in voice_channels[:10]]) or "（無）", inline=True)
     if len(text_channels) > 10 or len(voice_channels) > 10:
         embed.set_footer(text="只顯示前 10 個頻道")
     await ctx.send(embed=embed)
\ No newline at end of file
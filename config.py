@@ -7,12 +7,150 @@ load_dotenv()
 # Discord Bot 配置
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DISCORD_CHANNEL_ID = int(os.getenv("DISCORD_CHANNEL_ID", "0"))
+# 長期有效的令牌：只能放在 Authorization 標頭或 WebSocket 的 auth 訊框，不要放進 URL（例如 ?token=），
+# 否則會以明文留在 uvicorn 存取日誌、代理伺服器日誌與瀏覽器歷史紀錄中
 API_AUTH_TOKEN = os.getenv("API_AUTH_TOKEN")
 
+# 分片配置
+def _parse_shard_ids(value: str):
+    """解析 "0,1,4-7" 格式的分片 ID；空字串表示由 Bot 自行決定"""
+    if not value.strip():
+        return None
+    shard_ids = []
+    for part in value.split(","):
+        start, _, end = part.strip().partition("-")
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(shard_ids))
+
+DISCORD_SHARDING = os.getenv("DISCORD_SHARDING", "off")  # off / auto（使用 AutoShardedBot）
+DISCORD_SHARD_COUNT = int(os.getenv("DISCORD_SHARD_COUNT", "0"))  # 總分片數，0 表示由 Discord 建議
+DISCORD_SHARD_IDS = _parse_shard_ids(os.getenv("DISCORD_SHARD_IDS", ""))  # 本程序負責的分片，例如 0-3
+
+# 快取策略配置
+# API 只用到伺服器 / 頻道資訊與 member_count；大型伺服器可改用 lean / minimal 以減少常駐記憶體與啟動時間
+CACHE_POLICY_PRESETS = {
+    # 完整成員清單（啟動時 chunk）與訊息快取
+    "full": {"intents": ("default", "members", "message_content"), "member_cache": "all", "chunk_guilds": True, "max_messages": 1000},
+    # 保留成員加入 / 離開事件與 member_count，不快取成員與訊息
+    "lean": {
+        "intents": ("guilds", "guild_messages", "guild_reactions", "dm_messages", "dm_reactions", "members", "message_content"),
+        "member_cache": "none", "chunk_guilds": False, "max_messages": 0,
+    },
+    # 不訂閱成員事件（member_count 只在伺服器資料更新時變動）
+    "minimal": {
+        "intents": ("guilds", "guild_messages", "guild_reactions", "dm_messages", "dm_reactions", "message_content"),
+        "member_cache": "none", "chunk_guilds": False, "max_messages": 0,
+    },
+}
+
+DISCORD_CACHE_POLICY = os.getenv("DISCORD_CACHE_POLICY", "full")  # full / lean / minimal，以下設定未指定時使用此預設組合
+_cache_preset = CACHE_POLICY_PRESETS.get(DISCORD_CACHE_POLICY, CACHE_POLICY_PRESETS["full"])
+
+def _cache_setting(name: str, convert):
+    value = os.getenv(f"DISCORD_{name.upper()}", "").strip()
+    return convert(value) if value else _cache_preset[name]
+
+DISCORD_INTENTS = _cache_setting("intents", lambda value: tuple(part.strip() for part in value.split(",") if part.strip()))  # discord.Intents 旗標名稱，default 表示 Intents.default()
+DISCORD_MEMBER_CACHE = _cache_setting("member_cache", str.lower)  # all / joined / none
+DISCORD_CHUNK_GUILDS = _cache_setting("chunk_guilds", lambda value: value.lower() == "true")  # 啟動時下載完整成員清單
+DISCORD_MAX_MESSAGES = _cache_setting("max_messages", int)  # 訊息快取數量，0 表示停用
+
 # 伺服器配置
 HOST = "0.0.0.0"
 PORT = int(os.getenv("PORT", "8000"))
 
+# 訊息發送配置
+SENDER_CONCURRENCY = int(os.getenv("SENDER_CONCURRENCY", "8"))  # 同時發送的頻道數上限
+SENDER_COALESCE = os.getenv("SENDER_COALESCE", "false").lower() == "true"  # 合併同頻道連續訊息
+SENDER_COALESCE_WINDOW = float(os.getenv("SENDER_COALESCE_WINDOW", "0.05"))  # 合併等待時間（秒）
+SENDER_MAX_RATELIMIT_WAIT = float(os.getenv("SENDER_MAX_RATELIMIT_WAIT", "30"))  # discord.py 內部等待限流的上限（秒，最小 30），超過時改由發送任務暫緩
+SEND_BATCH_MAX_SIZE = int(os.getenv("SEND_BATCH_MAX_SIZE", "100"))  # 批次發送 API 單次最多訊息數
+
+# 頻道解析配置（Gateway 快取沒有的頻道改以 API 取得）
+CHANNEL_CACHE_SIZE = int(os.getenv("CHANNEL_CACHE_SIZE", "10000"))  # 以 API 取得的頻道最多保留數（LRU 淘汰）
+CHANNEL_CACHE_TTL = float(os.getenv("CHANNEL_CACHE_TTL", "3600"))  # 以 API 取得的頻道保留秒數
+CHANNEL_NEGATIVE_TTL = float(os.getenv("CHANNEL_NEGATIVE_TTL", "60"))  # 不存在的頻道 ID 直接判定失敗的秒數
+CHANNEL_FORBIDDEN_TTL = float(os.getenv("CHANNEL_FORBIDDEN_TTL", "30"))  # 無權限存取（403）的頻道 ID 直接判定失敗的秒數
+
+# 訊息優先等級配置
+def _parse_priority_weights(value: str):
+    """解析 "high=8,normal=4,low=1" 格式的各優先等級權重，未指定的等級使用預設值"""
+    weights = {"high": 8, "normal": 4, "low": 1}
+    for part in value.split(","):
+        if part.strip():
+            priority, _, weight = part.partition("=")
+            weights[priority.strip()] = int(weight)
+    return weights
+
+SENDER_PRIORITY_WEIGHTS = _parse_priority_weights(os.getenv("SENDER_PRIORITY_WEIGHTS", ""))  # 各優先等級同時有待發送訊息時的發送比例
+
+# 訊息佇列配置
+MESSAGE_QUEUE_MAXSIZE = int(os.getenv("MESSAGE_QUEUE_MAXSIZE", "10000"))  # 0 表示不限制
+MESSAGE_QUEUE_OVERFLOW = os.getenv("MESSAGE_QUEUE_OVERFLOW", "reject")  # reject / block / drop_oldest
+MESSAGE_QUEUE_BLOCK_TIMEOUT = float(os.getenv("MESSAGE_QUEUE_BLOCK_TIMEOUT", "5"))  # block 模式最長等待秒數
+MESSAGE_QUEUE_RETRY_AFTER = int(os.getenv("MESSAGE_QUEUE_RETRY_AFTER", "1"))  # 佇列已滿時建議的重試秒數
+
+# Idempotency-Key 配置
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))  # 紀錄保留秒數
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))  # 記憶體中最多保留的 key 數（LRU 淘汰）
+
+# 投遞票證配置
+TICKET_TTL = float(os.getenv("TICKET_TTL", "3600"))  # 發送結果保留秒數
+TICKET_MAX_ENTRIES = int(os.getenv("TICKET_MAX_ENTRIES", "100000"))  # 最多保留的票證數（LRU 淘汰）
+SEND_WAIT_TIMEOUT = float(os.getenv("SEND_WAIT_TIMEOUT", "10"))  # wait=true 時最長等待發送結果的秒數
+
+# 排程發送配置
+SCHEDULER_MAX_PENDING = int(os.getenv("SCHEDULER_MAX_PENDING", "1000000"))  # 尚未到期的排程訊息上限
+SCHEDULER_MAX_DELAY = float(os.getenv("SCHEDULER_MAX_DELAY", "2592000"))  # send_at / delay_seconds 最遠可排程的秒數（預設 30 天）
+
+# WebSocket 配置
+WS_CLIENT_QUEUE_SIZE = int(os.getenv("WS_CLIENT_QUEUE_SIZE", "256"))  # 每個連線待送出訊息上限
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")  # disconnect / drop_oldest / coalesce
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))  # 單次送出逾時秒數，逾時視為停滯並斷線
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "1000"))  # 保留供重連補送的事件數
+WS_REPLAY_BUFFER_BYTES = int(os.getenv("WS_REPLAY_BUFFER_BYTES", "1048576"))  # 補送緩衝區記憶體上限（以 JSON 大小估算）
+
+# 事件合併配置（大量反應 / 成員加入離開時合併為摘要訊框）
+EVENT_AGGREGATION = tuple(part.strip() for part in os.getenv("EVENT_AGGREGATION", "").split(",") if part.strip())  # 要合併的事件：reaction / member，未指定時不合併
+EVENT_AGGREGATION_WINDOW = float(os.getenv("EVENT_AGGREGATION_WINDOW", "1"))  # 同一訊息與表情（或伺服器）超過此秒數沒有新事件時送出摘要
+EVENT_AGGREGATION_MAX_DELAY = float(os.getenv("EVENT_AGGREGATION_MAX_DELAY", "5"))  # 第一個事件最多延遲此秒數就送出摘要
+EVENT_AGGREGATION_SAMPLE_SIZE = int(os.getenv("EVENT_AGGREGATION_SAMPLE_SIZE", "10"))  # 摘要中附帶的使用者名稱數
+
+# 多工作程序配置
+BROKER_MODE = os.getenv("BROKER_MODE", "off")  # off / auto（uvicorn --workers 時由一個程序持有 Gateway 連線）
+BROKER_SOCKET = os.getenv("BROKER_SOCKET", "/tmp/discord_bot_api.sock")  # 程序間通訊的 Unix socket
+BROKER_LOCK_PATH = os.getenv("BROKER_LOCK_PATH", BROKER_SOCKET + ".lock")  # 選出 Gateway 擁有者的檔案鎖
+BROKER_REQUEST_TIMEOUT = float(os.getenv("BROKER_REQUEST_TIMEOUT", "30"))  # 轉送請求逾時秒數
+BROKER_MAX_FRAME = int(os.getenv("BROKER_MAX_FRAME", str(64 * 1024 * 1024)))  # 單一訊框大小上限（bytes）
+BROKER_WORKER_QUEUE_SIZE = int(os.getenv("BROKER_WORKER_QUEUE_SIZE", "10000"))  # 每個工作程序待送出的事件數上限，超過時斷開該工作程序
+
+# 日誌配置
+def _parse_sample_rates(value: str):
+    """解析 "message=0.1,reaction=0.5" 格式的各事件類型取樣比例"""
+    rates = {}
+    for part in value.split(","):
+        if part.strip():
+            event, _, rate = part.partition("=")
+            rates[event.strip()] = float(rate)
+    return rates
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text / json
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 待寫出日誌上限，已滿時丟棄新日誌
+LOG_SAMPLE_RATES = _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))  # 各事件類型的取樣比例，例如 message=0.1
+LOG_EVENT_RATE_LIMIT = int(os.getenv("LOG_EVENT_RATE_LIMIT", "20"))  # 每種事件類型每秒最多輸出筆數，0 表示不限制
+
+# 監控配置
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))  # 事件迴圈延遲量測間隔（秒），0 表示停用
+METRICS_CACHE_COUNT_TTL = float(os.getenv("METRICS_CACHE_COUNT_TTL", "60"))  # /metrics 的快取物件數沿用上次計算結果的秒數（計算需走訪所有伺服器）
+
+# 持久化佇列配置
+OUTBOUND_QUEUE_BACKEND = os.getenv("OUTBOUND_QUEUE_BACKEND", "memory")  # memory / sqlite
+OUTBOUND_QUEUE_PATH = os.getenv("OUTBOUND_QUEUE_PATH", "outbound_queue.db")
+OUTBOUND_QUEUE_FLUSH_INTERVAL = float(os.getenv("OUTBOUND_QUEUE_FLUSH_INTERVAL", "0.05"))  # 批次提交間隔（秒）
+OUTBOUND_QUEUE_FLUSH_BATCH = int(os.getenv("OUTBOUND_QUEUE_FLUSH_BATCH", "500"))  # 累積多少筆立即提交
+OUTBOUND_QUEUE_SYNCHRONOUS = os.getenv("OUTBOUND_QUEUE_SYNCHRONOUS", "NORMAL").upper()  # NORMAL / FULL
+
 # 驗證配置
 def validate_config():
     """驗證必要的環境變數"""
@@ -20,5 +158,68 @@ def validate_config():
         raise ValueError("DISCORD_TOKEN 環境變數必須設定")
     if not DISCORD_CHANNEL_ID:
         raise ValueError("DISCORD_CHANNEL_ID 環境變數必須設定")
+    if DISCORD_SHARDING not in ("off", "auto"):
+        raise ValueError("DISCORD_SHARDING 必須是 off 或 auto")
+    if DISCORD_SHARD_IDS is not None:
+        if DISCORD_SHARDING != "auto":
+            raise ValueError("指定 DISCORD_SHARD_IDS 時 DISCORD_SHARDING 必須是 auto")
+        if not DISCORD_SHARD_COUNT:
+            raise ValueError("指定 DISCORD_SHARD_IDS 時必須設定 DISCORD_SHARD_COUNT")
+        if DISCORD_SHARD_IDS[0] < 0 or DISCORD_SHARD_IDS[-1] >= DISCORD_SHARD_COUNT:
+            raise ValueError("DISCORD_SHARD_IDS 必須介於 0 與 DISCORD_SHARD_COUNT - 1 之間")
+    if DISCORD_CACHE_POLICY not in CACHE_POLICY_PRESETS:
+        raise ValueError("DISCORD_CACHE_POLICY 必須是 full、lean 或 minimal")
+    if DISCORD_MEMBER_CACHE not in ("all", "joined", "none"):
+        raise ValueError("DISCORD_MEMBER_CACHE 必須是 all、joined 或 none")
+    if (DISCORD_CHUNK_GUILDS or DISCORD_MEMBER_CACHE != "none") and "members" not in DISCORD_INTENTS:
+        raise ValueError("DISCORD_CHUNK_GUILDS 或快取成員時 DISCORD_INTENTS 必須包含 members")
+    if DISCORD_MAX_MESSAGES < 0:
+        raise ValueError("DISCORD_MAX_MESSAGES 不可小於 0")
+    if SENDER_CONCURRENCY < 1:
+        raise ValueError("SENDER_CONCURRENCY 必須大於 0")
+    if CHANNEL_CACHE_SIZE < 1:
+        raise ValueError("CHANNEL_CACHE_SIZE 必須大於 0")
+    if CHANNEL_CACHE_TTL <= 0 or CHANNEL_NEGATIVE_TTL <= 0 or CHANNEL_FORBIDDEN_TTL <= 0:
+        raise ValueError("CHANNEL_CACHE_TTL、CHANNEL_NEGATIVE_TTL 與 CHANNEL_FORBIDDEN_TTL 必須大於 0")
+    if SENDER_MAX_RATELIMIT_WAIT < 30:
+        raise ValueError("SENDER_MAX_RATELIMIT_WAIT 不可小於 30（discord.py 的下限）")
+    if set(SENDER_PRIORITY_WEIGHTS) != {"high", "normal", "low"}:
+        raise ValueError("SENDER_PRIORITY_WEIGHTS 只能設定 high、normal、low")
+    if any(weight < 1 for weight in SENDER_PRIORITY_WEIGHTS.values()):
+        raise ValueError("SENDER_PRIORITY_WEIGHTS 的權重必須大於 0")
+    if MESSAGE_QUEUE_OVERFLOW not in ("reject", "block", "drop_oldest"):
+        raise ValueError("MESSAGE_QUEUE_OVERFLOW 必須是 reject、block 或 drop_oldest")
+    if IDEMPOTENCY_MAX_KEYS < 1:
+        raise ValueError("IDEMPOTENCY_MAX_KEYS 必須大於 0")
+    if TICKET_MAX_ENTRIES < 1:
+        raise ValueError("TICKET_MAX_ENTRIES 必須大於 0")
+    if SEND_WAIT_TIMEOUT <= 0:
+        raise ValueError("SEND_WAIT_TIMEOUT 必須大於 0")
+    if SCHEDULER_MAX_PENDING < 1:
+        raise ValueError("SCHEDULER_MAX_PENDING 必須大於 0")
+    if SCHEDULER_MAX_DELAY <= 0:
+        raise ValueError("SCHEDULER_MAX_DELAY 必須大於 0")
+    if WS_SLOW_CONSUMER_POLICY not in ("disconnect", "drop_oldest", "coalesce"):
+        raise ValueError("WS_SLOW_CONSUMER_POLICY 必須是 disconnect、drop_oldest 或 coalesce")
+    if not set(EVENT_AGGREGATION) <= {"reaction", "member"}:
+        raise ValueError("EVENT_AGGREGATION 只能包含 reaction、member")
+    if EVENT_AGGREGATION_WINDOW <= 0:
+        raise ValueError("EVENT_AGGREGATION_WINDOW 必須大於 0")
+    if EVENT_AGGREGATION_MAX_DELAY < EVENT_AGGREGATION_WINDOW:
+        raise ValueError("EVENT_AGGREGATION_MAX_DELAY 不可小於 EVENT_AGGREGATION_WINDOW")
+    if EVENT_AGGREGATION_SAMPLE_SIZE < 0:
+        raise ValueError("EVENT_AGGREGATION_SAMPLE_SIZE 不可小於 0")
+    if LOG_FORMAT not in ("text", "json"):
+        raise ValueError("LOG_FORMAT 必須是 text 或 json")
+    if any(not 0 <= rate <= 1 for rate in LOG_SAMPLE_RATES.values()):
+        raise ValueError("LOG_SAMPLE_RATES 的取樣比例必須介於 0 與 1 之間")
+    if BROKER_MODE not in ("off", "auto"):
+        raise ValueError("BROKER_MODE 必須是 off 或 auto")
+    if BROKER_WORKER_QUEUE_SIZE < 1:
+        raise ValueError("BROKER_WORKER_QUEUE_SIZE 必須大於 0")
+    if OUTBOUND_QUEUE_BACKEND not in ("memory", "sqlite"):
+        raise ValueError("OUTBOUND_QUEUE_BACKEND 必須是 memory 或 sqlite")
+    if OUTBOUND_QUEUE_SYNCHRONOUS not in ("NORMAL", "FULL"):
+        raise ValueError("OUTBOUND_QUEUE_SYNCHRONOUS 必須是 NORMAL 或 FULL")
     
     return True
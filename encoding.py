@@ -0,0 +1,33 @@
+import json
+from typing import Any
+
+# 可選的加速套件，未安裝時退回標準函式庫
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def available_encodings() -> tuple:
+    """目前可用的 WebSocket 編碼"""
+    return ("json", "msgpack") if msgpack else ("json",)
+
+def encode_json(data: Any) -> str:
+    """序列化為 JSON 字串（有安裝 orjson 時使用 orjson）"""
+    if orjson:
+        return orjson.dumps(data, default=str).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+
+def encode_msgpack(data: Any) -> bytes:
+    """序列化為 MessagePack（需安裝 msgpack）"""
+    return msgpack.packb(data, use_bin_type=True, default=str)
+
+def encode(data: Any, encoding: str):
+    """依編碼名稱序列化：json 回傳 str（文字訊框），msgpack 回傳 bytes（二進位訊框）"""
+    if encoding == "msgpack":
+        return encode_msgpack(data)
+    return encode_json(data)
@@ -0,0 +1,65 @@
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from .config import IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_KEYS
+from .cache import TTLCache
+from .queue_store import SQLiteQueueStore
+
+logger = logging.getLogger(__name__)
+
+def fingerprint(body: str) -> str:
+    """請求內容的摘要，用來檢查同一個 key 是否被用於不同內容"""
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+class IdempotencyCache:
+    """Idempotency-Key -> 第一次請求的回應
+    
+    同一個 key 的並行請求以鎖序列化，後到的請求直接取得第一次的結果。
+    若提供 store（持久化佇列），紀錄會一併寫入 SQLite，重啟後重新載入。
+    """
+    def __init__(self, store: Optional[SQLiteQueueStore] = None, maxsize: int = IDEMPOTENCY_MAX_KEYS, ttl: float = IDEMPOTENCY_TTL):
+        self.store = store
+        self._cache = TTLCache(maxsize, ttl)
+        # key -> [鎖, 使用中的請求數]
+        self._locks: Dict[str, list] = {}
+    
+    async def open(self):
+        """從持久化後端載入未過期的紀錄"""
+        if not self.store:
+            return
+        records = await self.store.load_idempotency()
+        for key, record, expires_at in records:
+            self._cache.set(key, record, expires_at=expires_at)
+        if records:
+            logger.info(f"已載入 {len(self._cache)} 筆 Idempotency-Key 紀錄")
+    
+    @asynccontextmanager
+    async def lock(self, key: str):
+        """序列化同一個 key 的請求，避免重試與原請求同時加入佇列"""
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+    
+    def get(self, key: str) -> Optional[dict]:
+        """回傳 {"fingerprint": ..., "response": ...}，沒有紀錄時回傳 None"""
+        return self._cache.get(key)
+    
+    def set(self, key: str, request_fingerprint: str, response: dict):
+        record = {"fingerprint": request_fingerprint, "response": response}
+        expires_at = self._cache.set(key, record)
+        if self.store:
+            self.store.save_idempotency(key, record, expires_at)
+    
+    def stats(self) -> dict:
+        return self._cache.stats()
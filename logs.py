@@ -0,0 +1,123 @@
+import atexit
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from .config import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES, LOG_EVENT_RATE_LIMIT
+from .encoding import encode_json
+from . import metrics
+
+# LogRecord 的內建屬性；其餘屬性視為 extra 欄位輸出到 JSON
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+
+class NonBlockingQueueHandler(QueueHandler):
+    """只把 LogRecord 放入佇列，格式化交給背景執行緒；佇列已滿時丟棄而不阻塞事件迴圈"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 預設實作會在呼叫端格式化訊息，這裡保留原始 record，由 listener 端的 Formatter 處理
+        return record
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_DROPPED.inc()
+
+class EventSampler(logging.Filter):
+    """依 record 的 event 欄位（logger.info(..., extra={"event": "message"})）取樣與限流
+    
+    - rates：各事件類型的取樣比例（0–1），未列出的類型全部保留
+    - rate_limit：每種事件類型每秒最多輸出筆數，0 表示不限制
+    被略過的筆數會附在該類型下一筆輸出的 record.suppressed 上。
+    沒有 event 欄位的日誌一律保留。
+    """
+    def __init__(self, rates: Dict[str, float], rate_limit: int = 0):
+        super().__init__()
+        self.rates = rates
+        self.rate_limit = rate_limit
+        # 事件類型 -> [目前秒數, 本秒已輸出筆數]
+        self._windows: Dict[str, list] = {}
+        self._suppressed: Dict[str, int] = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None)
+        if event is None:
+            return True
+        
+        rate = self.rates.get(event, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return self._suppress(event)
+        
+        if self.rate_limit:
+            second = int(time.monotonic())
+            window = self._windows.get(event)
+            if window is None or window[0] != second:
+                window = self._windows[event] = [second, 0]
+            if window[1] >= self.rate_limit:
+                return self._suppress(event)
+            window[1] += 1
+        
+        suppressed = self._suppressed.pop(event, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+    
+    def _suppress(self, event: str) -> bool:
+        self._suppressed[event] = self._suppressed.get(event, 0) + 1
+        metrics.LOG_SUPPRESSED.inc(event=event)
+        return False
+
+class TextFormatter(logging.Formatter):
+    """與 logging.basicConfig 相同的格式，另外標示略過的筆數"""
+    def __init__(self):
+        super().__init__(logging.BASIC_FORMAT)
+    
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" （另略過 {suppressed} 筆同類日誌）"
+        return text
+
+class JSONFormatter(logging.Formatter):
+    """每筆日誌一行 JSON，包含 extra 欄位（event、guild_id、channel_id 等）"""
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                data[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return encode_json(data)
+
+def setup_logging():
+    """以佇列 + 背景執行緒輸出日誌，取代 logging.basicConfig（重複呼叫不會重複設定）"""
+    global _listener
+    if _listener is not None:
+        return
+    
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(EventSampler(LOG_SAMPLE_RATES, LOG_EVENT_RATE_LIMIT))
+    
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # 程序結束時寫出佇列中剩餘的日誌
+    atexit.register(_listener.stop)
@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .config import METRICS_LOOP_LAG_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# 延遲類直方圖的預設分界（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(labelnames: Sequence[str], values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+class Registry:
+    """收集所有指標並輸出 Prometheus 文字格式"""
+    def __init__(self):
+        self._metrics: List["_Metric"] = []
+    
+    def register(self, metric: "_Metric"):
+        self._metrics.append(metric)
+    
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class _Metric:
+    kind = "untyped"
+    
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+    
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+    
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = "counter"
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+    
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+class Gauge(_Metric):
+    """數值型指標；可設定 callback 於輸出時才讀取目前值"""
+    kind = "gauge"
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], object]] = None
+    
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+    
+    def set_function(self, function: Callable[[], object]):
+        """function 回傳數值，或在有標籤時回傳 {標籤值 tuple: 數值}"""
+        self._function = function
+    
+    def samples(self) -> List[str]:
+        values = dict(self._values)
+        if self._function:
+            try:
+                result = self._function()
+            except Exception as e:
+                logger.debug(f"指標 {self.name} 讀取失敗: {e}")
+                result = None
+            if isinstance(result, dict):
+                values.update(result)
+            elif result is not None:
+                values[()] = result
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(float(value))}"
+            for key, value in values.items()
+        ]
+
+class Histogram(_Metric):
+    kind = "histogram"
+    
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # 每組標籤：[各分界的計數（非累積，最後一格為 +Inf）, 總和, 次數]
+        self._values: Dict[LabelValues, list] = {}
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+def render() -> str:
+    return REGISTRY.render()
+
+def rss_bytes() -> int:
+    """目前程序的常駐記憶體（Linux /proc）；無法讀取時回傳 0"""
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+# 訊息佇列
+QUEUE_DEPTH = Gauge("discord_api_queue_depth", "尚未被發送端取出的訊息數")
+QUEUE_PENDING = Gauge("discord_api_queue_pending", "尚未確認的訊息數（佇列中 + 發送中）")
+QUEUE_CAPACITY = Gauge("discord_api_queue_capacity", "訊息佇列容量，0 表示不限制")
+QUEUE_REJECTED = Counter("discord_api_queue_rejected_total", "因佇列已滿被拒絕的訊息數")
+QUEUE_DROPPED = Counter("discord_api_queue_dropped_total", "因 drop_oldest 策略被丟棄的訊息數")
+QUEUE_PRIORITY_PENDING = Gauge("discord_api_queue_priority_pending", "各優先等級尚未確認的訊息數", ("priority",))
+
+# 訊息發送
+SEND_QUEUE_LATENCY = Histogram("discord_api_send_queue_latency_seconds", "訊息從加入佇列到發送完成的時間", ("priority",))
+SEND_DURATION = Histogram("discord_api_send_duration_seconds", "Discord REST 發送呼叫耗時")
+SEND_TOTAL = Counter("discord_api_send_total", "訊息發送結果", ("channel_id", "outcome", "error"))
+SEND_DEFERRED = Counter("discord_api_send_deferred_total", "因頻道限流而暫緩發送的次數")
+SEND_PARKED = Gauge("discord_api_send_parked", "所屬分片未就緒而暫停發送的訊息數", ("shard",))
+SEND_OUTAGE_BACKLOG = Gauge("discord_api_send_outage_backlog", "因 Gateway 未就緒而等待發送的訊息數")
+SEND_LAST_OUTAGE_SECONDS = Gauge("discord_api_send_last_outage_seconds", "最近一次 Gateway 中斷的持續秒數")
+CHANNEL_RESOLVE_TOTAL = Counter(
+    "discord_api_channel_resolve_total",
+    "頻道解析來源（gateway / cache / coalesced / fetch 為命中，negative / not_found / forbidden 為不存在或無權限）",
+    ("source",),
+)
+SEND_LAST_OUTAGE_BACKLOG = Gauge("discord_api_send_last_outage_backlog", "最近一次 Gateway 恢復時累積的待發送訊息數")
+
+# 排程發送
+SCHEDULED_PENDING = Gauge("discord_api_scheduled_pending", "尚未到期的排程訊息數")
+SCHEDULED_TOTAL = Counter("discord_api_scheduled_total", "排程訊息的結果（released / cancelled / rejected）", ("outcome",))
+SCHEDULED_LATENESS = Histogram(
+    "discord_api_scheduled_lateness_seconds",
+    "排程訊息放入發送佇列時超過預定時間的秒數",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 60.0),
+)
+
+# Discord 限流
+RATELIMIT_HITS = Counter("discord_api_ratelimit_hits_total", "Discord 回應 429 的次數", ("scope",))
+RATELIMIT_UTILIZATION = Gauge("discord_api_ratelimit_utilization", "各 bucket 目前視窗內的使用率（已用 / 上限）", ("bucket", "major_id"))
+
+# WebSocket 廣播
+WS_CONNECTIONS = Gauge("discord_api_ws_connections", "目前的 WebSocket 連線數")
+WS_BROADCAST_DURATION = Histogram(
+    "discord_api_ws_broadcast_duration_seconds",
+    "單次廣播分派（序列化 + 放入各連線佇列）耗時",
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+WS_BROADCAST_RECIPIENTS = Histogram(
+    "discord_api_ws_broadcast_recipients",
+    "單次廣播的接收連線數",
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000),
+)
+WS_DROPPED_CLIENTS = Counter("discord_api_ws_dropped_clients_total", "因跟不上或停滯被斷開的連線數")
+WS_SEND_TOTAL = Counter("discord_api_ws_send_total", "經由 WebSocket send 訊框送出的訊息數", ("outcome",))
+EVENTS_AGGREGATED = Counter("discord_api_events_aggregated_total", "因合併為摘要訊框而未逐一廣播的事件數", ("kind",))
+WS_DROPPED_FRAMES = Counter("discord_api_ws_dropped_frames_total", "因連線佇列已滿被丟棄或合併的訊框數")
+
+# 日誌
+LOG_SUPPRESSED = Counter("discord_api_log_suppressed_total", "因取樣或限流略過的日誌數", ("event",))
+LOG_DROPPED = Counter("discord_api_log_dropped_total", "因日誌佇列已滿被丟棄的日誌數")
+
+# Discord Gateway 與事件迴圈
+GATEWAY_LATENCY = Gauge("discord_api_gateway_latency_seconds", "各分片的 Discord Gateway 心跳延遲", ("shard",))
+SHARD_READY = Gauge("discord_api_shard_ready", "分片是否已連線就緒（1 / 0）", ("shard",))
+LOOP_LAG = Histogram(
+    "discord_api_event_loop_lag_seconds",
+    "事件迴圈延遲（排程喚醒時間與實際喚醒時間的差）",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+RESIDENT_MEMORY = Gauge("discord_api_resident_memory_bytes", "程序的常駐記憶體")
+CACHE_OBJECTS = Gauge("discord_api_cache_objects", "discord.py 各快取的物件數", ("cache",))
+TIME_TO_READY = Gauge("discord_api_time_to_ready_seconds", "Bot 從建立到第一次就緒的秒數")
+LOOP_LAG_LAST = Gauge("discord_api_event_loop_lag_last_seconds", "最近一次量測的事件迴圈延遲")
+
+class LoopLagMonitor:
+    """定期量測事件迴圈延遲：預期 interval 秒後喚醒，實際多等的時間即為延遲"""
+    def __init__(self, interval: float = METRICS_LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - started - self.interval, 0.0)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
@@ -1,18 +1,50 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Literal
 from datetime import datetime
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 class MessagePayload(BaseModel):
     content: str = Field(..., description="訊息內容")
     channel_id: Optional[int] = Field(None, description="Discord 頻道 ID，不指定則使用預設頻道")
     embed: Optional[Dict[str, Any]] = Field(None, description="Embed 物件")
+    priority: Literal["high", "normal", "low"] = Field("normal", description="優先等級，各等級依 SENDER_PRIORITY_WEIGHTS 的比例輪流發送")
+    idempotency_key: Optional[str] = Field(None, max_length=255, description="冪等鍵，重試時帶相同的值不會重複發送（也可使用 Idempotency-Key 標頭）")
+    send_at: Optional[datetime] = Field(None, description="排程發送時間（ISO 8601，未帶時區時視為伺服器本地時間），已過去的時間立即發送")
+    delay_seconds: Optional[float] = Field(None, ge=0, description="延遲發送的秒數，不可與 send_at 同時指定")
+    
+    @model_validator(mode="after")
+    def _check_schedule(self):
+        if self.send_at is not None and self.delay_seconds is not None:
+            raise ValueError("send_at 與 delay_seconds 不可同時指定")
+        return self
 
 class MessageResponse(BaseModel):
     success: bool
+    ticket: Optional[str] = Field(None, description="投遞票證，可用 GET /messages/{ticket} 查詢發送結果")
+    status: Optional[Literal["scheduled", "queued", "sent", "failed", "cancelled"]] = None
+    send_at: Optional[datetime] = None
     message_id: Optional[int] = None
     error: Optional[str] = None
     timestamp: datetime
 
+class BatchMessageResponse(BaseModel):
+    success: bool
+    accepted: int
+    replayed: int = Field(0, description="以 idempotency_key 判定為重試、未重複加入佇列的訊息數")
+    tickets: List[str] = Field(default_factory=list, description="各訊息的投遞票證（與請求順序相同）")
+    error: Optional[str] = None
+    timestamp: datetime
+
+class TicketStatus(BaseModel):
+    ticket: str
+    status: Literal["scheduled", "queued", "sent", "failed", "cancelled"]
+    channel_id: Optional[int] = None
+    priority: Optional[str] = None
+    send_at: Optional[datetime] = None
+    message_id: Optional[int] = None
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+
 class WebSocketMessage(BaseModel):
     type: str
     message: str
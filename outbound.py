@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from .config import (
+    MESSAGE_QUEUE_MAXSIZE,
+    MESSAGE_QUEUE_OVERFLOW,
+    MESSAGE_QUEUE_BLOCK_TIMEOUT,
+    MESSAGE_QUEUE_RETRY_AFTER,
+)
+from .queue_store import SQLiteQueueStore
+from .priority import PRIORITIES, message_priority
+from .tickets import DeliveryTickets
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    """佇列已滿，呼叫端應於 retry_after 秒後重試"""
+    def __init__(self, message: str, retry_after: int, timed_out: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.timed_out = timed_out
+
+class OutboundQueue:
+    """有容量上限的待發送訊息佇列
+    
+    容量以「尚未確認」的訊息數計算：訊息被 get 取出後仍佔用容量，
+    直到發送端呼叫 task_done 為止，因此發送端內部緩衝的訊息也受上限約束。
+    drop_oldest 策略透過 set_evictor 由發送端一併丟棄其緩衝中尚未發送的訊息，
+    被丟棄訊息的投遞票證標記為失敗。
+    若提供 store，尚未確認的訊息會持久化，並於 open 時重新載入；
+    其中尚未到期的排程訊息不放入佇列，改由 take_deferred 交回排程器。
+    """
+    def __init__(
+        self,
+        maxsize: int = MESSAGE_QUEUE_MAXSIZE,
+        overflow: str = MESSAGE_QUEUE_OVERFLOW,
+        block_timeout: float = MESSAGE_QUEUE_BLOCK_TIMEOUT,
+        retry_after: int = MESSAGE_QUEUE_RETRY_AFTER,
+        store: Optional[SQLiteQueueStore] = None,
+        tickets: Optional[DeliveryTickets] = None,
+    ):
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.retry_after = retry_after
+        self.store = store
+        self.tickets = tickets
+        self.dropped_count = 0
+        self.rejected_count = 0
+        
+        self._items: Deque[dict] = deque()
+        self._deferred: List[dict] = []
+        self._unfinished = 0
+        # 各優先等級尚未確認的訊息數
+        self._pending_by_priority: Dict[str, int] = dict.fromkeys(PRIORITIES, 0)
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        # 發送端已取出、尚未發送的訊息數與丟棄方法（由最舊的開始丟棄）
+        self._dispatched_count: Optional[Callable[[], int]] = None
+        self._evict_dispatched: Optional[Callable[[int], List[dict]]] = None
+    
+    def set_evictor(self, count: Callable[[], int], evict: Callable[[int], List[dict]]):
+        """設定發送端緩衝的訊息數與丟棄方法，供 drop_oldest 在佇列已被取空時仍能騰出空間"""
+        self._dispatched_count = count
+        self._evict_dispatched = evict
+    
+    async def open(self):
+        """開啟持久化後端，並將上次未確認的訊息重新放入佇列"""
+        if not self.store:
+            return
+        items = await self.store.open()
+        now = time.time()
+        self._deferred = [item for item in items if item.get("send_at", 0) > now]
+        items = [item for item in items if item.get("send_at", 0) <= now]
+        for item in items:
+            self._items.append(item)
+            self._unfinished += 1
+            self._pending_by_priority[message_priority(item)] += 1
+        if items:
+            self._not_empty.set()
+            logger.info(f"已從持久化佇列重新載入 {len(items)} 則訊息")
+    
+    def take_deferred(self) -> List[dict]:
+        """取出 open 時載入、尚未到期的排程訊息"""
+        deferred, self._deferred = self._deferred, []
+        return deferred
+    
+    async def close(self):
+        """寫入持久化後端剩餘的變更"""
+        if self.store:
+            await self.store.close()
+    
+    def full(self, count: int = 1) -> bool:
+        """加入 count 則訊息是否會超過容量"""
+        return self.maxsize > 0 and self._unfinished + count > self.maxsize
+    
+    def qsize(self) -> int:
+        """尚未被取出的訊息數"""
+        return len(self._items)
+    
+    def pending_count(self) -> int:
+        """尚未確認的訊息數（佇列中 + 發送中）"""
+        return self._unfinished
+    
+    def pending_by_priority(self) -> Dict[str, int]:
+        """各優先等級尚未確認的訊息數"""
+        return dict(self._pending_by_priority)
+    
+    def remaining(self) -> int:
+        """剩餘容量，-1 表示不限制"""
+        if self.maxsize <= 0:
+            return -1
+        return max(self.maxsize - self._unfinished, 0)
+    
+    async def put(self, item: dict):
+        """加入訊息，佇列已滿時依溢出策略處理"""
+        if self.full():
+            if self.overflow == "block":
+                await self._wait_not_full()
+            else:
+                self._make_room()
+        self._append(item)
+    
+    async def put_many(self, items: List[dict]):
+        """一次加入多則訊息；容量不足時整批依溢出策略處理，不會只加入一部分"""
+        if self.full(len(items)):
+            if self.overflow == "block":
+                await self._wait_not_full(len(items))
+            else:
+                self._make_room(len(items))
+        for item in items:
+            self._append(item)
+    
+    def put_nowait(self, item: dict):
+        """加入訊息，佇列已滿時不等待（block 策略視同 reject）"""
+        if self.full():
+            self._make_room()
+        self._append(item)
+    
+    async def get(self) -> dict:
+        """取出下一則訊息，佇列為空時等待"""
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._items.popleft()
+    
+    def task_done(self, item: dict = None):
+        """確認訊息已處理完畢並釋放容量"""
+        if self._unfinished <= 0:
+            raise ValueError("task_done() 呼叫次數多於佇列中的訊息數")
+        self._unfinished -= 1
+        self._not_full.set()
+        if item is not None:
+            self._release(item)
+    
+    def stats(self) -> dict:
+        """取得佇列狀態"""
+        return {
+            "depth": self.qsize(),
+            "pending": self.pending_count(),
+            "pending_by_priority": self.pending_by_priority(),
+            "capacity": self.maxsize,
+            "remaining": self.remaining(),
+            "overflow": self.overflow,
+            "dropped": self.dropped_count,
+            "rejected": self.rejected_count,
+            "backend": "sqlite" if self.store else "memory",
+        }
+    
+    def _append(self, item: dict):
+        # 記錄加入時間（持久化後重啟仍保留），供計算佇列等待時間
+        item.setdefault("enqueued_at", time.time())
+        if self.store:
+            self.store.append(item)
+        self._items.append(item)
+        self._unfinished += 1
+        self._pending_by_priority[message_priority(item)] += 1
+        self._not_empty.set()
+    
+    def _release(self, item: dict):
+        self._pending_by_priority[message_priority(item)] -= 1
+        if self.store:
+            self.store.ack(item)
+    
+    def _make_room(self, count: int = 1):
+        """drop_oldest 策略丟棄最舊的尚未發送訊息，否則拒絕"""
+        needed = self._unfinished + count - self.maxsize
+        dispatched = self._dispatched_count() if self._dispatched_count else 0
+        if self.overflow == "drop_oldest" and len(self._items) + dispatched >= needed:
+            # 發送端緩衝的訊息比佇列中的訊息早加入，先從發送端丟棄
+            dropped = self._evict_dispatched(min(needed, dispatched)) if dispatched else []
+            while len(dropped) < needed:
+                dropped.append(self._items.popleft())
+            for item in dropped:
+                self._unfinished -= 1
+                self._release(item)
+                if self.tickets and "ticket" in item:
+                    self.tickets.drop(item["ticket"], item.get("channel_id"))
+            self.dropped_count += needed
+            metrics.QUEUE_DROPPED.inc(needed)
+            logger.warning(f"訊息佇列已滿，已丟棄最舊的 {needed} 則訊息（累計 {self.dropped_count} 則）")
+            return
+        self.rejected_count += count
+        metrics.QUEUE_REJECTED.inc(count)
+        raise QueueFullError("訊息佇列已滿", self.retry_after)
+    
+    async def _wait_not_full(self, count: int = 1):
+        """等待佇列出現足夠空位，逾時則拒絕"""
+        if count > self.maxsize:
+            self.rejected_count += count
+            metrics.QUEUE_REJECTED.inc(count)
+            raise QueueFullError("訊息數超過佇列容量", self.retry_after)
+        
+        async def wait():
+            while self.full(count):
+                self._not_full.clear()
+                await self._not_full.wait()
+        
+        try:
+            await asyncio.wait_for(wait(), timeout=self.block_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_count += count
+            metrics.QUEUE_REJECTED.inc(count)
+            raise QueueFullError("訊息佇列已滿，等待逾時", self.retry_after, timed_out=True)
@@ -0,0 +1,112 @@
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, Optional, Tuple
+
+from .config import SENDER_PRIORITY_WEIGHTS
+
+# 優先等級（由高到低）
+PRIORITIES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+def message_priority(message_data: dict) -> str:
+    """佇列中的訊息的優先等級（舊資料沒有此欄位時視為 normal）"""
+    return message_data.get("priority") or DEFAULT_PRIORITY
+
+class WeightedFairQueue:
+    """各優先等級各一個 FIFO，以 stride scheduling 依權重輪流取出
+    
+    每個等級有一個 pass 值，取出時選 pass 最小的非空等級，並將其 pass 加上 1 / 權重。
+    權重 8 : 4 : 1 表示三個等級都有資料時，約每 13 次取出中 high 8 次、normal 4 次、low 1 次，
+    低優先等級不會被餓死。等級由空變為非空時，pass 至少為目前的虛擬時間，不會累積閒置期間的額度。
+    """
+    def __init__(self, weights: Dict[str, int] = SENDER_PRIORITY_WEIGHTS):
+        self.weights = weights
+        self._queues: Dict[str, Deque[Any]] = {priority: deque() for priority in PRIORITIES}
+        self._pass: Dict[str, float] = {priority: 0.0 for priority in PRIORITIES}
+        self._virtual_time = 0.0
+        self._size = 0
+    
+    def __len__(self) -> int:
+        return self._size
+    
+    def __bool__(self) -> bool:
+        return self._size > 0
+    
+    def queue(self, priority: str) -> Deque[Any]:
+        """取得某個等級的 FIFO（供同等級合併時直接讀取）；修改後需呼叫 recount()"""
+        return self._queues[priority]
+    
+    def recount(self):
+        self._size = sum(len(queue) for queue in self._queues.values())
+    
+    def append(self, priority: str, item: Any):
+        queue = self._queues[priority]
+        if not queue:
+            self._pass[priority] = max(self._pass[priority], self._virtual_time)
+        queue.append(item)
+        self._size += 1
+    
+    def appendleft(self, priority: str, item: Any):
+        """放回最前面（發送失敗重送時維持原順序）"""
+        queue = self._queues[priority]
+        if not queue:
+            self._pass[priority] = max(self._pass[priority], self._virtual_time)
+        queue.appendleft(item)
+        self._size += 1
+    
+    def next_priority(self) -> Optional[str]:
+        """下一次 popleft 會取出的等級"""
+        best = None
+        for priority in PRIORITIES:
+            if self._queues[priority] and (best is None or self._pass[priority] < self._pass[best]):
+                best = priority
+        return best
+    
+    def popleft(self) -> Tuple[str, Any]:
+        priority = self.next_priority()
+        if priority is None:
+            raise IndexError("pop from an empty WeightedFairQueue")
+        self._virtual_time = self._pass[priority]
+        self._pass[priority] += 1 / self.weights.get(priority, 1)
+        self._size -= 1
+        return priority, self._queues[priority].popleft()
+    
+    def lengths(self) -> Dict[str, int]:
+        return {priority: len(queue) for priority, queue in self._queues.items()}
+
+class ReadyQueue:
+    """依優先等級排程的就緒頻道佇列，worker 以 get() 等待
+    
+    頻道以其頻道佇列下一則訊息的等級排入；同一頻道在等待期間被提升等級時，
+    會在較高等級再排入一次，原本的項目在取出時略過。
+    """
+    def __init__(self, weights: Dict[str, int] = SENDER_PRIORITY_WEIGHTS):
+        self._queue = WeightedFairQueue(weights)
+        self._queued: Dict[Hashable, str] = {}
+        self._available = asyncio.Semaphore(0)
+    
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._queued
+    
+    def qsize(self) -> int:
+        return len(self._queued)
+    
+    def put_nowait(self, priority: str, key: Hashable):
+        current = self._queued.get(key)
+        if current is not None and PRIORITIES.index(current) <= PRIORITIES.index(priority):
+            return
+        self._queued[key] = priority
+        self._queue.append(priority, key)
+        self._available.release()
+    
+    def discard(self, key: Hashable):
+        """移出佇列；已排入的項目在取出時略過"""
+        self._queued.pop(key, None)
+    
+    async def get(self) -> Hashable:
+        while True:
+            await self._available.acquire()
+            priority, key = self._queue.popleft()
+            if self._queued.get(key) == priority:
+                del self._queued[key]
+                return key
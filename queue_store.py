@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .config import (
+    OUTBOUND_QUEUE_PATH,
+    OUTBOUND_QUEUE_FLUSH_INTERVAL,
+    OUTBOUND_QUEUE_FLUSH_BATCH,
+    OUTBOUND_QUEUE_SYNCHRONOUS,
+)
+
+logger = logging.getLogger(__name__)
+
+class SQLiteQueueStore:
+    """以 SQLite（WAL 模式）保存尚未確認的訊息
+    
+    append / ack 只寫入記憶體緩衝，由背景任務每隔 flush_interval 秒
+    （或累積 flush_batch 筆）在執行緒中以單一交易批次提交，
+    因此加入佇列的路徑不會等待磁碟 I/O，也不會每則訊息各 fsync 一次。
+    程序異常結束時最多遺失最後一個提交間隔內的變更。
+    同一個資料庫也保存 Idempotency-Key 紀錄（idempotency 資料表）。
+    """
+    def __init__(
+        self,
+        path: str = OUTBOUND_QUEUE_PATH,
+        flush_interval: float = OUTBOUND_QUEUE_FLUSH_INTERVAL,
+        flush_batch: int = OUTBOUND_QUEUE_FLUSH_BATCH,
+        synchronous: str = OUTBOUND_QUEUE_SYNCHRONOUS,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.synchronous = synchronous
+        
+        self._conn: Optional[sqlite3.Connection] = None
+        self._next_seq = 1
+        # 尚未寫入磁碟的新增（依 seq 排序）與刪除
+        self._inserts: Dict[int, str] = {}
+        self._deletes: List[int] = []
+        # 尚未寫入磁碟的 Idempotency-Key 紀錄：key -> (JSON, 到期時間)
+        self._idempotency: Dict[str, Tuple[str, float]] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+    
+    async def open(self) -> List[dict]:
+        """開啟資料庫並回傳上次未確認的訊息（依加入順序）"""
+        items = await asyncio.to_thread(self._open)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"持久化佇列已開啟: {self.path}，待重送訊息 {len(items)} 則")
+        return items
+    
+    async def close(self):
+        """停止背景提交並寫入剩餘變更"""
+        if self._flush_task:
+            # 不直接取消，避免背景執行緒仍在寫入時重複使用連線
+            self._closing = True
+            self._wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        if self._conn:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+    
+    def append(self, item: dict):
+        """記錄新訊息（於下次批次提交時寫入）"""
+        seq = self._next_seq
+        self._next_seq += 1
+        item["queue_seq"] = seq
+        self._inserts[seq] = json.dumps(item, ensure_ascii=False)
+        if len(self._inserts) >= self.flush_batch:
+            self._wakeup.set()
+    
+    def ack(self, item: dict):
+        """記錄訊息已確認；尚未寫入磁碟的訊息直接從緩衝移除"""
+        seq = item.get("queue_seq")
+        if seq is None:
+            return
+        if self._inserts.pop(seq, None) is None:
+            self._deletes.append(seq)
+    
+    def save_idempotency(self, key: str, record: dict, expires_at: float):
+        """記錄 Idempotency-Key 的回應（與訊息一起批次提交）"""
+        self._idempotency[key] = (json.dumps(record, ensure_ascii=False), expires_at)
+    
+    async def load_idempotency(self) -> List[Tuple[str, dict, float]]:
+        """讀取未過期的 Idempotency-Key 紀錄（需先 open）"""
+        rows = await asyncio.to_thread(self._load_idempotency)
+        return [(key, json.loads(data), expires_at) for key, data, expires_at in rows]
+    
+    async def flush(self):
+        """將緩衝中的變更以單一交易寫入"""
+        if not self._conn or (not self._inserts and not self._deletes and not self._idempotency):
+            return
+        inserts, self._inserts = self._inserts, {}
+        deletes, self._deletes = self._deletes, []
+        idempotency, self._idempotency = self._idempotency, {}
+        try:
+            await asyncio.to_thread(
+                self._write,
+                list(inserts.items()),
+                deletes,
+                [(key, data, expires_at) for key, (data, expires_at) in idempotency.items()],
+            )
+        except Exception:
+            # 寫入失敗時放回緩衝，下次再試
+            self._inserts = {**inserts, **self._inserts}
+            self._deletes = deletes + self._deletes
+            self._idempotency = {**idempotency, **self._idempotency}
+            raise
+    
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"持久化佇列寫入失敗: {e}")
+    
+    def _open(self) -> List[dict]:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute("CREATE TABLE IF NOT EXISTS outbound (seq INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idempotency_expires_at ON idempotency (expires_at)")
+        self._conn = conn
+        
+        items = []
+        for seq, data in conn.execute("SELECT seq, data FROM outbound ORDER BY seq"):
+            item = json.loads(data)
+            item["queue_seq"] = seq
+            items.append(item)
+        if items:
+            self._next_seq = items[-1]["queue_seq"] + 1
+        return items
+    
+    def _load_idempotency(self) -> List[tuple]:
+        self._conn.execute("DELETE FROM idempotency WHERE expires_at <= ?", (time.time(),))
+        return self._conn.execute("SELECT key, data, expires_at FROM idempotency ORDER BY expires_at").fetchall()
+    
+    def _write(self, inserts: List[tuple], deletes: List[int], idempotency: List[tuple]):
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO outbound (seq, data) VALUES (?, ?)", inserts)
+            conn.executemany("DELETE FROM outbound WHERE seq = ?", [(seq,) for seq in deletes])
+            if idempotency:
+                conn.executemany("INSERT OR REPLACE INTO idempotency (key, data, expires_at) VALUES (?, ?, ?)", idempotency)
+                conn.execute("DELETE FROM idempotency WHERE expires_at <= ?", (time.time(),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
@@ -0,0 +1,145 @@
+import re
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from . import metrics
+
+# 路徑中的 snowflake；major parameter（頻道 / 伺服器 / webhook）決定 Discord 的 bucket 範圍
+_SNOWFLAKE = re.compile(r"\d{15,}")
+_MAJOR_PARAMETER = re.compile(r"/(?:channels|guilds|webhooks)/(\d+)")
+_API_PREFIX = re.compile(r"^/api/v\d+")
+
+# 發送訊息的路由
+SEND_MESSAGE_ROUTE = ("POST", "/channels/{id}/messages")
+
+# 發出請求的一方設定的識別值；trace callback 與請求在同一個 task 中執行，可讀到發出者設定的值，
+# listener 藉此只處理自己的請求（例如不處理命令回覆等同頻道的其他發送）
+REQUEST_OWNER: ContextVar[Any] = ContextVar("ratelimit_request_owner", default=None)
+
+# 超過此秒數未使用且已重置的 bucket 會被清除
+BUCKET_IDLE_SECONDS = 300
+
+class BucketState:
+    """單一 bucket（bucket hash + major parameter）的最新限流狀態"""
+    __slots__ = ("bucket", "major_id", "limit", "remaining", "reset_at", "requests", "limited")
+    
+    def __init__(self, bucket: str, major_id: Optional[int]):
+        self.bucket = bucket
+        self.major_id = major_id
+        self.limit = 0
+        self.remaining = 0
+        self.reset_at = 0.0
+        self.requests = 0
+        self.limited = 0
+
+class RateLimitTracker:
+    """依 Discord 回應的 X-RateLimit-* 標頭追蹤各 bucket 的剩餘次數與重置時間
+    
+    以 aiohttp TraceConfig 掛在 discord.py 的 HTTP session 上，所有 REST 回應（含重試）都會更新狀態。
+    發送任務在呼叫 API 前以 delay() 查詢，已知會被限流的頻道先暫緩，不佔用 worker；
+    並在收到發送訊息的回應時釋放 worker，不必等 discord.py 在 bucket 用完後的預先等待結束。
+    """
+    def __init__(self):
+        # (方法, 路由樣板) -> bucket hash
+        self._routes: Dict[Tuple[str, str], str] = {}
+        # (bucket hash, major parameter) -> 狀態
+        self._buckets: Dict[Tuple[str, Optional[int]], BucketState] = {}
+        self._global_reset_at = 0.0
+        self._last_prune = time.monotonic()
+        # (路由, callback)：只通知指定路由的回應
+        self._listeners: List[Tuple[Tuple[str, str], Callable[[Optional[int], int, Any], None]]] = []
+    
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(self._on_request_end)
+        return trace
+    
+    async def _on_request_end(self, session, context, params: aiohttp.TraceRequestEndParams):
+        self.update(params.method, params.url.path, params.response.status, params.response.headers)
+    
+    def update(self, method: str, path: str, status: int, headers):
+        """以單次回應的狀態碼與標頭更新 bucket 狀態，並通知該路由的 listener 此 major parameter 已收到回應"""
+        path = _API_PREFIX.sub("", path)
+        major = _MAJOR_PARAMETER.match(path)
+        major_id = int(major.group(1)) if major else None
+        route = (method, _SNOWFLAKE.sub("{id}", path))
+        self._update_state(route, major_id, status, headers)
+        owner = REQUEST_OWNER.get()
+        for listened_route, listener in self._listeners:
+            if listened_route == route:
+                listener(major_id, status, owner)
+    
+    def add_listener(self, listener: Callable[[Optional[int], int, Any], None], route: Tuple[str, str] = SEND_MESSAGE_ROUTE):
+        """註冊收到 route（預設為發送訊息）回應時的 callback(major_id, status, owner)；
+        owner 為發出請求時 REQUEST_OWNER 的值。同一頻道的其他路由（例如解析頻道時的 fetch_channel）不會觸發"""
+        self._listeners.append((route, listener))
+    
+    def _update_state(self, route: Tuple[str, str], major_id: Optional[int], status: int, headers):
+        now = time.monotonic()
+        if status == 429:
+            scope = "global" if headers.get("X-RateLimit-Global", "").lower() == "true" else headers.get("X-RateLimit-Scope", "user")
+            metrics.RATELIMIT_HITS.inc(scope=scope)
+            if scope == "global":
+                self._global_reset_at = now + float(headers.get("Retry-After", 1))
+                return
+        
+        bucket = headers.get("X-RateLimit-Bucket")
+        if bucket is None:
+            return
+        self._routes[route] = bucket
+        
+        state = self._buckets.get((bucket, major_id))
+        if state is None:
+            state = self._buckets[(bucket, major_id)] = BucketState(bucket, major_id)
+        state.requests += 1
+        state.limit = int(headers.get("X-RateLimit-Limit", state.limit))
+        state.remaining = int(headers.get("X-RateLimit-Remaining", state.remaining))
+        state.reset_at = now + float(headers.get("X-RateLimit-Reset-After", 0))
+        if status == 429:
+            state.limited += 1
+            state.remaining = 0
+            state.reset_at = max(state.reset_at, now + float(headers.get("Retry-After", 0)))
+        
+        if now - self._last_prune > 60:
+            self._prune(now)
+    
+    def delay(self, major_id: int, route: Tuple[str, str] = SEND_MESSAGE_ROUTE) -> float:
+        """距離可以對此路由 / major parameter 發出請求還需等待的秒數；0 表示可立即發送"""
+        now = time.monotonic()
+        wait = self._global_reset_at - now
+        bucket = self._routes.get(route)
+        state = self._buckets.get((bucket, major_id)) if bucket else None
+        if state is not None and state.remaining <= 0:
+            wait = max(wait, state.reset_at - now)
+        return max(wait, 0.0)
+    
+    def snapshot(self) -> dict:
+        """各 bucket 的使用率（目前視窗內已用次數 / 上限）"""
+        now = time.monotonic()
+        buckets: List[dict] = []
+        for state in self._buckets.values():
+            active = state.reset_at > now
+            remaining = state.remaining if active else state.limit
+            buckets.append({
+                "bucket": state.bucket,
+                "major_id": state.major_id,
+                "limit": state.limit,
+                "remaining": remaining,
+                "utilization": round((state.limit - remaining) / state.limit, 3) if state.limit else 0.0,
+                "reset_after": round(state.reset_at - now, 3) if active else 0.0,
+                "requests": state.requests,
+                "limited": state.limited,
+            })
+        return {
+            "global_reset_after": round(max(self._global_reset_at - now, 0.0), 3),
+            "buckets": buckets,
+        }
+    
+    def _prune(self, now: float):
+        self._last_prune = now
+        for key, state in list(self._buckets.items()):
+            if now - state.reset_at > BUCKET_IDLE_SECONDS:
+                del self._buckets[key]
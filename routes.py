@@ -1,12 +1,24 @@
+import asyncio
 import logging
+import os
+import time
+from contextlib import AsyncExitStack
 from datetime import datetime
-from typing import Optional
-from fastapi import APIRouter, HTTPException, Depends, WebSocket, status
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request, Response, WebSocket, status
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from pydantic import ValidationError
 
-from .models import MessagePayload, MessageResponse
-from .config import DISCORD_CHANNEL_ID, API_AUTH_TOKEN
+from .models import MessagePayload, MessageResponse, BatchMessageResponse, TicketStatus
+from .config import DISCORD_CHANNEL_ID, API_AUTH_TOKEN, SEND_BATCH_MAX_SIZE, SEND_WAIT_TIMEOUT, SCHEDULER_MAX_DELAY
 from .websocket_manager import WebSocketManager
+from .broker import HEALTH_PATH, BrokerClient, BrokerUnavailableError
+from .outbound import QueueFullError
+from .encoding import encode_json
+from .idempotency import fingerprint
+from .snapshot import GUILD_FIELDS, CHANNEL_FIELDS, project
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -20,13 +32,21 @@ security = HTTPBearer(auto_error=False)
 message_queue = None
 discord_bot = None
 websocket_manager = None
+idempotency_cache = None
+delivery_tickets = None
+message_scheduler = None
 
-def set_globals(queue, bot, ws_manager):
+def set_globals(queue, bot, ws_manager, idempotency=None, tickets=None, scheduler=None):
     """設定全域變數（由主應用程式調用）"""
-    global message_queue, discord_bot, websocket_manager
+    global message_queue, discord_bot, websocket_manager, idempotency_cache, delivery_tickets, message_scheduler
     message_queue = queue
     discord_bot = bot
     websocket_manager = ws_manager
+    idempotency_cache = idempotency
+    delivery_tickets = tickets
+    message_scheduler = scheduler
+    if ws_manager and queue:
+        ws_manager.set_send_handler(ingest_websocket_message)
 
 # 認證依賴
 async def verify_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
@@ -40,33 +60,258 @@ async def verify_token(credentials: Optional[HTTPAuthorizationCredentials] = Dep
     return True
 
 @router.post("/send-message", response_model=MessageResponse, dependencies=[Depends(verify_token)])
-async def send_message(payload: MessagePayload):
-    """發送訊息到 Discord"""
-    global message_queue
+async def send_message(
+    payload: MessagePayload,
+    wait: bool = Query(False, description=f"等待訊息發送完成再回應（最多 {SEND_WAIT_TIMEOUT:g} 秒）"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+):
+    """發送訊息到 Discord（帶 Idempotency-Key 時，相同 key 的重試直接回傳第一次的結果；
+    帶 send_at / delay_seconds 時排程於指定時間發送）"""
+    response, replayed = await _accept_message(payload, idempotency_key)
+    
+    # 等待發送結果：已發送回傳 200，發送失敗回傳 502，逾時回傳 202（可再以票證查詢）
+    status_code = status.HTTP_200_OK
+    if wait and response.ticket and delivery_tickets:
+        record = await delivery_tickets.wait(response.ticket, SEND_WAIT_TIMEOUT)
+        if record is not None:
+            response = _ticket_response(record)
+        status_code = {
+            "sent": status.HTTP_200_OK,
+            "failed": status.HTTP_502_BAD_GATEWAY,
+        }.get(response.status, status.HTTP_202_ACCEPTED)
     
+    if replayed or status_code != status.HTTP_200_OK:
+        return JSONResponse(
+            response.model_dump(mode="json"),
+            status_code=status_code,
+            headers={"Idempotent-Replayed": "true"} if replayed else None,
+        )
+    return response
+
+async def ingest_websocket_message(data: dict, idempotency_key: Optional[str] = None) -> Tuple[int, dict]:
+    """WebSocket send 訊框：與 /send-message 相同的驗證與加入佇列流程，回傳 (狀態碼, 內容)"""
+    try:
+        payload = MessagePayload.model_validate(data)
+        response, replayed = await _accept_message(payload, idempotency_key)
+    except ValidationError as e:
+        return status.HTTP_422_UNPROCESSABLE_ENTITY, {"detail": e.errors(include_url=False)}
+    except HTTPException as e:
+        body = {"detail": e.detail}
+        if e.headers and "Retry-After" in e.headers:
+            body["retry_after"] = int(e.headers["Retry-After"])
+        return e.status_code, body
+    return status.HTTP_200_OK, {**response.model_dump(mode="json"), "replayed": replayed}
+
+async def _accept_message(payload: MessagePayload, idempotency_key: Optional[str]) -> Tuple[MessageResponse, bool]:
+    """加入佇列並回傳 (回應, 是否為 Idempotency-Key 重播)"""
     if not message_queue:
         raise HTTPException(status_code=503, detail="訊息佇列未初始化")
     
+    key = idempotency_key or payload.idempotency_key
+    if not key or not idempotency_cache:
+        return await _enqueue_message(payload), False
+    
+    request_fingerprint = _fingerprint(payload)
+    async with idempotency_cache.lock(key):
+        record = idempotency_cache.get(key)
+        if record is not None:
+            if record["fingerprint"] != request_fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key 已用於不同內容的請求")
+            return MessageResponse(**record["response"]), True
+        
+        # 只保存成功加入佇列的結果；失敗（例如佇列已滿）時重試仍會重新加入佇列
+        response = await _enqueue_message(payload)
+        idempotency_cache.set(key, request_fingerprint, response.model_dump(mode="json"))
+        return response, False
+
+def _fingerprint(payload: MessagePayload) -> str:
+    return fingerprint(payload.model_dump_json(exclude={"idempotency_key"}))
+
+def _ticket_response(record: dict) -> MessageResponse:
+    return MessageResponse(
+        success=record["status"] != "failed",
+        ticket=record["ticket"],
+        status=record["status"],
+        send_at=record.get("send_at"),
+        message_id=record["message_id"],
+        error=record["error"],
+        timestamp=datetime.now(),
+    )
+
+async def _enqueue_message(payload: MessagePayload) -> MessageResponse:
+    send_at = _resolve_send_at(payload)
     try:
         # 準備訊息資料
-        message_data = {
-            "content": payload.content,
-            "channel_id": payload.channel_id or DISCORD_CHANNEL_ID,
-            "embed": payload.embed
-        }
-        
-        # 將訊息加入佇列
-        await message_queue.put(message_data)
+        message_data = _build_message_data(payload, send_at)
         
-        return MessageResponse(
-            success=True,
-            timestamp=datetime.now()
-        )
+        # 將訊息加入佇列（排程訊息到期後才由排程器放入）
+        if send_at is None:
+            await message_queue.put(message_data)
+        else:
+            message_scheduler.schedule(message_data)
         
+        return _accepted_response(message_data)
+    
+    except QueueFullError as e:
+        _discard_tickets([message_data])
+        raise _queue_full_exception(e)
     except Exception as e:
         logger.error(f"處理訊息請求失敗: {e}")
         raise HTTPException(status_code=500, detail=f"內部伺服器錯誤: {str(e)}")
 
+@router.post("/send-messages", response_model=BatchMessageResponse, dependencies=[Depends(verify_token)])
+async def send_messages(payloads: List[MessagePayload]):
+    """批次發送多則訊息到 Discord（整批加入佇列，不會只接受一部分；
+    帶 idempotency_key 的訊息與 /send-message 共用去重紀錄，重試時已接受的訊息不會重複加入）"""
+    global message_queue
+    
+    if not message_queue:
+        raise HTTPException(status_code=503, detail="訊息佇列未初始化")
+    
+    if not payloads:
+        raise HTTPException(status_code=400, detail="訊息列表不可為空")
+    if len(payloads) > SEND_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"單次最多 {SEND_BATCH_MAX_SIZE} 則訊息")
+    
+    keys = [payload.idempotency_key for payload in payloads if payload.idempotency_key]
+    if len(set(keys)) != len(keys):
+        raise HTTPException(status_code=422, detail="同一批次中的 idempotency_key 不可重複")
+    if not idempotency_cache:
+        keys = []
+    
+    async with AsyncExitStack() as stack:
+        # 依固定順序取得各 key 的鎖，避免與其他批次互相等待
+        for key in sorted(keys):
+            await stack.enter_async_context(idempotency_cache.lock(key))
+        
+        # 已接受過的訊息（索引 -> 第一次的回應）
+        replayed = {}
+        if keys:
+            for index, payload in enumerate(payloads):
+                record = idempotency_cache.get(payload.idempotency_key) if payload.idempotency_key else None
+                if record is not None:
+                    if record["fingerprint"] != _fingerprint(payload):
+                        raise HTTPException(status_code=422, detail="Idempotency-Key 已用於不同內容的請求")
+                    replayed[index] = record["response"]
+        
+        pending = [payload for index, payload in enumerate(payloads) if index not in replayed]
+        schedule = [_resolve_send_at(payload) for payload in pending]
+        items = []
+        try:
+            items = [_build_message_data(payload, send_at) for payload, send_at in zip(pending, schedule)]
+            scheduled = [item for item in items if "send_at" in item]
+            if scheduled:
+                message_scheduler.check_capacity(len(scheduled))
+            immediate = [item for item in items if "send_at" not in item]
+            if immediate:
+                await message_queue.put_many(immediate)
+            for item in scheduled:
+                message_scheduler.schedule(item)
+        
+        except QueueFullError as e:
+            _discard_tickets(items)
+            raise _queue_full_exception(e)
+        except Exception as e:
+            logger.error(f"處理批次訊息請求失敗: {e}")
+            raise HTTPException(status_code=500, detail=f"內部伺服器錯誤: {str(e)}")
+        
+        for payload, item in zip(pending, items):
+            if keys and payload.idempotency_key:
+                response = _accepted_response(item)
+                idempotency_cache.set(payload.idempotency_key, _fingerprint(payload), response.model_dump(mode="json"))
+    
+    # 票證依請求順序排列，重試的訊息回傳第一次的票證
+    accepted = iter(items)
+    tickets = [
+        replayed[index].get("ticket") if index in replayed else next(accepted).get("ticket")
+        for index in range(len(payloads))
+    ]
+    return BatchMessageResponse(
+        success=True,
+        accepted=len(payloads),
+        replayed=len(replayed),
+        tickets=[ticket for ticket in tickets if ticket],
+        timestamp=datetime.now()
+    )
+
+@router.get("/messages/{ticket}", response_model=TicketStatus, dependencies=[Depends(verify_token)])
+async def get_message_status(ticket: str):
+    """以投遞票證查詢訊息的發送結果"""
+    if not delivery_tickets:
+        raise HTTPException(status_code=503, detail="投遞票證未啟用")
+    record = delivery_tickets.get(ticket)
+    if record is None:
+        raise HTTPException(status_code=404, detail="找不到票證（可能已過期）")
+    return record
+
+@router.delete("/messages/{ticket}", response_model=TicketStatus, dependencies=[Depends(verify_token)])
+async def cancel_scheduled_message(ticket: str):
+    """取消尚未到期的排程訊息（已放入發送佇列的訊息無法取消）"""
+    if not message_scheduler:
+        raise HTTPException(status_code=503, detail="排程發送未啟用")
+    if not message_scheduler.cancel(ticket):
+        if delivery_tickets and delivery_tickets.get(ticket) is not None:
+            raise HTTPException(status_code=409, detail="訊息已放入發送佇列或已取消")
+        raise HTTPException(status_code=404, detail="找不到排程訊息")
+    record = delivery_tickets.get(ticket) if delivery_tickets else None
+    return record or {"ticket": ticket, "status": "cancelled"}
+
+def _accepted_response(message_data: dict) -> MessageResponse:
+    """已加入佇列（或排程）的訊息的回應"""
+    send_at = message_data.get("send_at")
+    return MessageResponse(
+        success=True,
+        ticket=message_data.get("ticket"),
+        status="queued" if send_at is None else "scheduled",
+        send_at=datetime.fromtimestamp(send_at) if send_at is not None else None,
+        timestamp=datetime.now()
+    )
+
+def _resolve_send_at(payload: MessagePayload) -> Optional[float]:
+    """排程發送時間（Unix 時間），未排程或時間已過時回傳 None"""
+    if payload.send_at is not None:
+        send_at = payload.send_at.timestamp()
+    elif payload.delay_seconds:
+        send_at = time.time() + payload.delay_seconds
+    else:
+        return None
+    now = time.time()
+    if send_at <= now:
+        return None
+    if not message_scheduler:
+        raise HTTPException(status_code=503, detail="排程發送未啟用")
+    if send_at - now > SCHEDULER_MAX_DELAY:
+        raise HTTPException(status_code=422, detail=f"排程時間最多 {SCHEDULER_MAX_DELAY:.0f} 秒之後")
+    return send_at
+
+def _build_message_data(payload: MessagePayload, send_at: Optional[float] = None) -> dict:
+    """將請求內容轉為佇列中的訊息資料"""
+    message_data = {
+        "content": payload.content,
+        "channel_id": payload.channel_id or DISCORD_CHANNEL_ID,
+        "embed": payload.embed,
+        "priority": payload.priority,
+    }
+    if send_at is not None:
+        message_data["send_at"] = send_at
+    if delivery_tickets:
+        message_data["ticket"] = delivery_tickets.create(message_data["channel_id"], payload.priority, send_at)
+    return message_data
+
+def _discard_tickets(items: List[dict]):
+    """未加入佇列的訊息不保留票證"""
+    for item in items:
+        if "ticket" in item:
+            delivery_tickets.discard(item["ticket"])
+
+def _queue_full_exception(error: QueueFullError) -> HTTPException:
+    """佇列已滿：拒絕回傳 429，block 等待逾時回傳 503，皆附 Retry-After"""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE if error.timed_out else status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
 @router.get("/status")
 async def get_status():
     """取得 Bot 狀態"""
@@ -76,69 +321,118 @@ async def get_status():
         return {
             "status": "online",
             "bot_name": discord_bot.user.name if discord_bot.user else None,
+            "shards": discord_bot.shard_status(),
             "timestamp": datetime.now().isoformat()
         }
     else:
         return {
             "status": "offline",
+            "shards": discord_bot.shard_status() if discord_bot else [],
             "timestamp": datetime.now().isoformat()
         }
 
 @router.get("/servers")
-async def get_servers():
-    """取得所有伺服器資訊"""
+async def get_servers(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="每頁筆數，指定後依 ID 排序分頁"),
+    after: Optional[int] = Query(None, description="游標：只回傳 ID 大於此值的伺服器"),
+    fields: Optional[str] = Query(None, description="以逗號分隔的欄位，例如 id,name"),
+):
+    """取得所有伺服器資訊（由快照提供，支援 ETag / If-None-Match、游標分頁與欄位投影）"""
     global discord_bot
     
     if not discord_bot or not discord_bot.is_ready_flag:
         raise HTTPException(status_code=503, detail="Bot 未連線")
     
-    servers = []
-    for guild in discord_bot.guilds:
-        server_info = {
-            "id": guild.id,
-            "name": guild.name,
-            "member_count": guild.member_count,
-            "channel_count": len(guild.channels),
-            "owner_id": guild.owner_id,
-            "created_at": guild.created_at.isoformat() if guild.created_at else None
-        }
-        servers.append(server_info)
+    selected = _parse_fields(fields, GUILD_FIELDS)
+    snapshot = discord_bot.snapshot
+    etag = f'W/"servers-{snapshot.version}"'
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
     
-    return {
-        "servers": servers,
-        "total_count": len(servers),
+    if limit is None and after is None:
+        servers = snapshot.get_servers()
+        return _json_response({
+            "servers": project(servers, selected),
+            "total_count": len(servers),
+            "timestamp": datetime.now().isoformat()
+        }, etag)
+    
+    servers, next_cursor = snapshot.get_servers_page(after, limit)
+    return _json_response({
+        "servers": project(servers, selected),
+        "count": len(servers),
+        "total_count": len(snapshot.get_servers()),
+        "next_cursor": next_cursor,
         "timestamp": datetime.now().isoformat()
-    }
+    }, etag)
 
 @router.get("/servers/{guild_id}/channels")
-async def get_guild_channels(guild_id: int):
-    """取得指定伺服器的頻道資訊"""
+async def get_guild_channels(
+    guild_id: int,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="每頁筆數，指定後依 ID 排序分頁"),
+    after: Optional[int] = Query(None, description="游標：只回傳 ID 大於此值的頻道"),
+    fields: Optional[str] = Query(None, description="以逗號分隔的欄位，例如 id,name,type"),
+):
+    """取得指定伺服器的頻道資訊（由快照提供，支援 ETag / If-None-Match、游標分頁與欄位投影）"""
     global discord_bot
     
     if not discord_bot or not discord_bot.is_ready_flag:
         raise HTTPException(status_code=503, detail="Bot 未連線")
     
-    guild = discord_bot.get_guild(guild_id)
+    selected = _parse_fields(fields, CHANNEL_FIELDS)
+    snapshot = discord_bot.snapshot
+    guild = snapshot.get_guild(guild_id)
     if not guild:
         raise HTTPException(status_code=404, detail="找不到指定的伺服器")
     
-    channels = []
-    for channel in guild.channels:
-        channel_info = {
-            "id": channel.id,
-            "name": channel.name,
-            "type": str(channel.type),
-            "position": channel.position
-        }
-        channels.append(channel_info)
+    etag = f'W/"channels-{guild_id}-{snapshot.guild_version(guild_id)}"'
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
     
-    return {
-        "guild_name": guild.name,
-        "guild_id": guild.id,
-        "channels": channels,
+    channels = snapshot.get_channels(guild_id)
+    if limit is None and after is None:
+        return _json_response({
+            "guild_name": guild["name"],
+            "guild_id": guild["id"],
+            "channels": project(channels, selected),
+            "total_count": len(channels),
+            "timestamp": datetime.now().isoformat()
+        }, etag)
+    
+    page, next_cursor = snapshot.get_channels_page(guild_id, after, limit)
+    return _json_response({
+        "guild_name": guild["name"],
+        "guild_id": guild["id"],
+        "channels": project(page, selected),
+        "count": len(page),
         "total_count": len(channels),
+        "next_cursor": next_cursor,
         "timestamp": datetime.now().isoformat()
-    }
+    }, etag)
+
+def _parse_fields(fields: Optional[str], allowed: tuple) -> Optional[List[str]]:
+    """解析 fields= 參數，含未知欄位時回傳 400"""
+    if not fields:
+        return None
+    selected = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in selected if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"未知的欄位: {', '.join(unknown)}，可用欄位: {', '.join(allowed)}")
+    return selected
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """檢查 If-None-Match 是否包含目前的 ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def _json_response(content: dict, etag: str) -> Response:
+    """直接序列化回應內容並附上 ETag"""
+    return Response(content=encode_json(content), media_type="application/json", headers={"ETag": etag})
 
 @router.get("/websocket/connections")
 async def get_websocket_connections():
@@ -162,14 +456,74 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
         return
     
-    await websocket_manager.handle_websocket(websocket)
+    # send 訊框需要與 HTTP API 相同的令牌：Authorization 標頭，或連線後送出 auth 訊框（瀏覽器無法設定標頭時）；
+    # 不接受 ?token=，避免令牌出現在存取日誌、代理伺服器與瀏覽器紀錄中
+    authorization = websocket.headers.get("authorization", "")
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else None
+    can_send = not API_AUTH_TOKEN or token == API_AUTH_TOKEN
+    
+    await websocket_manager.handle_websocket(websocket, can_send=can_send)
 
 @router.get("/health")
-async def health_check():
+async def health_check(request: Request):
     """健康檢查端點"""
+    broker_client = getattr(request.app.state, "broker_client", None)
+    if broker_client is not None:
+        return await _worker_health(broker_client)
+    
     return {
         "status": "healthy", 
         "timestamp": datetime.now().isoformat(),
         "bot_status": "online" if (discord_bot and discord_bot.is_ready_flag) else "offline",
-        "websocket_connections": websocket_manager.get_connection_count() if websocket_manager else 0
+        "shards": discord_bot.shard_status() if discord_bot else [],
+        "websocket_connections": websocket_manager.get_connection_count() if websocket_manager else 0,
+        "queue": message_queue.stats() if message_queue else None,
+        "idempotency": idempotency_cache.stats() if idempotency_cache else None,
+        "tickets": delivery_tickets.stats() if delivery_tickets else None,
+        "scheduler": message_scheduler.stats() if message_scheduler else None,
+        "channels": discord_bot.channels.stats() if discord_bot else None
     }
+
+async def _worker_health(broker_client: BrokerClient) -> dict:
+    """工作程序的健康檢查：Bot 與佇列狀態取自 Gateway 擁有者，WebSocket 連線數為本程序的"""
+    try:
+        health = await broker_client.get_json(HEALTH_PATH)
+    except (BrokerUnavailableError, asyncio.TimeoutError):
+        health = {"status": "degraded", "bot_status": "unknown"}
+    return {
+        **health,
+        "timestamp": datetime.now().isoformat(),
+        "websocket_connections": websocket_manager.get_connection_count() if websocket_manager else 0,
+        "worker": {"pid": os.getpid(), "broker_connected": broker_client.connected},
+    }
+
+@router.get("/memory")
+async def get_memory_report():
+    """常駐記憶體、快取策略與各快取的物件數"""
+    if not discord_bot:
+        raise HTTPException(status_code=503, detail="Bot 未初始化")
+    
+    return {
+        "resident_memory_bytes": metrics.rss_bytes(),
+        **discord_bot.memory_report(),
+        "snapshot": discord_bot.snapshot.stats(),
+        "idempotency": idempotency_cache.stats() if idempotency_cache else None,
+        "tickets": delivery_tickets.stats() if delivery_tickets else None,
+        "timestamp": datetime.now().isoformat()
+    }
+
+@router.get("/ratelimits")
+async def get_rate_limits():
+    """各 Discord 限流 bucket 的剩餘次數、重置時間與使用率"""
+    if not discord_bot:
+        raise HTTPException(status_code=503, detail="Bot 未初始化")
+    
+    return {
+        **discord_bot.rate_limits.snapshot(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@router.get("/metrics")
+async def get_metrics():
+    """Prometheus 文字格式的監控指標"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from .config import SCHEDULER_MAX_PENDING
+from .outbound import OutboundQueue, QueueFullError
+from .tickets import DeliveryTickets
+from .encoding import encode_json
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+class MessageScheduler:
+    """排程訊息：到期前保存在最小堆積中，到期後放入發送佇列交給 DiscordSenderTask
+    
+    堆積只保存 (到期時間, 序號, 票證)，訊息內容以 JSON 字串保存在以票證為鍵的字典中，
+    百萬筆等級的排程也只佔用少量記憶體。背景任務只等待最早到期的一則訊息，
+    新訊息比目前最早的更早到期時才喚醒重新計算。取消時只移除字典中的內容，
+    堆積中的項目於彈出時略過（失效項目過多時重建堆積）。
+    發送佇列有持久化後端時排程訊息也一併寫入，重啟後由 start 重新排程。
+    排程中的訊息不佔用發送佇列的容量。
+    """
+    def __init__(
+        self,
+        queue: OutboundQueue,
+        tickets: Optional[DeliveryTickets] = None,
+        max_pending: int = SCHEDULER_MAX_PENDING,
+    ):
+        self.queue = queue
+        self.tickets = tickets
+        self.max_pending = max_pending
+        self.released_count = 0
+        self.cancelled_count = 0
+        self.rejected_count = 0
+        
+        self._heap: List[Tuple[float, int, str]] = []
+        self._items: Dict[str, str] = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+    
+    def pending_count(self) -> int:
+        """尚未到期的排程訊息數"""
+        return len(self._items)
+    
+    def start(self, items: Optional[List[dict]] = None):
+        """重新排程持久化後端載入的未到期訊息，並啟動背景任務"""
+        for item in items or ():
+            self._push(item)
+        if items:
+            logger.info(f"已從持久化佇列重新排程 {len(items)} 則訊息")
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            # 不直接取消：等待中的 wait_for 剛好被喚醒時取消可能被吞掉，導致關閉時卡住
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+    
+    def check_capacity(self, count: int = 1):
+        """排程 count 則訊息會超過上限時拒絕"""
+        if len(self._items) + count > self.max_pending:
+            self.rejected_count += count
+            metrics.SCHEDULED_TOTAL.inc(count, outcome="rejected")
+            raise QueueFullError("排程訊息已達上限", self.queue.retry_after)
+    
+    def schedule(self, item: dict):
+        """排程一則訊息，item["send_at"] 為發送時間（Unix 時間）"""
+        self.check_capacity()
+        item.setdefault("ticket", uuid.uuid4().hex)
+        if self.queue.store:
+            self.queue.store.append(item)
+        self._push(item)
+    
+    def cancel(self, ticket: str) -> bool:
+        """取消尚未到期的排程訊息，已放入發送佇列或不存在時回傳 False"""
+        data = self._items.pop(ticket, None)
+        if data is None:
+            return False
+        if self.queue.store:
+            self.queue.store.ack(json.loads(data))
+        self.cancelled_count += 1
+        metrics.SCHEDULED_TOTAL.inc(outcome="cancelled")
+        if self.tickets:
+            self.tickets.cancel(ticket)
+        if len(self._heap) > 2 * len(self._items) + 1024:
+            self._heap = [entry for entry in self._heap if entry[2] in self._items]
+            heapq.heapify(self._heap)
+        return True
+    
+    def next_due(self) -> Optional[float]:
+        """最早到期的排程時間"""
+        self._drop_cancelled()
+        return self._heap[0][0] if self._heap else None
+    
+    def stats(self) -> dict:
+        next_due = self.next_due()
+        return {
+            "pending": len(self._items),
+            "capacity": self.max_pending,
+            "next_due_in": round(max(next_due - time.time(), 0), 3) if next_due is not None else None,
+            "released": self.released_count,
+            "cancelled": self.cancelled_count,
+            "rejected": self.rejected_count,
+        }
+    
+    def _push(self, item: dict):
+        ticket = item["ticket"]
+        self._items[ticket] = encode_json(item)
+        self._seq += 1
+        heapq.heappush(self._heap, (item["send_at"], self._seq, ticket))
+        if self._heap[0][2] == ticket:
+            self._wakeup.set()
+    
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][2] not in self._items:
+            heapq.heappop(self._heap)
+    
+    async def _run(self):
+        while not self._closing:
+            next_due = self.next_due()
+            self._wakeup.clear()
+            if next_due is None:
+                await self._wakeup.wait()
+                continue
+            delay = next_due - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._release_due()
+    
+    def _release_due(self):
+        """將所有已到期的訊息放入發送佇列"""
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, ticket = heapq.heappop(self._heap)
+            data = self._items.pop(ticket, None)
+            if data is None:
+                continue
+            item = json.loads(data)
+            scheduled_seq = item.pop("queue_seq", None)
+            try:
+                # 持久化後端以新的序號重新寫入，再刪除排程時的紀錄
+                self.queue.put_nowait(item)
+            except QueueFullError as e:
+                # 發送佇列已滿：保留在排程中，稍後再試
+                self._items[ticket] = data
+                self._seq += 1
+                heapq.heappush(self._heap, (now + e.retry_after, self._seq, ticket))
+                logger.warning(f"發送佇列已滿，排程訊息延後 {e.retry_after} 秒再放入")
+                return
+            if self.queue.store and scheduled_seq is not None:
+                self.queue.store.ack({"queue_seq": scheduled_seq})
+            self.released_count += 1
+            metrics.SCHEDULED_TOTAL.inc(outcome="released")
+            metrics.SCHEDULED_LATENESS.observe(max(time.time() - item["send_at"], 0))
+            if self.tickets:
+                self.tickets.mark_queued(ticket)
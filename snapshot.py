@@ -0,0 +1,184 @@
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# channels 命令中視為文字 / 語音頻道的類型
+TEXT_CHANNEL_TYPES = ("text", "news")
+VOICE_CHANNEL_TYPES = ("voice",)
+
+# 可供 fields= 投影的欄位
+GUILD_FIELDS = ("id", "name", "member_count", "channel_count", "owner_id", "created_at")
+CHANNEL_FIELDS = ("id", "name", "type", "position")
+
+def guild_info(guild) -> dict:
+    return {
+        "id": guild.id,
+        "name": guild.name,
+        "member_count": guild.member_count,
+        "channel_count": len(guild.channels),
+        "owner_id": guild.owner_id,
+        "created_at": guild.created_at.isoformat() if guild.created_at else None
+    }
+
+def channel_info(channel) -> dict:
+    return {
+        "id": channel.id,
+        "name": channel.name,
+        "type": str(channel.type),
+        "position": channel.position
+    }
+
+class GuildSnapshot:
+    """伺服器與頻道資訊的快照，由 Bot 的伺服器 / 頻道事件增量維護
+    
+    version 在每次變更時遞增；每個伺服器另外記錄其最後變更時的 version，
+    供 API 產生 ETag。列表結果會快取到下一次變更為止。
+    """
+    def __init__(self):
+        self.version = 0
+        self._guilds: Dict[int, dict] = {}
+        self._channels: Dict[int, Dict[int, dict]] = {}
+        self._guild_versions: Dict[int, int] = {}
+        self._servers_cache: Optional[List[dict]] = None
+        self._channels_cache: Dict[int, List[dict]] = {}
+        self._groups_cache: Dict[int, Dict[str, List[str]]] = {}
+        # 依 ID 排序的列表（分頁用）：(ID 列表, 資料列表)
+        self._sorted_servers_cache: Optional[Tuple[List[int], List[dict]]] = None
+        self._sorted_channels_cache: Dict[int, Tuple[List[int], List[dict]]] = {}
+    
+    def rebuild(self, guilds: Iterable):
+        """以目前所有伺服器重建快照（on_ready 時呼叫）"""
+        self._guilds.clear()
+        self._channels.clear()
+        self._guild_versions.clear()
+        for guild in guilds:
+            self._store_guild(guild)
+        self._touch()
+    
+    def upsert_guild(self, guild):
+        """新增或更新伺服器（含其所有頻道）"""
+        self._store_guild(guild)
+        self._touch(guild.id)
+    
+    def update_guild_info(self, guild):
+        """只更新伺服器本身的資訊（名稱、成員數等）"""
+        if guild.id not in self._guilds:
+            self.upsert_guild(guild)
+            return
+        self._guilds[guild.id] = guild_info(guild)
+        self._touch(guild.id)
+    
+    def remove_guild(self, guild_id: int):
+        self._guilds.pop(guild_id, None)
+        self._channels.pop(guild_id, None)
+        self._guild_versions.pop(guild_id, None)
+        self._touch(guild_id)
+    
+    def upsert_channel(self, channel):
+        guild = channel.guild
+        channels = self._channels.setdefault(guild.id, {})
+        channels[channel.id] = channel_info(channel)
+        self._guilds[guild.id] = guild_info(guild)
+        self._touch(guild.id)
+    
+    def remove_channel(self, channel):
+        guild = channel.guild
+        self._channels.get(guild.id, {}).pop(channel.id, None)
+        self._guilds[guild.id] = guild_info(guild)
+        self._touch(guild.id)
+    
+    def get_servers(self) -> List[dict]:
+        if self._servers_cache is None:
+            self._servers_cache = list(self._guilds.values())
+        return self._servers_cache
+    
+    def get_guild(self, guild_id: int) -> Optional[dict]:
+        return self._guilds.get(guild_id)
+    
+    def get_channels(self, guild_id: int) -> Optional[List[dict]]:
+        if guild_id not in self._guilds:
+            return None
+        cached = self._channels_cache.get(guild_id)
+        if cached is None:
+            cached = self._channels_cache[guild_id] = list(self._channels.get(guild_id, {}).values())
+        return cached
+    
+    def get_channel_groups(self, guild_id: int) -> Optional[Dict[str, List[str]]]:
+        """取得伺服器的文字 / 語音頻道名稱（供 channels 命令使用）"""
+        channels = self.get_channels(guild_id)
+        if channels is None:
+            return None
+        groups = self._groups_cache.get(guild_id)
+        if groups is None:
+            groups = self._groups_cache[guild_id] = {
+                "text": [ch["name"] for ch in channels if ch["type"] in TEXT_CHANNEL_TYPES],
+                "voice": [ch["name"] for ch in channels if ch["type"] in VOICE_CHANNEL_TYPES],
+            }
+        return groups
+    
+    def get_servers_page(self, after: Optional[int], limit: Optional[int]) -> Tuple[List[dict], Optional[int]]:
+        """依 ID 排序分頁，回傳 (本頁伺服器, 下一頁游標)"""
+        if self._sorted_servers_cache is None:
+            self._sorted_servers_cache = _sort_by_id(self._guilds.values())
+        return _paginate(self._sorted_servers_cache, after, limit)
+    
+    def get_channels_page(self, guild_id: int, after: Optional[int], limit: Optional[int]) -> Optional[Tuple[List[dict], Optional[int]]]:
+        """依 ID 排序分頁，回傳 (本頁頻道, 下一頁游標)；伺服器不存在時回傳 None"""
+        if guild_id not in self._guilds:
+            return None
+        cached = self._sorted_channels_cache.get(guild_id)
+        if cached is None:
+            cached = self._sorted_channels_cache[guild_id] = _sort_by_id(self._channels.get(guild_id, {}).values())
+        return _paginate(cached, after, limit)
+    
+    def guild_version(self, guild_id: int) -> int:
+        return self._guild_versions.get(guild_id, 0)
+    
+    def stats(self) -> dict:
+        """快照中的伺服器數、頻道數與目前快取的列表結果數"""
+        return {
+            "version": self.version,
+            "guilds": len(self._guilds),
+            "channels": sum(len(channels) for channels in self._channels.values()),
+            "cached_lists": len(self._channels_cache) + len(self._groups_cache) + len(self._sorted_channels_cache),
+        }
+    
+    def _store_guild(self, guild):
+        self._guilds[guild.id] = guild_info(guild)
+        self._channels[guild.id] = {channel.id: channel_info(channel) for channel in guild.channels}
+    
+    def _touch(self, guild_id: Optional[int] = None):
+        """遞增版本並清除受影響的快取"""
+        self.version += 1
+        self._servers_cache = None
+        self._sorted_servers_cache = None
+        if guild_id is None:
+            self._channels_cache.clear()
+            self._groups_cache.clear()
+            self._sorted_channels_cache.clear()
+            for gid in self._guilds:
+                self._guild_versions[gid] = self.version
+        else:
+            self._channels_cache.pop(guild_id, None)
+            self._groups_cache.pop(guild_id, None)
+            self._sorted_channels_cache.pop(guild_id, None)
+            if guild_id in self._guilds:
+                self._guild_versions[guild_id] = self.version
+
+def _sort_by_id(items: Iterable[dict]) -> Tuple[List[int], List[dict]]:
+    ordered = sorted(items, key=lambda item: item["id"])
+    return [item["id"] for item in ordered], ordered
+
+def _paginate(sorted_items: Tuple[List[int], List[dict]], after: Optional[int], limit: Optional[int]) -> Tuple[List[dict], Optional[int]]:
+    """取出 ID 大於 after 的前 limit 筆；還有下一頁時回傳最後一筆的 ID 作為游標"""
+    ids, items = sorted_items
+    start = bisect_right(ids, after) if after is not None else 0
+    end = len(items) if limit is None else min(start + limit, len(items))
+    next_cursor = ids[end - 1] if end < len(items) and end > start else None
+    return items[start:end], next_cursor
+
+def project(items: List[dict], fields: Optional[List[str]]) -> List[dict]:
+    """只保留指定欄位（id 一律保留，供游標分頁使用）"""
+    if not fields:
+        return items
+    keys = ["id"] + [field for field in fields if field != "id"]
+    return [{key: item[key] for key in keys} for item in items]
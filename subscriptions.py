@@ -0,0 +1,108 @@
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set
+
+# 訂閱欄位：訂閱訊框中的鍵 -> 事件中的欄位
+FILTER_FIELDS = {
+    "types": "type",
+    "guilds": "guild_id",
+    "channels": "channel_id",
+}
+
+def parse_filters(frame: Dict[str, Any]) -> Dict[str, Optional[Set]]:
+    """解析 subscribe 訊框；未指定的欄位為 None（不過濾），ID 一律轉為 int"""
+    filters: Dict[str, Optional[Set]] = {}
+    for key, field in FILTER_FIELDS.items():
+        values = frame.get(key)
+        if values is None:
+            filters[field] = None
+            continue
+        if not isinstance(values, list):
+            raise ValueError(f"{key} 必須是陣列")
+        if field == "type":
+            filters[field] = {str(value) for value in values}
+        else:
+            # 前端常以字串傳遞 snowflake，避免 JavaScript 數字精度問題
+            filters[field] = {int(value) for value in values}
+    return filters
+
+class SubscriptionIndex:
+    """依事件類型 / 伺服器 / 頻道建立的訂閱索引
+    
+    每個欄位維護「指定值 -> 訂閱者」與「未過濾此欄位的訂閱者」兩組集合。
+    比對事件時只走訪候選數最少的欄位，再以訂閱者自身的條件檢查其餘欄位，
+    因此成本與該欄位的候選訂閱者數成正比，而非總連線數。
+    事件缺少某欄位（例如全域狀態事件沒有 guild_id）時，該欄位不參與過濾。
+    """
+    def __init__(self):
+        self._filters: Dict[Hashable, Dict[str, Optional[Set]]] = {}
+        self._by_value: Dict[str, Dict[Any, Set[Hashable]]] = {field: {} for field in FILTER_FIELDS.values()}
+        self._wildcard: Dict[str, Set[Hashable]] = {field: set() for field in FILTER_FIELDS.values()}
+    
+    def __len__(self) -> int:
+        return len(self._filters)
+    
+    def add(self, subscriber: Hashable, filters: Optional[Dict[str, Optional[Set]]] = None):
+        """加入或更新訂閱者；filters 為 None 表示接收所有事件"""
+        self.remove(subscriber)
+        filters = filters or {field: None for field in FILTER_FIELDS.values()}
+        self._filters[subscriber] = filters
+        for field, values in filters.items():
+            if values is None:
+                self._wildcard[field].add(subscriber)
+            else:
+                index = self._by_value[field]
+                for value in values:
+                    index.setdefault(value, set()).add(subscriber)
+    
+    def remove(self, subscriber: Hashable):
+        filters = self._filters.pop(subscriber, None)
+        if filters is None:
+            return
+        for field, values in filters.items():
+            if values is None:
+                self._wildcard[field].discard(subscriber)
+                continue
+            index = self._by_value[field]
+            for value in values:
+                subscribers = index.get(value)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del index[value]
+    
+    def get_filters(self, subscriber: Hashable) -> Optional[Dict[str, Optional[Set]]]:
+        return self._filters.get(subscriber)
+    
+    def matches(self, subscriber: Hashable, event: Dict[str, Any]) -> bool:
+        """檢查單一訂閱者是否需要此事件"""
+        filters = self._filters.get(subscriber)
+        if filters is None:
+            return False
+        for field, values in filters.items():
+            value = event.get(field)
+            if values is not None and value is not None and value not in values:
+                return False
+        return True
+    
+    def match(self, event: Dict[str, Any]) -> Iterable[Hashable]:
+        """回傳需要此事件的訂閱者"""
+        best: Optional[List[Set[Hashable]]] = None
+        best_size = None
+        for field in FILTER_FIELDS.values():
+            value = event.get(field)
+            if value is None:
+                continue
+            candidates = [self._by_value[field].get(value, set()), self._wildcard[field]]
+            size = len(candidates[0]) + len(candidates[1])
+            if best_size is None or size < best_size:
+                best, best_size = candidates, size
+        
+        if best is None:
+            # 事件沒有任何可過濾的欄位，送給所有訂閱者
+            return list(self._filters)
+        
+        result = []
+        for group in best:
+            for subscriber in group:
+                if self.matches(subscriber, event):
+                    result.append(subscriber)
+        return result
@@ -1,36 +1,95 @@
 import asyncio
 import logging
-from typing import Optional
+import time
+from typing import Deque, Dict, List, Optional, Set
 from datetime import datetime
-from .config import DISCORD_CHANNEL_ID
+from .config import DISCORD_CHANNEL_ID, SENDER_CONCURRENCY, SENDER_COALESCE, SENDER_COALESCE_WINDOW
 from .bot import DiscordBot
+from .outbound import OutboundQueue
+from .ratelimit import REQUEST_OWNER
+from .priority import PRIORITIES, ReadyQueue, WeightedFairQueue, message_priority
+from .tickets import DeliveryTickets
+from . import metrics
 import discord
 
 logger = logging.getLogger(__name__)
 
+# Discord 單則訊息限制
+MAX_CONTENT_LENGTH = 2000
+MAX_EMBEDS = 10
+MAX_EMBED_TOTAL_LENGTH = 6000
+
+# Discord 錯誤代碼：頻道不存在
+UNKNOWN_CHANNEL = 10003
+
+# worker 發生非預期錯誤後，頻道重新排程前等待的秒數
+WORKER_ERROR_RETRY_DELAY = 1
+
+def _batch_tickets(batch: List[dict]) -> List[str]:
+    """batch 中各訊息的投遞票證"""
+    return [item["ticket"] for item in batch if "ticket" in item]
+
 class DiscordSenderTask:
-    def __init__(self, message_queue: asyncio.Queue, discord_bot: DiscordBot):
+    def __init__(
+        self,
+        message_queue: OutboundQueue,
+        discord_bot: DiscordBot,
+        concurrency: int = SENDER_CONCURRENCY,
+        coalesce: bool = SENDER_COALESCE,
+        coalesce_window: float = SENDER_COALESCE_WINDOW,
+        tickets: Optional[DeliveryTickets] = None,
+    ):
         self.message_queue = message_queue
         self.discord_bot = discord_bot
+        self.tickets = tickets
+        self.concurrency = concurrency
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
         self.running = False
+        
+        # 每個頻道一條待發送佇列，同頻道同優先等級的訊息維持順序，不同等級依權重輪流發送
+        self._lanes: Dict[int, WeightedFairQueue] = {}
+        # 有待發送訊息且目前沒有 worker 處理中的頻道，依頻道下一則訊息的優先等級排程
+        self._ready = ReadyQueue()
+        # 因限流暫緩的頻道與其重新排入的計時器
+        self._deferred: Dict[int, asyncio.TimerHandle] = {}
+        # 所屬分片尚未就緒而暫停的頻道（分片 ID -> 頻道），分片就緒後才排入就緒佇列
+        self._parked: Dict[Optional[int], Set[int]] = {}
+        self._workers: List[asyncio.Task] = []
+        # 發送中的頻道 -> 收到回應時設定的事件；發送中的任務
+        self._inflight: Dict[int, asyncio.Event] = {}
+        self._deliveries: Set[asyncio.Task] = set()
+        # Gateway 是否可用（任一分片就緒）；未就緒時訊息留在佇列中，不取出
+        self._gateway_ready = asyncio.Event()
+        self._outage_started: Optional[float] = time.monotonic()
+        
+        # drop_oldest 溢出時由頻道佇列中最舊的訊息開始丟棄
+        self.message_queue.set_evictor(self.get_pending_count, self._evict_oldest)
+        
+        if self.discord_bot:
+            if self.discord_bot.is_ready_flag:
+                self._gateway_ready.set()
+                self._outage_started = None
+            self.discord_bot.add_shard_listener(self._on_shard_state)
+            self.discord_bot.rate_limits.add_listener(self._on_response)
     
     async def start(self):
         """啟動訊息發送任務"""
         self.running = True
-        logger.info("Discord 訊息發送任務已啟動")
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(self.concurrency)
+        ]
+        logger.info(f"Discord 訊息發送任務已啟動，並行頻道數: {self.concurrency}")
         
         while self.running:
             try:
+                # Gateway 未就緒時不取出訊息，佇列維持原順序；恢復後全速排出，由各頻道的限流狀態控制速率
+                await self._gateway_ready.wait()
+                
                 # 等待訊息
                 message_data = await self.message_queue.get()
-                
-                if self.discord_bot and self.discord_bot.is_ready_flag:
-                    await self._send_message(message_data)
-                else:
-                    # Bot 未準備好，將訊息放回佇列
-                    await asyncio.sleep(1)
-                    await self.message_queue.put(message_data)
-                    
+                self._dispatch(message_data)
+            
             except asyncio.CancelledError:
                 logger.info("Discord 發送任務已取消")
                 break
@@ -41,50 +100,324 @@ class DiscordSenderTask:
     async def stop(self):
         """停止訊息發送任務"""
         self.running = False
+        for task in [*self._workers, *self._deliveries]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._deliveries, return_exceptions=True)
+        self._workers = []
+        for handle in self._deferred.values():
+            handle.cancel()
+        self._deferred.clear()
         logger.info("Discord 訊息發送任務已停止")
     
-    async def _send_message(self, message_data: dict):
-        """發送訊息到 Discord"""
+    def _dispatch(self, message_data: dict):
+        """依頻道分派訊息；頻道沒有待發送訊息時才排入就緒佇列"""
+        channel_id = message_data.get("channel_id") or DISCORD_CHANNEL_ID
+        lane = self._lanes.get(channel_id)
+        if lane is None:
+            lane = self._lanes[channel_id] = WeightedFairQueue()
+            lane.append(message_priority(message_data), message_data)
+            self._schedule(channel_id)
+        else:
+            # 頻道已在就緒佇列或正由 worker 處理，worker 會接續處理
+            lane.append(message_priority(message_data), message_data)
+            if channel_id in self._ready:
+                # 仍在就緒佇列中等待的頻道，依新的下一則訊息提升排程等級
+                self._ready.put_nowait(lane.next_priority(), channel_id)
+    
+    async def _worker(self, worker_id: int):
+        """取出一個就緒頻道並發送其下一則訊息；同一時間每個頻道只有一則發送中的請求"""
+        while True:
+            channel_id = await self._ready.get()
+            # 已從頻道佇列取出、尚未交給發送任務的訊息
+            batch: List[dict] = []
+            try:
+                if self._park_if_unready(channel_id):
+                    # 排入後所屬分片才斷線，等待分片恢復
+                    continue
+                delay = self.discord_bot.rate_limits.delay(channel_id)
+                if delay > 0:
+                    # 已知此頻道的 bucket 已用完，重置後再排入，期間 worker 處理其他頻道
+                    self._defer(channel_id, delay)
+                    continue
+                
+                lane = self._lanes[channel_id]
+                priority, message_data = lane.popleft()
+                batch.append(message_data)
+                if self.coalesce:
+                    await self._coalesce(lane, priority, batch)
+                
+                # 收到 Discord 回應（或發送結束）即釋放 worker：discord.py 在 bucket 用完後會在請求內預先等待重置，
+                # 這段等待只延後此頻道的下一則訊息，不佔用 worker
+                released = asyncio.Event()
+                self._inflight[channel_id] = released
+                delivery = asyncio.create_task(self._deliver(channel_id, lane, batch, released))
+                batch = []
+                self._deliveries.add(delivery)
+                delivery.add_done_callback(self._deliveries.discard)
+                await released.wait()
+            except Exception:
+                logger.exception(f"發送 worker {worker_id} 處理頻道 {channel_id} 時發生錯誤")
+                self._recover(channel_id, batch)
+    
+    def _recover(self, channel_id: int, batch: List[dict]):
+        """worker 發生錯誤後放回未發送的訊息，稍後重新排程頻道，避免頻道脫離就緒佇列"""
+        lane = self._lanes.get(channel_id)
+        if lane is None:
+            return
+        for message_data in reversed(batch):
+            lane.appendleft(message_priority(message_data), message_data)
+        lane.recount()
+        if lane and channel_id not in self._inflight and not self._is_waiting(channel_id):
+            self._deferred[channel_id] = asyncio.get_running_loop().call_later(
+                WORKER_ERROR_RETRY_DELAY, self._resume_deferred, channel_id
+            )
+    
+    async def _deliver(self, channel_id: int, lane: WeightedFairQueue, batch: List[dict], released: asyncio.Event):
+        """發送一批訊息並確認，完成後再排程頻道的下一批"""
+        # 標記此 task 發出的請求，只有自己的發送回應才釋放 worker
+        REQUEST_OWNER.set(released)
+        try:
+            # 關閉時被取消的訊息不確認，持久化佇列會在重啟後重送
+            await self._send_message(batch)
+        except discord.RateLimited as e:
+            # 限流等待超過 SENDER_MAX_RATELIMIT_WAIT：訊息放回頻道佇列最前面，重置後依序重送
+            for message_data in reversed(batch):
+                lane.appendleft(message_priority(message_data), message_data)
+            self._defer(channel_id, e.retry_after)
+            return
+        finally:
+            self._inflight.pop(channel_id).set()
+        
+        for message_data in batch:
+            self.message_queue.task_done(message_data)
+        if lane:
+            self._schedule(channel_id)
+        else:
+            del self._lanes[channel_id]
+    
+    def _on_response(self, channel_id: Optional[int], status: int, owner):
+        """發送任務自己的發送訊息請求（POST /channels/{id}/messages）已收到回應，釋放處理中的 worker；
+        同頻道的命令回覆等其他請求不會釋放"""
+        released = self._inflight.get(channel_id)
+        if released is not None and owner is released:
+            released.set()
+    
+    def _defer(self, channel_id: int, delay: float):
+        """頻道暫停 delay 秒後再排程"""
+        metrics.SEND_DEFERRED.inc()
+        self._deferred[channel_id] = asyncio.get_running_loop().call_later(delay, self._resume_deferred, channel_id)
+    
+    def _resume_deferred(self, channel_id: int):
+        self._deferred.pop(channel_id, None)
+        self._schedule(channel_id)
+    
+    def _schedule(self, channel_id: int):
+        """頻道所屬分片已就緒時排入就緒佇列，否則暫停到分片恢復為止，不影響其他分片的頻道"""
+        if not self._park_if_unready(channel_id):
+            self._mark_ready(channel_id)
+    
+    def _park_if_unready(self, channel_id: int) -> bool:
+        shard_id = self.discord_bot.shard_for_channel(channel_id)
+        if self.discord_bot.is_shard_ready(shard_id):
+            return False
+        self._parked.setdefault(shard_id, set()).add(channel_id)
+        return True
+    
+    def _on_shard_state(self, shard_id: int, ready: bool):
+        """分片就緒時恢復其暫停的頻道（無法判斷分片的頻道在所有分片就緒時恢復）"""
+        self._update_gateway_ready()
+        if not ready:
+            return
+        for key in (shard_id, None):
+            if self.discord_bot.is_shard_ready(key):
+                for channel_id in self._parked.pop(key, ()):
+                    self._mark_ready(channel_id)
+    
+    def _update_gateway_ready(self):
+        """依 Bot 的就緒狀態開關取出訊息的閘門，並記錄中斷期間累積的訊息數"""
+        if self.discord_bot.is_ready_flag:
+            if self._gateway_ready.is_set():
+                return
+            backlog = self.get_outage_backlog()
+            duration = time.monotonic() - self._outage_started
+            self._outage_started = None
+            self._gateway_ready.set()
+            metrics.SEND_LAST_OUTAGE_SECONDS.set(duration)
+            metrics.SEND_LAST_OUTAGE_BACKLOG.set(backlog)
+            logger.info(f"Gateway 已就緒（等待 {duration:.1f} 秒），開始發送累積的 {backlog} 則訊息")
+        elif self._gateway_ready.is_set():
+            self._gateway_ready.clear()
+            self._outage_started = time.monotonic()
+            logger.warning("Gateway 未就緒，暫停取出待發送訊息")
+    
+    def get_outage_backlog(self) -> int:
+        """因 Gateway 或所屬分片未就緒而等待發送的訊息數"""
+        parked = sum(self.get_parked_counts().values())
+        if self._gateway_ready.is_set():
+            return parked
+        return self.message_queue.qsize() + parked
+    
+    def _mark_ready(self, channel_id: int):
+        self._ready.put_nowait(self._lanes[channel_id].next_priority(), channel_id)
+    
+    def get_parked_counts(self) -> Dict[Optional[int], int]:
+        """各分片因未就緒而暫停的訊息數"""
+        return {
+            shard_id: sum(len(self._lanes[channel_id]) for channel_id in channels)
+            for shard_id, channels in self._parked.items()
+        }
+    
+    async def _coalesce(self, lane: WeightedFairQueue, priority: str, batch: List[dict]):
+        """將同頻道同優先等級連續的純文字（或 Embed）訊息合併進 batch，不超過 Discord 單則訊息限制"""
+        if not lane and self.coalesce_window > 0:
+            # 等待短暫時間讓後續訊息進入頻道佇列
+            await asyncio.sleep(self.coalesce_window)
+        
+        self._merge(lane.queue(priority), batch)
+        lane.recount()
+    
+    def _merge(self, lane: Deque[dict], batch: List[dict]):
+        first = batch[0]
+        if first.get("embed"):
+            total = len(discord.Embed.from_dict(first["embed"]))
+            while lane and lane[0].get("embed") and len(batch) < MAX_EMBEDS:
+                size = len(discord.Embed.from_dict(lane[0]["embed"]))
+                if total + size > MAX_EMBED_TOTAL_LENGTH:
+                    break
+                total += size
+                batch.append(lane.popleft())
+        else:
+            length = len(first["content"])
+            while lane and not lane[0].get("embed"):
+                # 以換行串接
+                new_length = length + 1 + len(lane[0]["content"])
+                if new_length > MAX_CONTENT_LENGTH:
+                    break
+                length = new_length
+                batch.append(lane.popleft())
+    
+    def _evict_oldest(self, count: int) -> List[dict]:
+        """從頻道佇列移出最早加入的 count 則尚未發送訊息（發送中的訊息不受影響）"""
+        evicted = []
+        while len(evicted) < count:
+            oldest = None
+            for channel_id, lane in self._lanes.items():
+                for priority in PRIORITIES:
+                    queue = lane.queue(priority)
+                    if queue and (oldest is None or queue[0].get("enqueued_at", 0) < oldest[0]):
+                        oldest = (queue[0].get("enqueued_at", 0), channel_id, priority)
+            if oldest is None:
+                break
+            _, channel_id, priority = oldest
+            lane = self._lanes[channel_id]
+            evicted.append(lane.queue(priority).popleft())
+            lane.recount()
+            if not lane and self._is_waiting(channel_id):
+                # 沒有 worker 處理中的頻道直接移除；處理中的頻道由 _deliver 完成後移除
+                self._forget(channel_id)
+        return evicted
+    
+    def _is_waiting(self, channel_id: int) -> bool:
+        """頻道在就緒佇列中、因限流暫緩或因分片未就緒而暫停"""
+        return (
+            channel_id in self._ready
+            or channel_id in self._deferred
+            or any(channel_id in channels for channels in self._parked.values())
+        )
+    
+    def _forget(self, channel_id: int):
+        del self._lanes[channel_id]
+        self._ready.discard(channel_id)
+        handle = self._deferred.pop(channel_id, None)
+        if handle is not None:
+            handle.cancel()
+        for channels in self._parked.values():
+            channels.discard(channel_id)
+    
+    def get_pending_count(self) -> int:
+        """取得已從佇列取出但尚未發送的訊息數"""
+        return sum(len(lane) for lane in self._lanes.values())
+    
+    async def _send_message(self, batch: List[dict]):
+        """發送訊息到 Discord（batch 為同頻道合併後的一則或多則訊息）"""
         try:
             # 取得頻道
+            message_data = batch[0]
             channel_id = message_data.get("channel_id", DISCORD_CHANNEL_ID)
-            channel = self.discord_bot.get_channel(channel_id)
+            channel = await self.discord_bot.channels.resolve(channel_id)
             
             if not channel:
                 error_msg = f"找不到頻道 ID: {channel_id}"
-                logger.error(error_msg)
+                logger.error(error_msg, extra={"event": "channel_not_found", "channel_id": channel_id})
+                metrics.SEND_TOTAL.inc(len(batch), channel_id=channel_id, outcome="error", error="ChannelNotFound")
+                self._fail_tickets(batch, channel_id, error_msg)
                 await self.discord_bot.broadcast_websocket({
                     "type": "error",
                     "message": error_msg,
+                    "channel_id": channel_id,
+                    "tickets": _batch_tickets(batch),
                     "timestamp": datetime.now().isoformat()
                 })
                 return
             
             # 發送訊息
+            started = time.perf_counter()
             if message_data.get("embed"):
                 # 發送 Embed
-                embed = discord.Embed.from_dict(message_data["embed"])
-                message = await channel.send(embed=embed)
+                embeds = [discord.Embed.from_dict(item["embed"]) for item in batch]
+                if len(embeds) == 1:
+                    message = await channel.send(embed=embeds[0])
+                else:
+                    message = await channel.send(embeds=embeds)
             else:
                 # 發送純文字
-                message = await channel.send(message_data["content"])
+                message = await channel.send("\n".join(item["content"] for item in batch))
+            metrics.SEND_DURATION.observe(time.perf_counter() - started)
+            
+            now = time.time()
+            for item in batch:
+                if "enqueued_at" in item:
+                    metrics.SEND_QUEUE_LATENCY.observe(now - item["enqueued_at"], priority=message_priority(item))
+            metrics.SEND_TOTAL.inc(len(batch), channel_id=channel_id, outcome="success")
+            if self.tickets:
+                for ticket in _batch_tickets(batch):
+                    self.tickets.resolve(ticket, message.id, channel.id)
             
             # 廣播成功訊息
             success_msg = {
                 "type": "success",
                 "message": f"訊息已發送到頻道 {channel.name}",
+                "guild_id": channel.guild.id if getattr(channel, "guild", None) else None,
+                "channel_id": channel.id,
                 "message_id": message.id,
+                "merged_count": len(batch),
+                "tickets": _batch_tickets(batch),
                 "timestamp": datetime.now().isoformat()
             }
             await self.discord_bot.broadcast_websocket(success_msg)
             
-            logger.info(f"訊息已發送: {message.id}")
-            
+            logger.info("訊息已發送: %s", message.id, extra={"event": "send", "channel_id": channel.id, "merged_count": len(batch)})
+        
+        except discord.RateLimited:
+            # 交由 worker 暫緩後重送
+            raise
         except Exception as e:
+            if isinstance(e, discord.NotFound) and e.code == UNKNOWN_CHANNEL:
+                # 以 API 取得後才被刪除的頻道：之後的訊息直接判定不存在
+                self.discord_bot.channels.invalidate(batch[0].get("channel_id"))
             error_msg = f"發送訊息失敗: {str(e)}"
             logger.error(error_msg)
+            metrics.SEND_TOTAL.inc(len(batch), channel_id=batch[0].get("channel_id"), outcome="error", error=type(e).__name__)
+            self._fail_tickets(batch, batch[0].get("channel_id"), error_msg)
             await self.discord_bot.broadcast_websocket({
                 "type": "error",
                 "message": error_msg,
+                "channel_id": batch[0].get("channel_id"),
+                "tickets": _batch_tickets(batch),
                 "timestamp": datetime.now().isoformat()
             })
+    
+    def _fail_tickets(self, batch: List[dict], channel_id: int, error: str):
+        if self.tickets:
+            for ticket in _batch_tickets(batch):
+                self.tickets.fail(ticket, channel_id, error)
@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+
+from ..aggregation import EventAggregator
+
+class EventAggregatorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.emitted = []
+        
+        async def emit(data):
+            self.emitted.append(data)
+        
+        self.aggregator = EventAggregator(emit, kinds=("reaction",), window=0.05, max_delay=0.2)
+    
+    async def asyncTearDown(self):
+        await self.aggregator.close()
+    
+    async def test_summarizes_events_per_key(self):
+        for user in ("a", "b", "c"):
+            self.aggregator.add("reaction", 1, {"user": user}, {"key": 1}, user)
+        self.aggregator.add("reaction", 2, {"user": "d"}, {"key": 2}, "d")
+        await asyncio.sleep(0.15)
+        
+        self.assertEqual(len(self.emitted), 2)
+        summary = next(data for data in self.emitted if data.get("key") == 1)
+        self.assertEqual(summary["count"], 3)
+        self.assertEqual(summary["users"], ["a", "b", "c"])
+        self.assertIn({"user": "d"}, self.emitted)
+    
+    async def test_extends_deadline_until_max_delay(self):
+        # 每 0.02 秒一個事件，視窗不會結束，到 max_delay 時送出
+        for _ in range(15):
+            self.aggregator.add("reaction", 1, {}, {"key": 1})
+            await asyncio.sleep(0.02)
+        
+        self.assertEqual(len(self.emitted), 1)
+        self.assertGreaterEqual(self.emitted[0]["count"], 8)
+    
+    async def test_many_distinct_keys(self):
+        for key in range(5000):
+            self.aggregator.add("reaction", key, {"key": key}, {"key": key})
+        await asyncio.sleep(0.2)
+        
+        self.assertEqual(len(self.emitted), 5000)
+        self.assertEqual(self.aggregator.pending_count(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+from unittest import mock
+
+from ..bot import DiscordBot
+from ..websocket_manager import WebSocketManager
+
+class CacheCountsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = DiscordBot(WebSocketManager())
+    
+    async def asyncTearDown(self):
+        await self.bot.close()
+    
+    async def test_reuses_counts_within_max_age(self):
+        with mock.patch.object(self.bot, "_count_caches", wraps=self.bot._count_caches) as count:
+            first = self.bot.cache_counts(max_age=60)
+            self.assertIs(self.bot.cache_counts(max_age=60), first)
+            self.bot.cache_counts()
+        self.assertEqual(count.call_count, 2)
+    
+    async def test_counts_without_guilds(self):
+        counts = self.bot.cache_counts()
+        self.assertEqual(counts["guilds"], 0)
+        self.assertEqual(counts["voice_states"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
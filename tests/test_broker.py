@@ -0,0 +1,91 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from types import SimpleNamespace
+
+from ..broker import BrokerForwardMiddleware, BrokerServer
+
+class StubWebSocketManager:
+    def add_listener(self, listener):
+        pass
+
+class SlowWorkerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = BrokerServer(None, StubWebSocketManager(), path=os.path.join(self.tmpdir.name, "broker.sock"), max_queue=10)
+        await self.server.start()
+    
+    async def asyncTearDown(self):
+        await self.server.close()
+        self.tmpdir.cleanup()
+    
+    async def _wait_for_workers(self, count: int):
+        for _ in range(100):
+            if len(self.server._workers) == count:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f"工作程序數未變為 {count}")
+    
+    async def test_disconnects_stalled_worker(self):
+        # 連線後不讀取的工作程序
+        reader, writer = await asyncio.open_unix_connection(self.server.path)
+        await self._wait_for_workers(1)
+        worker = next(iter(self.server._workers))
+        
+        self.server.publish({}, "x" * (8 * 1024 * 1024))
+        await asyncio.sleep(0.05)
+        for _ in range(self.server.max_queue + 1):
+            self.server.publish({}, "{}")
+        
+        self.assertTrue(worker.closing)
+        await self._wait_for_workers(0)
+        writer.close()
+    
+    async def test_delivers_events_in_order(self):
+        reader, writer = await asyncio.open_unix_connection(self.server.path)
+        await self._wait_for_workers(1)
+        
+        for seq in range(1, 31):
+            self.server.publish({}, f'{{"seq":{seq}}}')
+            await asyncio.sleep(0)
+        lines = [await asyncio.wait_for(reader.readline(), 1) for _ in range(30)]
+        
+        self.assertEqual(lines[0], b'{"op":"event","data":{"seq":1}}\n')
+        self.assertEqual(lines[-1], b'{"op":"event","data":{"seq":30}}\n')
+        self.assertEqual(len(self.server._workers), 1)
+        writer.close()
+
+class ForwardMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+    async def _call(self, path: str) -> list:
+        """回傳處理請求的對象：local 或 owner"""
+        handled = []
+        
+        async def app(scope, receive, send):
+            handled.append("local")
+        
+        async def request(frame):
+            handled.append("owner")
+            return {"status": 200, "headers": [], "body": ""}
+        
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        
+        async def send(message):
+            pass
+        
+        state = SimpleNamespace(broker_client=SimpleNamespace(request=request))
+        scope = {"type": "http", "app": SimpleNamespace(state=state), "method": "GET", "path": path, "headers": []}
+        await BrokerForwardMiddleware(app)(scope, receive, send)
+        return handled
+    
+    async def test_serves_connection_introspection_locally(self):
+        self.assertEqual(await self._call("/api/v1/health"), ["local"])
+        self.assertEqual(await self._call("/api/v1/websocket/connections"), ["local"])
+    
+    async def test_forwards_other_routes(self):
+        self.assertEqual(await self._call("/api/v1/status"), ["owner"])
+
+if __name__ == "__main__":
+    unittest.main()
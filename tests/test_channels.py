@@ -0,0 +1,34 @@
+import unittest
+from types import SimpleNamespace
+
+import discord
+
+from ..channels import ChannelResolver
+
+class ForbiddenBot:
+    """Gateway 快取沒有、API 回應 403 的 Bot"""
+    def __init__(self):
+        self.fetches = 0
+    
+    def get_channel(self, channel_id):
+        return None
+    
+    async def fetch_channel(self, channel_id):
+        self.fetches += 1
+        raise discord.Forbidden(SimpleNamespace(status=403, reason="Forbidden"), {"code": 50001, "message": "Missing Access"})
+
+class ChannelResolverTest(unittest.IsolatedAsyncioTestCase):
+    async def test_negative_caches_forbidden_channels(self):
+        bot = ForbiddenBot()
+        resolver = ChannelResolver(bot)
+        
+        for _ in range(3):
+            self.assertIsNone(await resolver.resolve(1))
+        
+        self.assertEqual(bot.fetches, 1)
+        stats = resolver.stats()
+        self.assertEqual(stats["sources"]["forbidden"], 1)
+        self.assertEqual(stats["sources"]["negative"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from ..outbound import OutboundQueue, QueueFullError
+from ..tasks import DiscordSenderTask
+from ..tickets import DeliveryTickets
+
+class FakeBot:
+    """只提供發送任務排程所需介面的 Bot（所有分片皆已就緒）"""
+    is_ready_flag = True
+    
+    def __init__(self):
+        self.rate_limits = SimpleNamespace(add_listener=lambda listener: None, delay=lambda channel_id: 0)
+    
+    def add_shard_listener(self, listener):
+        pass
+    
+    def shard_for_channel(self, channel_id):
+        return 0
+    
+    def is_shard_ready(self, shard_id):
+        return True
+
+def _message(channel_id: int, content: str) -> dict:
+    return {"channel_id": channel_id, "content": content}
+
+class DropOldestTest(unittest.IsolatedAsyncioTestCase):
+    async def test_drops_from_sender_lanes_when_queue_drained(self):
+        queue = OutboundQueue(maxsize=3, overflow="drop_oldest")
+        sender = DiscordSenderTask(queue, FakeBot(), concurrency=1)
+        for index, channel_id in enumerate((1, 2, 1)):
+            await queue.put(_message(channel_id, f"m{index}"))
+        for _ in range(3):
+            sender._dispatch(await queue.get())
+        
+        await queue.put(_message(2, "m3"))
+        
+        self.assertEqual(queue.dropped_count, 1)
+        self.assertEqual(queue.pending_count(), 3)
+        self.assertEqual(sender.get_pending_count(), 2)
+        self.assertEqual([item["content"] for item in sender._lanes[1].queue("normal")], ["m2"])
+    
+    async def test_removes_emptied_waiting_channel(self):
+        queue = OutboundQueue(maxsize=1, overflow="drop_oldest")
+        sender = DiscordSenderTask(queue, FakeBot(), concurrency=1)
+        await queue.put(_message(1, "m0"))
+        sender._dispatch(await queue.get())
+        
+        await queue.put(_message(2, "m1"))
+        
+        self.assertNotIn(1, sender._lanes)
+        self.assertNotIn(1, sender._ready)
+        self.assertEqual(queue.qsize(), 1)
+    
+    async def test_rejects_without_evictable_messages(self):
+        queue = OutboundQueue(maxsize=1, overflow="drop_oldest")
+        await queue.put(_message(1, "m0"))
+        await queue.get()
+        
+        with self.assertRaises(QueueFullError):
+            await queue.put(_message(1, "m1"))
+        self.assertEqual(queue.dropped_count, 0)
+    
+    async def test_fails_ticket_of_dropped_message(self):
+        tickets = DeliveryTickets()
+        queue = OutboundQueue(maxsize=1, overflow="drop_oldest", tickets=tickets)
+        message = _message(1, "m0")
+        message["ticket"] = tickets.create(1, "normal")
+        await queue.put(message)
+        waiter = asyncio.create_task(tickets.wait(message["ticket"], timeout=5))
+        await asyncio.sleep(0)
+        
+        await queue.put(_message(1, "m1"))
+        
+        record = await waiter
+        self.assertEqual(record["status"], "failed")
+        self.assertEqual(record["error"], "dropped")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import asyncio
+import unittest
+
+from ..ratelimit import REQUEST_OWNER, RateLimitTracker
+
+CHANNEL_ID = 200000000000000001
+
+class ResponseListenerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tracker = RateLimitTracker()
+        self.responses = []
+        self.tracker.add_listener(lambda major_id, status, owner: self.responses.append((major_id, status, owner)))
+    
+    async def test_notifies_message_create_responses(self):
+        self.tracker.update("POST", f"/api/v10/channels/{CHANNEL_ID}/messages", 200, {})
+        self.assertEqual(self.responses, [(CHANNEL_ID, 200, None)])
+    
+    async def test_ignores_other_requests_on_the_channel(self):
+        self.tracker.update("GET", f"/api/v10/channels/{CHANNEL_ID}", 200, {})
+        self.tracker.update("PUT", f"/api/v10/channels/{CHANNEL_ID}/messages/{CHANNEL_ID}/reactions/x/@me", 204, {})
+        self.assertEqual(self.responses, [])
+    
+    async def test_reports_owner_of_the_request_task(self):
+        async def request(owner):
+            REQUEST_OWNER.set(owner)
+            self.tracker.update("POST", f"/api/v10/channels/{CHANNEL_ID}/messages", 200, {})
+        
+        await asyncio.create_task(request("delivery"))
+        self.tracker.update("POST", f"/api/v10/channels/{CHANNEL_ID}/messages", 200, {})
+        
+        self.assertEqual([owner for _, _, owner in self.responses], ["delivery", None])
+
+if __name__ == "__main__":
+    unittest.main()
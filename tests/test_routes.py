@@ -0,0 +1,52 @@
+import unittest
+
+from fastapi import HTTPException
+
+from .. import routes
+from ..idempotency import IdempotencyCache
+from ..models import MessagePayload
+from ..outbound import OutboundQueue
+from ..tickets import DeliveryTickets
+
+class BatchIdempotencyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.queue = OutboundQueue(maxsize=10)
+        routes.set_globals(self.queue, None, None, IdempotencyCache(), DeliveryTickets())
+    
+    async def asyncTearDown(self):
+        routes.set_globals(None, None, None)
+    
+    async def test_retried_batch_is_not_enqueued_twice(self):
+        batch = [
+            MessagePayload(content="a", channel_id=1, idempotency_key="a"),
+            MessagePayload(content="b", channel_id=1),
+        ]
+        first = await routes.send_messages(batch)
+        retry = await routes.send_messages(batch)
+        
+        self.assertEqual(self.queue.qsize(), 3)
+        self.assertEqual(retry.replayed, 1)
+        self.assertEqual(retry.tickets[0], first.tickets[0])
+        self.assertNotEqual(retry.tickets[1], first.tickets[1])
+    
+    async def test_key_shared_with_single_send(self):
+        payload = MessagePayload(content="a", channel_id=1, idempotency_key="a")
+        batch = await routes.send_messages([payload])
+        response, replayed = await routes._accept_message(payload, None)
+        
+        self.assertTrue(replayed)
+        self.assertEqual(response.ticket, batch.tickets[0])
+        self.assertEqual(self.queue.qsize(), 1)
+    
+    async def test_rejects_duplicate_keys_in_batch(self):
+        batch = [
+            MessagePayload(content="a", channel_id=1, idempotency_key="a"),
+            MessagePayload(content="b", channel_id=1, idempotency_key="a"),
+        ]
+        with self.assertRaises(HTTPException) as raised:
+            await routes.send_messages(batch)
+        self.assertEqual(raised.exception.status_code, 422)
+        self.assertEqual(self.queue.qsize(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from .. import tasks
+from ..outbound import OutboundQueue
+from ..tasks import DiscordSenderTask
+from .test_outbound import FakeBot, _message
+
+class SenderWorkerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bot = FakeBot()
+        self.queue = OutboundQueue(maxsize=10)
+        self.sender = DiscordSenderTask(self.queue, self.bot, concurrency=1)
+        self.sent = []
+        
+        async def send_message(batch):
+            self.sent.extend(item["content"] for item in batch)
+        
+        self.sender._send_message = send_message
+    
+    async def asyncTearDown(self):
+        await self.sender.stop()
+    
+    async def test_worker_survives_unexpected_error(self):
+        calls = []
+        
+        def delay(channel_id):
+            calls.append(channel_id)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+            return 0
+        
+        self.bot.rate_limits.delay = delay
+        with mock.patch.object(tasks, "WORKER_ERROR_RETRY_DELAY", 0.01), self.assertLogs(tasks.logger, "ERROR"):
+            asyncio.create_task(self.sender.start())
+            await self.queue.put(_message(1, "m0"))
+            await self.queue.put(_message(2, "m1"))
+            for _ in range(50):
+                if len(self.sent) == 2:
+                    break
+                await asyncio.sleep(0.01)
+        
+        self.assertEqual(sorted(self.sent), ["m0", "m1"])
+        self.assertEqual(self.queue.pending_count(), 0)
+    
+    async def test_restores_batch_when_coalescing_fails(self):
+        self.sender.coalesce = True
+        failures = []
+        
+        async def coalesce(lane, priority, batch):
+            if not failures:
+                failures.append(batch[0]["content"])
+                raise RuntimeError("boom")
+        
+        self.sender._coalesce = coalesce
+        with mock.patch.object(tasks, "WORKER_ERROR_RETRY_DELAY", 0.01), self.assertLogs(tasks.logger, "ERROR"):
+            asyncio.create_task(self.sender.start())
+            await self.queue.put(_message(1, "m0"))
+            for _ in range(50):
+                if self.sent:
+                    break
+                await asyncio.sleep(0.01)
+        
+        self.assertEqual(failures, ["m0"])
+        self.assertEqual(self.sent, ["m0"])
+    
+    async def test_releases_worker_only_on_own_response(self):
+        released = asyncio.Event()
+        self.sender._inflight[1] = released
+        
+        # 同頻道的其他發送（例如命令回覆）
+        self.sender._on_response(1, 200, None)
+        self.assertFalse(released.is_set())
+        
+        self.sender._on_response(1, 200, released)
+        self.assertTrue(released.is_set())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import unittest
+from unittest import mock
+
+from .. import websocket_manager
+from ..websocket_manager import EventHistory, WebSocketManager
+
+class RecordingClient:
+    """記錄補送訊框的客戶端"""
+    def __init__(self):
+        self.encoding = "json"
+        self.can_send = False
+        self.frames = []
+    
+    def enqueue(self, frame, force=False):
+        self.frames.append(frame)
+        return True
+
+def _event(seq: int) -> dict:
+    return {"type": "event", "seq": seq}
+
+class EventHistoryTest(unittest.TestCase):
+    def test_since_with_gaps(self):
+        history = EventHistory(max_events=10, max_bytes=10_000)
+        for seq in (3, 4, 7, 10):
+            history.append(seq, _event(seq), 10)
+        
+        self.assertEqual([event["seq"] for event in history.since(4)], [7, 10])
+        self.assertEqual([event["seq"] for event in history.since(5)], [7, 10])
+        self.assertEqual([event["seq"] for event in history.since(0)], [3, 4, 7, 10])
+        self.assertEqual(history.since(10), [])
+    
+    def test_restarted_source_clears_history(self):
+        history = EventHistory(max_events=10, max_bytes=10_000)
+        for seq in (5, 6, 1, 2):
+            history.append(seq, _event(seq), 10)
+        
+        self.assertEqual(history.oldest_seq(), 1)
+        self.assertEqual([event["seq"] for event in history.since(0)], [1, 2])
+        self.assertEqual(history.total_bytes, 20)
+
+class ReplayTest(unittest.IsolatedAsyncioTestCase):
+    async def test_resync_when_since_ahead_of_seq(self):
+        manager = WebSocketManager()
+        await manager.broadcast(_event(0))
+        client = RecordingClient()
+        manager.subscriptions.add(client)
+        
+        manager._replay(client, 50)
+        
+        self.assertEqual([frame[0] for frame in client.frames], ["resync"])
+    
+    async def test_publish_after_owner_restart(self):
+        manager = WebSocketManager()
+        for seq in (40, 41):
+            manager.publish(_event(seq))
+        manager.publish(_event(1))
+        client = RecordingClient()
+        manager.subscriptions.add(client)
+        
+        manager._replay(client, 41)
+        
+        self.assertEqual(manager.seq, 1)
+        self.assertEqual([frame[0] for frame in client.frames], ["resync"])
+
+class AuthFrameTest(unittest.TestCase):
+    def _auth(self, token):
+        manager = WebSocketManager()
+        client = RecordingClient()
+        with mock.patch.object(websocket_manager, "API_AUTH_TOKEN", "secret"):
+            manager._handle_auth(client, {"action": "auth", "id": "a1", "token": token})
+        return client, json.loads(client.frames[-1][1])
+    
+    def test_valid_token_grants_send(self):
+        client, reply = self._auth("secret")
+        self.assertTrue(client.can_send)
+        self.assertEqual(reply["type"], "auth")
+        self.assertEqual(reply["id"], "a1")
+    
+    def test_invalid_token_is_rejected(self):
+        client, reply = self._auth("wrong")
+        self.assertFalse(client.can_send)
+        self.assertEqual(reply["type"], "error")
+        self.assertEqual(reply["code"], 401)
+
+if __name__ == "__main__":
+    unittest.main()
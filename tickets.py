@@ -0,0 +1,102 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .config import TICKET_TTL, TICKET_MAX_ENTRIES
+from .cache import TTLCache
+
+class DeliveryTickets:
+    """已接受訊息的投遞票證 -> 發送結果
+    
+    每則加入佇列的訊息取得一個票證，發送任務完成後以 Discord 訊息 ID（或錯誤）更新狀態：
+    queued -> sent / failed（佇列已滿被丟棄時 error 為 dropped）；排程訊息先為 scheduled，到期放入佇列後轉為 queued，取消時為 cancelled。紀錄保存在有上限的 LRU + TTL 快取中，
+    wait() 讓 HTTP 請求等待發送結果而不必另外開 WebSocket。
+    """
+    def __init__(self, maxsize: int = TICKET_MAX_ENTRIES, ttl: float = TICKET_TTL):
+        self._records = TTLCache(maxsize, ttl)
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+    
+    def create(self, channel_id: int, priority: str, send_at: Optional[float] = None) -> str:
+        """建立票證；排程訊息的紀錄保留到發送時間之後再加上 TTL"""
+        ticket = uuid.uuid4().hex
+        ttl = None
+        if send_at is not None:
+            ttl = self._records.ttl + max(send_at - time.time(), 0)
+        self._records.set(ticket, {
+            "ticket": ticket,
+            "status": "scheduled" if send_at is not None else "queued",
+            "channel_id": channel_id,
+            "priority": priority,
+            "send_at": datetime.fromtimestamp(send_at).isoformat() if send_at is not None else None,
+            "message_id": None,
+            "error": None,
+            "created_at": datetime.now().isoformat(),
+            "completed_at": None,
+        }, ttl=ttl)
+        return ticket
+    
+    def get(self, ticket: str) -> Optional[dict]:
+        return self._records.get(ticket)
+    
+    def discard(self, ticket: str):
+        self._records.pop(ticket)
+    
+    def mark_queued(self, ticket: str):
+        """排程訊息已到期並放入發送佇列"""
+        record = self._records.get(ticket, count=False)
+        if record is not None and record["status"] == "scheduled":
+            record["status"] = "queued"
+    
+    def cancel(self, ticket: str):
+        """排程訊息已取消"""
+        self._complete(ticket, "cancelled", None)
+    
+    def resolve(self, ticket: str, message_id: int, channel_id: int):
+        """訊息已發送（合併發送的訊息共用同一個 Discord 訊息 ID）"""
+        self._complete(ticket, "sent", channel_id, message_id=message_id)
+    
+    def fail(self, ticket: str, channel_id: int, error: str):
+        self._complete(ticket, "failed", channel_id, error=error)
+    
+    def drop(self, ticket: str, channel_id: int):
+        """訊息因佇列已滿被 drop_oldest 丟棄"""
+        self._complete(ticket, "failed", channel_id, error="dropped")
+    
+    async def wait(self, ticket: str, timeout: float) -> Optional[dict]:
+        """等待票證完成，逾時時回傳目前（仍為 scheduled / queued）的紀錄"""
+        record = self.get(ticket)
+        if record is None or record["status"] not in ("scheduled", "queued"):
+            return record
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(ticket, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return self.get(ticket)
+        finally:
+            waiters = self._waiters.get(ticket)
+            if waiters is not None and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiters[ticket]
+    
+    def _complete(self, ticket: str, status: str, channel_id: Optional[int], message_id: Optional[int] = None, error: Optional[str] = None):
+        record = self._records.get(ticket, count=False)
+        if record is None:
+            # 重啟前加入持久化佇列的訊息，或紀錄已被淘汰：以結果重新建立
+            record = {"ticket": ticket, "channel_id": channel_id, "priority": None, "send_at": None, "created_at": None}
+        record.update(
+            status=status,
+            message_id=message_id,
+            error=error,
+            completed_at=datetime.now().isoformat(),
+        )
+        self._records.set(ticket, record)
+        for future in self._waiters.pop(ticket, ()):
+            if not future.done():
+                future.set_result(record)
+    
+    def stats(self) -> dict:
+        return {**self._records.stats(), "waiters": sum(len(waiters) for waiters in self._waiters.values())}
@@ -1,69 +1,268 @@
+import asyncio
+import bisect
+import hmac
+import json
 import logging
-from typing import List
-from fastapi import WebSocket, WebSocketDisconnect
+import time
+from collections import deque
+from itertools import islice
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
+from fastapi import WebSocket, WebSocketDisconnect, status
 from datetime import datetime
 
+from .config import (
+    API_AUTH_TOKEN,
+    WS_CLIENT_QUEUE_SIZE,
+    WS_SLOW_CONSUMER_POLICY,
+    WS_SEND_TIMEOUT,
+    WS_REPLAY_BUFFER_SIZE,
+    WS_REPLAY_BUFFER_BYTES,
+)
+from .encoding import available_encodings, encode
+from .subscriptions import SubscriptionIndex, parse_filters
+from . import metrics
+
 logger = logging.getLogger(__name__)
 
+# 待送出訊框：(事件類型, 已編碼內容)，str 為文字訊框、bytes 為二進位訊框
+Frame = Tuple[Optional[str], Union[str, bytes]]
+
+# send 訊框的處理函式：(訊息內容, Idempotency-Key) -> (HTTP 狀態碼, 回應內容)
+SendHandler = Callable[[dict, Optional[str]], Awaitable[Tuple[int, dict]]]
+
+class WebSocketClient:
+    """單一 WebSocket 連線，擁有自己的待送出佇列與寫入任務"""
+    def __init__(self, websocket: WebSocket, max_queue: int, policy: str, encoding: str = "json", can_send: bool = False):
+        self.websocket = websocket
+        self.encoding = encoding
+        self.max_queue = max_queue
+        self.policy = policy
+        self.can_send = can_send
+        self.dropped_count = 0
+        self.closing = False
+        
+        self._queue: Deque[Frame] = deque()
+        self._has_data = asyncio.Event()
+        self._writable = asyncio.Event()
+        self.writer_task: Optional[asyncio.Task] = None
+    
+    def enqueue(self, frame: Frame, force: bool = False) -> bool:
+        """加入已編碼的待送出訊框（不等待）；回傳 False 表示此連線應被斷開
+        
+        force 用於重連補送與 send 訊框的回覆，允許暫時超過佇列上限。
+        """
+        if self.closing:
+            return True
+        if not force and len(self._queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                return False
+            if self.policy == "coalesce":
+                self._coalesce(frame[0])
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.dropped_count += 1
+                metrics.WS_DROPPED_FRAMES.inc()
+        self._queue.append(frame)
+        self._has_data.set()
+        return True
+    
+    def kick(self):
+        """標記連線關閉，由寫入任務負責關閉 WebSocket"""
+        self.closing = True
+        self._queue.clear()
+        self._has_data.set()
+        self._writable.set()
+    
+    async def wait_writable(self):
+        """等待待送出佇列低於上限；ack 訊框不套用慢速策略，改以暫停讀取 send 訊框施加背壓"""
+        while len(self._queue) >= self.max_queue and not self.closing:
+            self._writable.clear()
+            await self._writable.wait()
+    
+    def pending_count(self) -> int:
+        return len(self._queue)
+    
+    def _coalesce(self, message_type: Optional[str]):
+        """同類型的舊訊息只保留最新一則"""
+        kept = deque(frame for frame in self._queue if frame[0] != message_type)
+        self.dropped_count += len(self._queue) - len(kept)
+        metrics.WS_DROPPED_FRAMES.inc(len(self._queue) - len(kept))
+        self._queue = kept
+    
+    async def run_writer(self):
+        """依序送出佇列中的訊息；送出逾時視為停滯"""
+        while True:
+            while not self._queue and not self.closing:
+                self._has_data.clear()
+                await self._has_data.wait()
+            if self.closing:
+                await self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            _, payload = self._queue.popleft()
+            self._writable.set()
+            if isinstance(payload, bytes):
+                send = self.websocket.send_bytes(payload)
+            else:
+                send = self.websocket.send_text(payload)
+            await asyncio.wait_for(send, timeout=WS_SEND_TIMEOUT)
+
+class EventHistory:
+    """固定大小的事件環形緩衝區，供重連的客戶端補送遺漏的事件
+    
+    同時以事件數與估算的記憶體大小（JSON 長度）限制容量，超過時淘汰最舊的事件。
+    序號遞增但不一定連續（多工作程序模式下由 broker 轉送）；序號倒退表示事件來源已重啟，捨棄舊事件。
+    """
+    def __init__(self, max_events: int = WS_REPLAY_BUFFER_SIZE, max_bytes: int = WS_REPLAY_BUFFER_BYTES):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._events: Deque[Tuple[int, dict, int]] = deque()
+        # 與 _events 對應的序號，供二分搜尋
+        self._seqs: Deque[int] = deque()
+    
+    def append(self, seq: int, message: dict, size: int):
+        if self._seqs and seq <= self._seqs[-1]:
+            self.clear()
+        self._events.append((seq, message, size))
+        self._seqs.append(seq)
+        self.total_bytes += size
+        while self._events and (len(self._events) > self.max_events or self.total_bytes > self.max_bytes):
+            _, _, evicted = self._events.popleft()
+            self._seqs.popleft()
+            self.total_bytes -= evicted
+    
+    def clear(self):
+        self._events.clear()
+        self._seqs.clear()
+        self.total_bytes = 0
+    
+    def oldest_seq(self) -> Optional[int]:
+        return self._events[0][0] if self._events else None
+    
+    def since(self, seq: int) -> List[dict]:
+        """取得序號大於 seq 的事件"""
+        if not self._events or seq >= self._seqs[-1]:
+            return []
+        start = bisect.bisect_right(self._seqs, seq)
+        return [message for _, message, _ in islice(self._events, start, None)]
+
 class WebSocketManager:
-    def __init__(self):
-        self.connections: List[WebSocket] = []
+    def __init__(self, max_queue: int = WS_CLIENT_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY):
+        self.max_queue = max_queue
+        self.policy = policy
+        self.clients: Dict[WebSocket, WebSocketClient] = {}
+        self.subscriptions = SubscriptionIndex()
+        self.history = EventHistory()
+        self.dropped_clients = 0
+        self.seq = 0
+        # 處理客戶端 send 訊框（由路由設定；多工作程序模式下轉送給 Gateway 擁有者）
+        self._send_handler: Optional[SendHandler] = None
+        # 廣播事件的額外接收者（例如轉送給其他工作程序），參數為 (事件, JSON 字串)
+        self._listeners: List[Callable[[dict, str], None]] = []
+    
+    def set_send_handler(self, handler: SendHandler):
+        self._send_handler = handler
     
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, can_send: bool = False):
         """接受新的 WebSocket 連線"""
         await websocket.accept()
-        self.connections.append(websocket)
+        
+        # 客戶端可用 ?encoding=msgpack 要求二進位編碼，不支援時退回 JSON
+        encoding = websocket.query_params.get("encoding", "json")
+        if encoding not in available_encodings():
+            encoding = "json"
+        client = WebSocketClient(websocket, self.max_queue, self.policy, encoding, can_send)
+        self.clients[websocket] = client
+        self.subscriptions.add(client)
+        client.writer_task = asyncio.create_task(self._run_client(client))
         
         # 發送連線成功訊息
         await self.send_personal_message(websocket, {
             "type": "connection",
             "message": "WebSocket 連線已建立",
+            "encoding": encoding,
+            "seq": self.seq,
             "timestamp": datetime.now().isoformat()
         })
         
-        logger.info(f"WebSocket 連線已建立，當前連線數: {len(self.connections)}")
+        # 重連時以 ?since=<seq> 補送斷線期間的事件
+        since = websocket.query_params.get("since")
+        if since is not None:
+            try:
+                self._replay(client, int(since))
+            except ValueError:
+                pass
+        
+        logger.info("WebSocket 連線已建立，當前連線數: %d", len(self.clients), extra={"event": "ws_connect"})
     
     def disconnect(self, websocket: WebSocket):
         """移除斷線的 WebSocket 連線"""
-        if websocket in self.connections:
-            self.connections.remove(websocket)
-            logger.info(f"WebSocket 連線已關閉，當前連線數: {len(self.connections)}")
+        client = self.clients.pop(websocket, None)
+        if client:
+            self.subscriptions.remove(client)
+            if client.writer_task and client.writer_task is not asyncio.current_task():
+                client.writer_task.cancel()
+            logger.info("WebSocket 連線已關閉，當前連線數: %d", len(self.clients), extra={"event": "ws_connect"})
     
     async def send_personal_message(self, websocket: WebSocket, message: dict):
         """發送訊息到指定的 WebSocket 連線"""
-        try:
-            await websocket.send_json(message)
-        except Exception as e:
-            logger.error(f"發送個人訊息失敗: {e}")
-            self.disconnect(websocket)
+        client = self.clients.get(websocket)
+        if client and not client.enqueue((message.get("type"), encode(message, client.encoding))):
+            self._drop_slow_client(client)
     
     async def broadcast(self, message: dict):
-        """廣播訊息到所有 WebSocket 連線"""
-        disconnected = []
+        """廣播訊息到訂閱此事件的 WebSocket 連線（只放入各連線的佇列，不等待送出）"""
+        self.seq += 1
+        message = {**message, "seq": self.seq}
+        json_frame = encode(message, "json")
+        for listener in self._listeners:
+            listener(message, json_frame)
+        self._fan_out(message, json_frame)
+    
+    def publish(self, message: dict, json_frame: Optional[str] = None):
+        """送出已由其他程序編上序號的事件（多工作程序模式下由 broker 呼叫）
         
-        for websocket in self.connections:
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"WebSocket 廣播失敗: {e}")
-                disconnected.append(websocket)
+        序號倒退表示 Gateway 擁有者已重啟，改用新的序號；之後帶舊序號重連的客戶端會收到 resync。
+        """
+        self.seq = message["seq"]
+        self._fan_out(message, json_frame or encode(message, "json"))
+    
+    def add_listener(self, listener: Callable[[dict, str], None]):
+        self._listeners.append(listener)
+    
+    def _fan_out(self, message: dict, json_frame: str):
+        started = time.perf_counter()
         
-        # 移除斷線的連線
-        for websocket in disconnected:
-            self.disconnect(websocket)
+        # 每種編碼只序列化一次，所有連線共用同一份訊框
+        frames: Dict[str, Frame] = {"json": (message.get("type"), json_frame)}
+        self.history.append(message["seq"], message, len(json_frame))
+        
+        slow = []
+        recipients = self.subscriptions.match(message)
+        for client in recipients:
+            frame = frames.get(client.encoding)
+            if frame is None:
+                frame = frames[client.encoding] = (message.get("type"), encode(message, client.encoding))
+            if not client.enqueue(frame):
+                slow.append(client)
+        for client in slow:
+            self._drop_slow_client(client)
+        
+        metrics.WS_BROADCAST_DURATION.observe(time.perf_counter() - started)
+        metrics.WS_BROADCAST_RECIPIENTS.observe(len(recipients))
     
-    async def handle_websocket(self, websocket: WebSocket):
-        """處理 WebSocket 連線的生命週期"""
-        await self.connect(websocket)
+    async def handle_websocket(self, websocket: WebSocket, can_send: bool = False):
+        """處理 WebSocket 連線的生命週期；can_send 表示連線已通過認證，可送出 send 訊框"""
+        await self.connect(websocket, can_send)
         
         try:
             while True:
                 # 等待客戶端訊息（可選）
                 data = await websocket.receive_text()
-                logger.info(f"收到 WebSocket 訊息: {data}")
-                
+                await self._handle_client_frame(websocket, data)
+        
         except WebSocketDisconnect:
-            logger.info("WebSocket 客戶端斷線")
+            logger.debug("WebSocket 客戶端斷線")
         except Exception as e:
             logger.error(f"WebSocket 錯誤: {e}")
         finally:
@@ -71,4 +270,152 @@ class WebSocketManager:
     
     def get_connection_count(self) -> int:
         """取得當前連線數"""
-        return len(self.connections)
+        return len(self.clients)
+    
+    async def _handle_client_frame(self, websocket: WebSocket, data: str):
+        """處理客戶端送來的訊框（auth / send / subscribe / unsubscribe / resume）"""
+        try:
+            frame = json.loads(data)
+        except ValueError:
+            frame = None
+        action = frame.get("action") if isinstance(frame, dict) else None
+        
+        if action not in ("auth", "send", "subscribe", "unsubscribe", "resume"):
+            logger.debug("收到 WebSocket 訊息: %s", data, extra={"event": "ws_frame"})
+            return
+        
+        client = self.clients.get(websocket)
+        if not client:
+            return
+        
+        if action == "auth":
+            self._handle_auth(client, frame)
+            return
+        
+        if action == "send":
+            await self._handle_send(client, frame)
+            return
+        
+        if action == "resume":
+            try:
+                self._replay(client, int(frame.get("since")))
+            except (TypeError, ValueError):
+                await self.send_personal_message(websocket, {
+                    "type": "error",
+                    "message": "resume 需要整數 since",
+                    "timestamp": datetime.now().isoformat()
+                })
+            return
+        
+        try:
+            filters = parse_filters(frame) if action == "subscribe" else None
+        except (TypeError, ValueError) as e:
+            await self.send_personal_message(websocket, {
+                "type": "error",
+                "message": f"訂閱格式錯誤: {e}",
+                "timestamp": datetime.now().isoformat()
+            })
+            return
+        
+        self.subscriptions.add(client, filters)
+        current = self.subscriptions.get_filters(client)
+        await self.send_personal_message(websocket, {
+            "type": "subscribed",
+            "filters": {field: sorted(values) if values is not None else None for field, values in current.items()},
+            "timestamp": datetime.now().isoformat()
+        })
+    
+    def _handle_auth(self, client: WebSocketClient, frame: dict):
+        """以 auth 訊框中的令牌取得 send 權限（無法設定 Authorization 標頭的客戶端使用）"""
+        token = frame.get("token")
+        if not API_AUTH_TOKEN or (isinstance(token, str) and hmac.compare_digest(token, API_AUTH_TOKEN)):
+            client.can_send = True
+            reply = {"type": "auth", "id": frame.get("id"), "authenticated": True}
+        else:
+            reply = {
+                "type": "error",
+                "id": frame.get("id"),
+                "code": status.HTTP_401_UNAUTHORIZED,
+                "message": "無效的認證令牌",
+                "timestamp": datetime.now().isoformat()
+            }
+        client.enqueue(("ack", encode(reply, client.encoding)), force=True)
+    
+    async def _handle_send(self, client: WebSocketClient, frame: dict):
+        """處理 send 訊框並回覆帶相同 id 的 ack 或 error
+        
+        訊框依接收順序逐一加入佇列（同一連線的訊息順序不變），客戶端不必等待 ack 即可連續送出；
+        待送出的回覆超過連線佇列上限時暫停讀取，直到客戶端收走回覆為止。
+        """
+        await client.wait_writable()
+        request_id = frame.get("id")
+        if not client.can_send:
+            status_code, body = status.HTTP_401_UNAUTHORIZED, {"detail": "無效的認證令牌"}
+        elif not self._send_handler:
+            status_code, body = status.HTTP_503_SERVICE_UNAVAILABLE, {"detail": "訊息佇列未初始化"}
+        elif not isinstance(frame.get("message"), dict):
+            status_code, body = status.HTTP_422_UNPROCESSABLE_ENTITY, {"detail": "send 需要 message 物件"}
+        else:
+            status_code, body = await self._send_handler(frame["message"], frame.get("idempotency_key"))
+        
+        if status_code < 300:
+            reply = {"type": "ack", "id": request_id, **body}
+            metrics.WS_SEND_TOTAL.inc(outcome="accepted")
+        else:
+            detail = body.get("detail")
+            reply = {
+                "type": "error",
+                "id": request_id,
+                "code": status_code,
+                "message": detail if isinstance(detail, str) else "訊息格式錯誤",
+                **body,
+                "timestamp": datetime.now().isoformat()
+            }
+            metrics.WS_SEND_TOTAL.inc(outcome="rejected")
+        client.enqueue(("ack", encode(reply, client.encoding)), force=True)
+    
+    def _replay(self, client: WebSocketClient, since: int):
+        """一次補送序號大於 since 且符合訂閱條件的事件；超出緩衝範圍時先通知客戶端重新同步
+        
+        since 大於目前序號表示伺服器（或 Gateway 擁有者）重啟後序號已重新計算，同樣視為超出範圍。
+        """
+        oldest = self.history.oldest_seq()
+        if since > self.seq or (since < self.seq and (oldest is None or since + 1 < oldest)):
+            client.enqueue(("resync", encode({
+                "type": "resync",
+                "message": "部分事件已超出補送範圍，請重新取得完整狀態",
+                "since": since,
+                "oldest_seq": oldest,
+                "seq": self.seq,
+                "timestamp": datetime.now().isoformat()
+            }, client.encoding)), force=True)
+        
+        for message in self.history.since(since):
+            if self.subscriptions.matches(client, message):
+                client.enqueue((message.get("type"), encode(message, client.encoding)), force=True)
+    
+    def _drop_slow_client(self, client: WebSocketClient):
+        """斷開跟不上的連線"""
+        self.dropped_clients += 1
+        metrics.WS_DROPPED_CLIENTS.inc()
+        logger.warning(f"WebSocket 連線待送出訊息超過 {self.max_queue} 則，已斷開")
+        client.kick()
+    
+    async def _run_client(self, client: WebSocketClient):
+        """執行連線的寫入任務，送出失敗時移除連線"""
+        try:
+            await client.run_writer()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self.dropped_clients += 1
+            metrics.WS_DROPPED_CLIENTS.inc()
+            logger.warning("WebSocket 送出逾時，已斷開停滯的連線")
+            try:
+                await client.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            except Exception:
+                pass
+        except Exception as e:
+            logger.error(f"WebSocket 廣播失敗: {e}")
+        finally:
+            self.disconnect(client.websocket)